@@ -133,6 +133,10 @@ async def initialize_clients():
         # 单客户端模式：只使用默认的StreamBot
         logger.info("使用单客户端模式（默认客户端）")
 
+    # 后台预热各机器人的媒体会话并保活
+    from WebStreamer.utils.session_pool import media_session_pool
+    media_session_pool.start()
+
 
 async def client_health_check():
     """
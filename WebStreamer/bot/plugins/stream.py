@@ -22,10 +22,14 @@ from .stream_modules import (
     handle_flood_wait_end,
     send_flood_wait_notification,
     delete_flood_wait_notification,
+    mark_client_flood_wait,
+    is_client_flood_waiting,
+    get_available_client_indices,
     
     # 任务跟踪
     task_completion_tracker,
     task_completion_lock,
+    mark_task_status,
     wait_for_tasks_completion,
     
     # 队列管理
@@ -65,10 +69,14 @@ __all__ = [
     'handle_flood_wait_end',
     'send_flood_wait_notification',
     'delete_flood_wait_notification',
+    'mark_client_flood_wait',
+    'is_client_flood_waiting',
+    'get_available_client_indices',
     
     # 任务跟踪
     'task_completion_tracker',
     'task_completion_lock',
+    'mark_task_status',
     'wait_for_tasks_completion',
     
     # 队列管理
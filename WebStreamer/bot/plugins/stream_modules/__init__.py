@@ -26,13 +26,17 @@ from .flood_control import (
     handle_flood_wait_start,
     handle_flood_wait_end,
     send_flood_wait_notification,
-    delete_flood_wait_notification
+    delete_flood_wait_notification,
+    mark_client_flood_wait,
+    is_client_flood_waiting,
+    get_available_client_indices
 )
 
 # 任务跟踪模块
 from .task_tracker import (
     task_completion_tracker,
     task_completion_lock,
+    mark_task_status,
     wait_for_tasks_completion
 )
 
@@ -77,10 +81,14 @@ __all__ = [
     'handle_flood_wait_end',
     'send_flood_wait_notification',
     'delete_flood_wait_notification',
+    'mark_client_flood_wait',
+    'is_client_flood_waiting',
+    'get_available_client_indices',
     
     # task_tracker
     'task_completion_tracker',
     'task_completion_lock',
+    'mark_task_status',
     'wait_for_tasks_completion',
     
     # queue_manager
@@ -4,6 +4,8 @@
 """
 限流控制模块
 管理 Telegram API 限流状态，实现智能队列暂停和恢复
+限流按机器人单独记录（冷却时间保存在客户端调度器中），被限流的机器人不再参与转发、文件解析、直链和上传，
+只有所有机器人都被限流时才暂停整个队列
 """
 
 import logging
@@ -13,7 +15,7 @@ from WebStreamer.vars import Var
 
 logger = logging.getLogger(__name__)
 
-# 限流状态管理
+# 全局限流状态管理（所有机器人都被限流时）
 # 用于跟踪 Telegram 限流状态,实现智能队列暂停和恢复
 flood_wait_status = {
     'is_flood_waiting': False,  # 是否处于限流状态
@@ -40,12 +42,49 @@ def extract_flood_wait_seconds(error: Exception) -> int:
     return 300
 
 
-async def handle_flood_wait_start(error: Exception):
-    """处理限流开始"""
+def mark_client_flood_wait(client_index: int, error: Exception, method_class: str = None, chat_id: int = None) -> int:
+    """
+    记录单个机器人的限流，返回限流秒数
+    method_class/chat_id 用于让令牌桶限速器按该类调用（及聊天）降速
+    """
+    from WebStreamer.utils.scheduler import client_scheduler
+    wait_seconds = extract_flood_wait_seconds(error)
+    if wait_seconds <= 0:
+        wait_seconds = 300
+    client_scheduler.record_flood_wait(client_index, wait_seconds, method_class, chat_id)
+    return wait_seconds
+
+
+def is_client_flood_waiting(client_index: int) -> bool:
+    """机器人是否处于限流冷却中"""
+    from WebStreamer.utils.scheduler import client_scheduler
+    return client_scheduler.is_flooded(client_index)
+
+
+def get_available_client_indices(exclude=()) -> list:
+    """未被限流的机器人索引（优先能访问频道的）"""
+    from WebStreamer.utils.scheduler import client_scheduler
+    return [i for i in client_scheduler.candidates(exclude) if not client_scheduler.is_flooded(i)]
+
+
+async def handle_flood_wait_start(error: Exception, client_index: int = None):
+    """
+    处理限流开始
+    指定 client_index 时只冷却该机器人，其余机器人照常工作；所有机器人都被限流（或来源未知）时才暂停整个队列
+    """
     global flood_wait_status, flood_wait_lock
     wait_seconds = extract_flood_wait_seconds(error)
     if wait_seconds <= 0:
         wait_seconds = 300
+    if client_index is not None:
+        from WebStreamer.utils.scheduler import client_scheduler
+        mark_client_flood_wait(client_index, error)
+        if not client_scheduler.all_flooded():
+            logger.warning(f"客户端 {client_index} 被 Telegram 限流 {wait_seconds} 秒，其余客户端继续处理")
+            return
+        # 所有机器人都被限流：暂停到最早恢复的机器人结束冷却为止
+        from WebStreamer.bot import multi_clients
+        wait_seconds = max(1, int(min(client_scheduler.flood_wait_remaining(i) for i in multi_clients)))
     async with flood_wait_lock:
         flood_wait_status['is_flood_waiting'] = True
         flood_wait_status['flood_wait_seconds'] = wait_seconds
@@ -68,6 +107,8 @@ async def send_flood_wait_notification(wait_seconds: int):
     best_bot_idx = min(available_bots, key=lambda x: work_loads.get(x[0], 0))[0]
     backup_bot = multi_clients[best_bot_idx]
     try:
+        from WebStreamer.utils.rate_limiter import rate_limiter
+        await rate_limiter.acquire(best_bot_idx, "send", Var.BIN_CHANNEL)
         import datetime
         end_time = datetime.datetime.utcnow() + datetime.timedelta(seconds=wait_seconds)
         end_time_str = end_time.strftime('%H:%M:%S UTC')
@@ -113,8 +154,10 @@ async def delete_flood_wait_notification():
     if not msg_id or not chat_id:
         return
     from WebStreamer.bot import multi_clients
+    from WebStreamer.utils.rate_limiter import rate_limiter
     for idx, client in multi_clients.items():
         try:
+            await rate_limiter.acquire(idx, "delete")
             await client.delete_messages(chat_id=chat_id, message_ids=[msg_id])
             logger.info(f"已删除限流通知消息 (使用 bot {idx})")
             return
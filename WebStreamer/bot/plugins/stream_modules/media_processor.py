@@ -12,11 +12,17 @@ from collections import defaultdict
 from urllib.parse import quote_plus
 from pyrogram import filters, errors
 from pyrogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton
+from pyrogram.enums import ChatType
 from pyrogram.enums.parse_mode import ParseMode
 
 from WebStreamer.vars import Var
-from WebStreamer.bot import StreamBot, logger
+from WebStreamer.bot import StreamBot, logger, multi_clients
 from WebStreamer.utils import get_hash, get_name
+from WebStreamer.utils.file_properties import get_media_from_message
+from WebStreamer.utils.scheduler import client_scheduler
+from WebStreamer.utils.rate_limiter import rate_limiter
+from WebStreamer.utils.admission import internal_link
+from WebStreamer.utils.tg_downloader import tg_downloader
 from db import save_tg_media, create_download, mark_download_started
 
 # 媒体组缓存：用于收集同一媒体组的所有消息
@@ -24,6 +30,117 @@ media_group_cache = defaultdict(list)
 media_group_tasks = {}
 
 
+def reachable_by_other_bots(m: Message) -> bool:
+    """
+    来源消息能否由其他机器人访问：只有频道与群组中的消息可能被其他（同为成员的）机器人获取，
+    私聊中的消息与消息 ID 只属于接收它的机器人
+    """
+    chat = getattr(m, "chat", None)
+    return getattr(chat, "type", None) in (ChatType.CHANNEL, ChatType.SUPERGROUP, ChatType.GROUP)
+
+
+def receiver_flood_wait(receiver_index) -> errors.FloodWait:
+    """接收消息的机器人剩余冷却时间对应的 FloodWait，交给队列处理器暂停后重新处理该消息"""
+    remaining = client_scheduler.flood_wait_remaining(receiver_index) if receiver_index is not None else 0
+    return errors.FloodWait(value=max(1, int(remaining)))
+
+
+async def send_media_via_other_bot(m: Message, receiver_index):
+    """
+    由其他未被限流的机器人从来源聊天复制同一条消息到日志频道（copy_message）
+    file_id 只对获取它的机器人有效，因此由该机器人自己获取消息，使用它自己的 file_id
+    只用于其他机器人也能访问的来源聊天（频道、群组）；没有机器人能复制时按接收机器人的剩余冷却抛出 FloodWait
+    """
+    from .flood_control import mark_client_flood_wait, get_available_client_indices
+    last_flood_error = None
+    for index in get_available_client_indices({receiver_index}):
+        try:
+            await rate_limiter.acquire(index, "send", Var.BIN_CHANNEL)
+            log_msg = await multi_clients[index].copy_message(
+                chat_id=Var.BIN_CHANNEL,
+                from_chat_id=m.chat.id,
+                message_id=m.id
+            )
+            logger.info(f"已使用客户端 {index} 将媒体发送到日志频道")
+            return log_msg
+        except errors.FloodWait as e:
+            mark_client_flood_wait(index, e, "send", Var.BIN_CHANNEL)
+            last_flood_error = e
+        except Exception as e:
+            logger.warning(f"客户端 {index} 发送媒体到日志频道失败: {e}")
+    if last_flood_error is not None:
+        raise last_flood_error
+    raise receiver_flood_wait(receiver_index)
+
+
+async def forward_to_bin_channel(m: Message):
+    """
+    转发单条媒体到日志频道
+    接收消息的机器人处于限流冷却中（或转发时触发限流）时，来源聊天其他机器人也能访问则改由其他机器人发送，
+    否则抛出 FloodWait，由队列处理器暂停并在冷却结束后重新处理
+    """
+    from .flood_control import mark_client_flood_wait
+    receiver_index = client_scheduler.client_index(getattr(m, "_client", None))
+    if receiver_index is None or not client_scheduler.is_flooded(receiver_index):
+        try:
+            await rate_limiter.acquire(receiver_index if receiver_index is not None else getattr(m, "_client", None), "send", Var.BIN_CHANNEL)
+            return await m.forward(chat_id=Var.BIN_CHANNEL)
+        except errors.FloodWait as e:
+            if receiver_index is None:
+                raise
+            mark_client_flood_wait(receiver_index, e, "send", Var.BIN_CHANNEL)
+    if not reachable_by_other_bots(m):
+        raise receiver_flood_wait(receiver_index)
+    return await send_media_via_other_bot(m, receiver_index)
+
+
+async def start_native_download(log_msg: Message, original_msg: Message, stream_link: str, aria2_client):
+    """
+    使用进程内下载器直接把 Telegram 媒体写入磁盘（不经过 aria2 回环下载直链）
+    进度与完成事件写入同一张 downloads 表，完成后交给 aria2 下载处理器同样的上传与清理流程
+    
+    Returns:
+        任务GID；未启用或无法启动时返回 None，由调用方回退到 aria2
+    """
+    if not Var.NATIVE_DOWNLOAD:
+        return None
+    media = get_media_from_message(original_msg)
+    if not media:
+        return None
+    
+    # 与 aria2 使用同一个下载目录，上传与清理阶段无需区分来源
+    save_dir = None
+    try:
+        save_dir = (await aria2_client.get_global_option()).get('dir')
+    except Exception as e:
+        logger.debug(f"获取aria2下载目录失败，使用 SAVE_PATH: {e}")
+    if not save_dir:
+        from configer import get_config_value
+        save_dir = get_config_value('SAVE_PATH', 'downloads')
+    
+    try:
+        gid = tg_downloader.start(
+            log_msg.id,
+            get_name(original_msg),
+            save_dir,
+            aria2_client.download_handler.on_native_download_complete,
+        )
+    except Exception as e:
+        logger.error(f"启动进程内下载失败，回退到aria2: {e}", exc_info=True)
+        return None
+    # 进程内下载已计入槽位占用，归还等待槽位时的预留
+    aria2_client.download_slots.cancel_reservation()
+    
+    # 记录 Telegram 媒体与下载任务到数据库（下载任务在下一次事件循环才开始，进度更新时记录已存在）
+    try:
+        file_unique_id = save_tg_media(original_msg, media)
+        create_download(file_unique_id, gid, stream_link)
+        mark_download_started(gid)
+    except Exception as db_e:
+        logger.error(f"记录进程内下载任务到数据库失败: {db_e}", exc_info=True)
+    return gid
+
+
 async def process_media_group(messages: list, queue_reply_msg=None):
     """
     处理媒体组：一次性转发所有媒体文件到频道，保持消息完整性
@@ -57,13 +174,23 @@ async def process_media_group(messages: list, queue_reply_msg=None):
     try:
         # 一次性转发整个媒体组到频道（保持消息完整性）
         # 使用 forward_messages 一次性转发所有消息，保持媒体组完整性
+        # 由接收媒体组的机器人转发（只有它能访问来源聊天中的这些消息）
+        receiver = getattr(first_msg, "_client", None) or StreamBot
+        receiver_index = client_scheduler.client_index(receiver)
+        if receiver_index is None:
+            receiver_index = 0
         try:
+            # 接收消息的机器人处于限流冷却中时直接逐条由其他机器人发送
+            if client_scheduler.is_flooded(receiver_index):
+                raise errors.FloodWait(value=int(client_scheduler.flood_wait_remaining(receiver_index)) or 1)
+
             # 获取所有消息的 ID
             message_ids = [msg.id for msg in messages]
             chat_id = messages[0].chat.id
             
-            # 一次性转发整个媒体组
-            forwarded_msgs = await StreamBot.forward_messages(
+            # 一次性转发整个媒体组（按消息条数获取令牌）
+            await rate_limiter.acquire(receiver_index, "send", Var.BIN_CHANNEL, tokens=len(message_ids))
+            forwarded_msgs = await receiver.forward_messages(
                 chat_id=Var.BIN_CHANNEL,
                 from_chat_id=chat_id,
                 message_ids=message_ids
@@ -81,15 +208,31 @@ async def process_media_group(messages: list, queue_reply_msg=None):
                 forwarded_messages.append((messages[0], forwarded_msgs))
                 
         except Exception as e:
-            logger.error(f"转发媒体组失败: {e}", exc_info=True)
-            # 如果一次性转发失败，回退到逐条转发
+            if isinstance(e, errors.FloodWait):
+                from .flood_control import mark_client_flood_wait
+                if not client_scheduler.is_flooded(receiver_index):
+                    mark_client_flood_wait(receiver_index, e, "send", Var.BIN_CHANNEL)
+                if not reachable_by_other_bots(first_msg):
+                    # 私聊中的媒体组只有接收它的机器人能转发：等待冷却结束后由队列处理器重新处理
+                    raise receiver_flood_wait(receiver_index)
+                logger.warning(f"客户端 {receiver_index} 被限流，改由其他客户端逐条转发媒体组")
+            else:
+                logger.error(f"转发媒体组失败: {e}", exc_info=True)
+            # 如果一次性转发失败，回退到逐条转发（被限流的机器人会自动跳过）
             forwarded_messages = []
+            last_flood_error = None
             for msg in messages:
                 try:
-                    log_msg = await msg.forward(chat_id=Var.BIN_CHANNEL)
+                    log_msg = await forward_to_bin_channel(msg)
                     forwarded_messages.append((msg, log_msg))
+                except errors.FloodWait as e2:
+                    last_flood_error = e2
+                    logger.warning(f"转发单条消息时所有客户端均被限流: {e2}")
                 except Exception as e2:
                     logger.error(f"转发单条消息失败: {e2}", exc_info=True)
+            # 所有机器人都被限流：交给队列处理器暂停并稍后重试
+            if not forwarded_messages and last_flood_error is not None:
+                raise last_flood_error
         
         if not forwarded_messages:
             return
@@ -97,6 +240,7 @@ async def process_media_group(messages: list, queue_reply_msg=None):
         # 为每个媒体文件生成直链
         stream_links = []
         download_links = []
+        download_items = []  # 与 download_links 一一对应的 (原始消息, 频道消息)
         
         for original_msg, log_msg in forwarded_messages:
             try:
@@ -114,6 +258,7 @@ async def process_media_group(messages: list, queue_reply_msg=None):
                 # 检查是否应该下载（图片类不下载）
                 if should_download_file(original_msg):
                     download_links.append(stream_link)
+                    download_items.append((original_msg, log_msg))
                     logger.info(f"直链已生成（将下载）： {stream_link} for {first_msg.from_user.first_name}")
                 else:
                     logger.info(f"直链已生成（仅转发）： {stream_link} for {first_msg.from_user.first_name}")
@@ -245,25 +390,25 @@ async def process_media_group(messages: list, queue_reply_msg=None):
                     while retry_count <= max_retries and not added_successfully:
                         try:
                             # 无论是否启用小文件跳过，都必须等待空闲槽位，确保不超过最大并发数
-                            # 只有在添加第一个任务且不是重试时，才可能跳过等待（但为了安全，仍然检查）
-                            if i > 0 or retry_count > 0:
-                                await wait_for_download_slot(max_wait_time=60)
-                            else:
-                                # 即使是第一个任务，也检查一下当前任务数，确保不超过限制
-                                try:
-                                    active_tasks = await aria2_client.tell_active()
-                                    waiting_tasks = await aria2_client.tell_waiting(0, 100)
-                                    current_count = len(active_tasks) + len(waiting_tasks)
-                                    from .utils import get_aria2_max_concurrent_downloads
-                                    max_concurrent = await get_aria2_max_concurrent_downloads()
-                                    if current_count >= max_concurrent:
-                                        logger.debug(f"当前任务数已达上限 ({current_count}/{max_concurrent})，等待空闲槽位")
-                                        await wait_for_download_slot(max_wait_time=60)
-                                except Exception as e:
-                                    logger.debug(f"检查任务数失败，继续添加: {e}")
+                            # （槽位在进程内计数，有空闲时立即返回，不查询aria2）
+                            await wait_for_download_slot(max_wait_time=60)
+                            
+                            # Telegram 媒体优先由进程内下载器直接写入磁盘（无需等待 aria2 任务开始），未启用或启动失败时回退到 aria2
+                            native_gid = await start_native_download(download_items[i][1], download_items[i][0], link, aria2_client)
+                            if native_gid:
+                                success_count += 1
+                                added_successfully = True
+                                task_gids.append(native_gid)
+                                if queue_reply_msg:
+                                    try:
+                                        from .utils import register_gid_queue_msg
+                                        register_gid_queue_msg(native_gid, queue_reply_msg)
+                                    except Exception as reg_e:
+                                        logger.debug(f"注册GID队列消息失败: {reg_e}")
+                                continue
                             
                             # 添加任务
-                            result = await aria2_client.add_uri(uris=[link])
+                            result = await aria2_client.add_uri(uris=[internal_link(link)])
                             
                             # 检查返回结果
                             if result and 'result' in result:
@@ -378,6 +523,7 @@ async def process_media_group(messages: list, queue_reply_msg=None):
                 if main_link:
                     buttons.append([InlineKeyboardButton("🔗 打开直链", url=main_link)])
                 
+                await rate_limiter.acquire_for_message(first_msg, "send")
                 reply_msg = await first_msg.reply_text(
                     text=reply_text,
                     quote=True,
@@ -385,6 +531,7 @@ async def process_media_group(messages: list, queue_reply_msg=None):
                     reply_markup=InlineKeyboardMarkup(buttons) if buttons else None,
                 )
             except errors.ButtonUrlInvalid:
+                await rate_limiter.acquire_for_message(first_msg, "send")
                 reply_msg = await first_msg.reply_text(
                     text=reply_text,
                     quote=True,
@@ -401,6 +548,7 @@ async def process_media_group(messages: list, queue_reply_msg=None):
                         f"⬇️ {len(download_links)} 个将下载\n"
                         "🔄 请稍候，处理完成后会通知您"
                     )
+                    await rate_limiter.acquire_for_message(queue_reply_msg, "edit")
                     await queue_reply_msg.edit_text(
                         text=processing_text,
                         parse_mode=ParseMode.HTML
@@ -417,6 +565,9 @@ async def process_media_group(messages: list, queue_reply_msg=None):
         
         # 返回任务GID列表，供队列处理器等待完成
         return task_gids
+    except errors.FloodWait:
+        # 所有机器人都被限流：交给队列处理器暂停队列，限流结束后重新处理
+        raise
     except Exception as e:
         logger.error(f"处理媒体组失败: {e}", exc_info=True)
         try:
@@ -424,6 +575,7 @@ async def process_media_group(messages: list, queue_reply_msg=None):
                 f'❌ <b>处理失败</b>\n\n'
                 f'⚠️ 处理媒体组时出错，请稍后重试'
             )
+            await rate_limiter.acquire_for_message(first_msg, "send")
             await first_msg.reply(error_reply, quote=True, parse_mode=ParseMode.HTML)
         except:
             pass
@@ -458,16 +610,18 @@ async def process_single_media(m: Message, queue_reply_msg=None):
             f'🚫 <b>权限不足</b>\n\n'
             f'⚠️ 你没有权限使用这个机器人'
         )
+        await rate_limiter.acquire_for_message(m, "send")
         return await m.reply(permission_msg, quote=True, parse_mode=ParseMode.HTML)
     
     # BIN_CHANNEL检查
     if not Var.BIN_CHANNEL:
         logger.warning(f"BIN_CHANNEL未配置，无法为 {m.from_user.first_name} 生成直链")
+        await rate_limiter.acquire_for_message(m, "send")
         return await m.reply("直链功能未配置，请在配置文件中设置 BIN_CHANNEL", quote=True)
     
     try:
         # 转发到日志频道并生成直链
-        log_msg = await m.forward(chat_id=Var.BIN_CHANNEL)
+        log_msg = await forward_to_bin_channel(m)
         file_hash = get_hash(log_msg, Var.HASH_LENGTH)
         stream_link = f"{Var.URL}{log_msg.id}/{quote_plus(get_name(m))}?hash={file_hash}"
         short_link = f"{Var.URL}{file_hash}{log_msg.id}"
@@ -519,18 +673,22 @@ async def process_single_media(m: Message, queue_reply_msg=None):
                         from .utils import wait_for_download_slot
                         await wait_for_download_slot(max_wait_time=60)
                         
-                        result = await aria2_client.add_uri(uris=[stream_link])
-                        if result and 'result' in result:
-                            task_gid = result.get('result')
-                            # 记录 Telegram 媒体与下载任务到数据库
-                            try:
-                                if media:
-                                    file_unique_id = save_tg_media(m, media)
-                                    create_download(file_unique_id, task_gid, stream_link)
-                                    mark_download_started(task_gid)
-                            except Exception as db_e:
-                                logger.error(f"记录单文件下载任务到数据库失败: {db_e}", exc_info=True)
-                            
+                        # Telegram 媒体优先由进程内下载器直接写入磁盘，未启用或启动失败时回退到 aria2
+                        task_gid = await start_native_download(log_msg, m, stream_link, aria2_client)
+                        if task_gid is None:
+                            result = await aria2_client.add_uri(uris=[internal_link(stream_link)])
+                            if result and 'result' in result:
+                                task_gid = result.get('result')
+                                # 记录 Telegram 媒体与下载任务到数据库
+                                try:
+                                    if media:
+                                        file_unique_id = save_tg_media(m, media)
+                                        create_download(file_unique_id, task_gid, stream_link)
+                                        mark_download_started(task_gid)
+                                except Exception as db_e:
+                                    logger.error(f"记录单文件下载任务到数据库失败: {db_e}", exc_info=True)
+                        
+                        if task_gid:
                             # 注册GID和队列通知消息的关联（用于清理完成后更新通知）
                             try:
                                 from .utils import register_gid_queue_msg
@@ -539,7 +697,7 @@ async def process_single_media(m: Message, queue_reply_msg=None):
                                 logger.debug(f"注册GID队列消息失败: {reg_e}")
                             
                         download_added = True
-                        logger.info(f"已将直链添加到aria2下载队列: {stream_link}, GID: {task_gid}")
+                        logger.info(f"已添加到下载队列: {stream_link}, GID: {task_gid}")
                 except Exception as e:
                     logger.error(f"添加直链到aria2失败: {e}", exc_info=True)
         
@@ -572,6 +730,7 @@ async def process_single_media(m: Message, queue_reply_msg=None):
                 reply_text += "\n\n⚠️ <b>添加到下载队列失败，请手动添加</b>"
             
             try:
+                await rate_limiter.acquire_for_message(m, "send")
                 await m.reply_text(
                     text=reply_text,
                     quote=True,
@@ -581,6 +740,7 @@ async def process_single_media(m: Message, queue_reply_msg=None):
                     ),
                 )
             except errors.ButtonUrlInvalid:
+                await rate_limiter.acquire_for_message(m, "send")
                 await m.reply_text(
                     text=reply_text,
                     quote=True,
@@ -595,6 +755,7 @@ async def process_single_media(m: Message, queue_reply_msg=None):
                         "📥 消息正在处理中...\n"
                         "🔄 请稍候，处理完成后会通知您"
                     )
+                    await rate_limiter.acquire_for_message(queue_reply_msg, "edit")
                     await queue_reply_msg.edit_text(
                         text=processing_text,
                         parse_mode=ParseMode.HTML
@@ -614,8 +775,12 @@ async def process_single_media(m: Message, queue_reply_msg=None):
         
         # 返回任务GID列表，供队列处理器等待完成
         return [task_gid] if task_gid else []
+    except errors.FloodWait:
+        # 所有机器人都被限流：交给队列处理器暂停队列，限流结束后重新处理
+        raise
     except Exception as e:
         logger.error(f"生成直链失败: {e}", exc_info=True)
+        await rate_limiter.acquire_for_message(m, "send")
         await m.reply("生成直链时出错，请稍后重试", quote=True)
         return []  # 返回空列表
 
@@ -10,6 +10,7 @@ import logging
 import asyncio
 from pyrogram.types import Message
 from pyrogram.enums.parse_mode import ParseMode
+from WebStreamer.utils.rate_limiter import rate_limiter
 
 logger = logging.getLogger(__name__)
 
@@ -24,6 +25,10 @@ def set_aria2_client(client):
     """设置aria2客户端"""
     global aria2_client
     aria2_client = client
+    # 进程内下载结束时同样会空出下载槽位
+    if client is not None:
+        from WebStreamer.utils.tg_downloader import tg_downloader
+        tg_downloader.on_finished = client.download_slots.notify
 
 
 async def get_aria2_max_concurrent_downloads():
@@ -76,7 +81,9 @@ async def wait_for_download_slot(max_wait_time=60):
     """
     等待有空闲下载槽位（统一控制，确保不超过最大并发数）
     
-    此函数会检查当前aria2的任务数，如果已达到最大并发数，则等待直到有空闲槽位。
+    槽位由 aria2 客户端在进程内计数（添加任务时占用，完成/出错/移除通知时释放，定时按 aria2 校准），
+    进程内 Telegram 下载同样占用槽位。已达到最大并发数时排队等待，槽位空出时立即唤醒，
+    返回时为调用方预留一个槽位，直到它添加的任务被登记。
     无论是否启用小文件跳过，都必须调用此函数来确保不超过最大并发数。
     
     Args:
@@ -90,49 +97,30 @@ async def wait_for_download_slot(max_wait_time=60):
         return True
     
     max_concurrent = await get_aria2_max_concurrent_downloads()
-    wait_start = asyncio.get_event_loop().time()
-    last_log_time = 0
-    check_interval = 2.0  # 每2秒检查一次
-    
-    while True:
+    slots = aria2_client.download_slots
+    if not slots.seeded:
+        # 轮询任务尚未完成首次校准时，先从aria2获取当前任务数
         try:
-            # 获取当前正在下载和等待的任务数
-            active_tasks = await aria2_client.tell_active()
-            waiting_tasks = await aria2_client.tell_waiting(0, 100)
-            current_count = len(active_tasks) + len(waiting_tasks)
-            elapsed_time = asyncio.get_event_loop().time() - wait_start
-            
-            # 如果当前任务数小于最大并发数，有空闲槽位
-            if current_count < max_concurrent:
-                if elapsed_time > 1:  # 如果等待了超过1秒，记录日志
-                    logger.debug(f"等待空闲槽位成功，当前任务数: {current_count}/{max_concurrent}，等待时间: {elapsed_time:.1f}秒")
-                return True
-            
-            # 定期记录等待状态（每5秒记录一次）
-            if elapsed_time - last_log_time >= 5:
-                logger.debug(
-                    f"等待空闲槽位中... 当前任务数: {current_count}/{max_concurrent}，"
-                    f"已等待: {elapsed_time:.1f}秒"
-                )
-                last_log_time = elapsed_time
-            
-            # 检查是否超时
-            if elapsed_time > max_wait_time:
-                logger.warning(
-                    f"等待空闲槽位超时（{max_wait_time}秒），当前任务数: {current_count}/{max_concurrent}，"
-                    f"将继续尝试添加任务（任务将进入等待队列）"
-                )
-                # 即使超时也返回True，让任务添加到等待队列
-                return True
-            
-            # 等待后重试
-            await asyncio.sleep(check_interval)
+            await aria2_client.reconcile_download_slots()
         except Exception as e:
             logger.error(f"检查aria2任务状态失败: {e}")
-            # 如果检查失败，等待一下再继续
-            await asyncio.sleep(1.0)
             # 如果检查失败，假设有空闲位置，继续尝试
             return True
+    
+    from WebStreamer.utils.tg_downloader import tg_downloader
+    wait_start = asyncio.get_event_loop().time()
+    if await slots.wait(max_concurrent, max_wait_time, extra=tg_downloader.active_count):
+        elapsed_time = asyncio.get_event_loop().time() - wait_start
+        if elapsed_time > 1:  # 如果等待了超过1秒，记录日志
+            logger.debug(f"等待空闲槽位成功，当前任务数: {slots.in_use()}/{max_concurrent}，等待时间: {elapsed_time:.1f}秒")
+        return True
+    
+    logger.warning(
+        f"等待空闲槽位超时（{max_wait_time}秒），当前任务数: {slots.in_use()}/{max_concurrent}，"
+        f"将继续尝试添加任务（任务将进入等待队列）"
+    )
+    # 即使超时也返回True，让任务添加到等待队列
+    return True
 
 
 def should_download_file(message: Message) -> bool:
@@ -227,6 +215,7 @@ async def update_queue_msg_on_cleanup(gid: str):
         # 优先更新队列通知消息（如果存在）
         if queue_reply_msg:
             try:
+                await rate_limiter.acquire_for_message(queue_reply_msg, "edit")
                 await queue_reply_msg.edit_text(
                     text=completion_text,
                     parse_mode=ParseMode.HTML
@@ -237,6 +226,7 @@ async def update_queue_msg_on_cleanup(gid: str):
         # 如果没有队列通知消息，但有原始消息，则回复原始消息
         elif original_msg:
             try:
+                await rate_limiter.acquire_for_message(original_msg, "send")
                 await original_msg.reply_text(
                     text=completion_text,
                     quote=True,
@@ -276,6 +266,7 @@ async def send_queue_notification(message: Message, queue_size: int):
                 f"⏰ 请耐心等待，正在按顺序处理..."
             )
         
+        await rate_limiter.acquire_for_message(message, "send")
         reply_msg = await message.reply_text(
             text=queue_text,
             quote=True,
@@ -5,3 +5,10 @@ class InvalidHash(Exception):
 class FIleNotFound(Exception):
     message = "File not found"
 
+class StreamOverloaded(Exception):
+    message = "Too many concurrent streams, retry later"
+
+    def __init__(self, retry_after: int):
+        super().__init__(self.message)
+        self.retry_after = retry_after
+
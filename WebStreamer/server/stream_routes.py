@@ -3,7 +3,6 @@
 
 import re
 import time
-import math
 import logging
 import secrets
 import mimetypes
@@ -13,18 +12,31 @@ import json
 import asyncio
 import sqlite3
 from datetime import datetime
+from urllib.parse import unquote_plus, urlparse
 from pathlib import Path
 from aiohttp import web
 from aiohttp.http_exceptions import BadStatusLine
+from pyrogram.errors import FloodWait
 from WebStreamer.bot import multi_clients, work_loads, channel_accessible_clients
-from WebStreamer.server.exceptions import FIleNotFound, InvalidHash
+from WebStreamer.server.exceptions import FIleNotFound, InvalidHash, StreamOverloaded
 from WebStreamer.server.ws_manager import ws_manager
 from WebStreamer import Var, utils, StartTime, __version__, StreamBot
+from WebStreamer.utils.chunk_cache import chunk_cache
+from WebStreamer.utils.disk_cache import disk_cache
+from WebStreamer.utils.file_id_cache import file_id_cache
+from WebStreamer.utils.session_pool import media_session_pool
+from WebStreamer.utils.scheduler import client_scheduler
+from WebStreamer.utils.rate_limiter import rate_limiter
+from WebStreamer.utils.stream_stats import stream_stats
+from WebStreamer.utils.write_coalescer import WriteCoalescer, socket_write_size
+from WebStreamer.utils.seek_prefetch import seek_prefetcher
+from WebStreamer.utils.admission import admission, client_address, internal_link, is_internal_request
+from WebStreamer.utils.tg_downloader import tg_downloader
 from db import (
     fetch_recent_downloads, get_all_configs, get_config, set_config,
-    get_download_id_by_gid, get_download_by_id, get_upload_by_id,
+    get_download_id_by_gid, get_download_by_id, get_download_journal, get_upload_by_id,
     mark_download_failed, update_upload_status, mark_upload_failed,
-    delete_download_record
+    delete_download_record, get_local_paths_by_unique_id
 )
 import configer
 
@@ -147,6 +159,7 @@ async def api_status_handler(_):
             else:
                 bot_username = "@unknown"
     
+    aria2 = get_aria2_client()
     return web.json_response(
         {
             "server_status": "running",
@@ -160,6 +173,17 @@ async def api_status_handler(_):
                 )
             ),
             "version": f"v{__version__}",
+            "chunk_cache": chunk_cache.stats(),
+            "disk_cache": disk_cache.stats(),
+            "file_id_cache": file_id_cache.stats(),
+            "media_sessions": media_session_pool.stats(),
+            "scheduler": client_scheduler.stats(),
+            "flood_wait": client_scheduler.flood_wait_status(),
+            "rate_limits": rate_limiter.stats(),
+            "streams": stream_stats.stats(),
+            "seek_prefetch": seek_prefetcher.stats(),
+            "admission": admission.stats(),
+            "download_slots": aria2.download_slots.stats() if aria2 else None,
         }
     )
 
@@ -833,6 +857,20 @@ async def update_config_handler(request: web.Request):
             'STREAM_ALLOWED_USERS': ('string', 'stream', '允许使用直链的用户列表'),
             'STREAM_AUTO_DOWNLOAD': ('bool', 'stream', '是否自动添加到下载队列'),
             'SEND_STREAM_LINK': ('bool', 'stream', '是否发送直链信息给用户'),
+            'STREAM_PREFETCH_MIN': ('int', 'stream', '直链预读窗口最小分块数（默认2）'),
+            'STREAM_PREFETCH_MAX': ('int', 'stream', '直链预读窗口最大分块数（默认8）'),
+            'STREAM_STRIPED': ('bool', 'stream', '是否启用多机器人条带化传输（默认关闭）'),
+            'STREAM_CHUNK_CACHE_MB': ('int', 'stream', '最近分块内存缓存大小MB（默认64）'),
+            'STREAM_NATIVE_DOWNLOAD': ('bool', 'stream', 'Telegram媒体是否使用进程内下载器（默认关闭）'),
+            'STREAM_DOWNLOAD_CONCURRENCY': ('int', 'stream', '进程内下载器每个机器人在途分块数（默认4）'),
+            'STREAM_DISK_CACHE_MB': ('int', 'stream', '磁盘分块缓存大小MB（默认0，不启用）'),
+            'STREAM_DISK_CACHE_DIR': ('string', 'stream', '磁盘分块缓存目录（留空使用数据库目录下的segment_cache）'),
+            'STREAM_MAX_STREAMS': ('int', 'stream', '同时进行的外部直链数量上限（默认0，不限制）'),
+            'STREAM_MAX_STREAMS_PER_IP': ('int', 'stream', '单个IP同时进行的直链数量上限（默认0，不限制）'),
+            'STREAM_TRUSTED_PROXIES': ('list', 'stream', '可信反向代理地址列表（按X-Forwarded-For识别客户端IP）'),
+            'STREAM_QUEUE_SIZE': ('int', 'stream', '超出上限的直链请求排队数量（默认16）'),
+            'STREAM_QUEUE_TIMEOUT': ('int', 'stream', '直链请求排队等待秒数，超时返回503（默认5）'),
+            'STREAM_BOT_CHUNK_BUDGET': ('int', 'stream', '每个机器人同时在途的分块请求数上限（默认32，0不限制）'),
             'MULTI_BOT_TOKENS': ('list', 'stream', '多机器人Token列表'),
         }
         
@@ -1164,6 +1202,34 @@ async def queue_api_handler(request: web.Request):
 
 # ==================== 下载任务控制 API ====================
 
+async def restart_native_download(client, gid: str, download_record: dict) -> str:
+    """
+    重新开始进程内 Telegram 下载：取消仍在进行的旧任务，按直链中的消息 ID 重新下载，返回新的 GID
+    因临时错误失败、保留了分块日志的下载按位图续传，沿用原来的 GID 与文件
+    """
+    await tg_downloader.cancel(gid)
+    journal = get_download_journal(download_record['id'])
+    if journal:
+        return tg_downloader.resume(journal, client.download_handler.on_native_download_complete)
+    link_path = urlparse(download_record.get('source_url') or '').path
+    match = re.search(r"(\d+)/([^/]+)$", link_path) or re.search(r"(\d+)$", link_path)
+    if not match:
+        raise ValueError("无法从直链中获取消息ID")
+    message_id = int(match.group(1))
+    file_name = unquote_plus(match.group(2)) if match.lastindex == 2 else str(message_id)
+    
+    # 与 aria2 使用同一个下载目录
+    save_dir = download_record.get('save_dir')
+    if not save_dir:
+        try:
+            save_dir = (await client.get_global_option()).get('dir')
+        except Exception as e:
+            logger.debug(f"获取aria2下载目录失败，使用 SAVE_PATH: {e}")
+    if not save_dir:
+        save_dir = configer.get_config_value('SAVE_PATH', 'downloads')
+    return tg_downloader.start(message_id, file_name, save_dir, client.download_handler.on_native_download_complete)
+
+
 @routes.post("/api/downloads/{gid}/retry")
 async def retry_download_handler(request: web.Request):
     """重试下载任务（重新提交到aria2）"""
@@ -1200,6 +1266,31 @@ async def retry_download_handler(request: web.Request):
                 "error": "无法获取下载源URL，无法重试"
             }, status=400)
         
+        if tg_downloader.is_native_gid(gid):
+            # 进程内下载：取消旧任务后由进程内下载器重新下载，不经过aria2
+            try:
+                new_gid = await restart_native_download(client, gid, download_record)
+            except Exception as e:
+                logger.error(f"重新开始进程内下载失败: {e}", exc_info=True)
+                return web.json_response({
+                    "success": False,
+                    "error": str(e)
+                }, status=500)
+            from db import get_connection
+            now_iso = datetime.utcnow().isoformat(timespec="seconds") + 'Z'
+            with get_connection() as conn:
+                cur = conn.cursor()
+                cur.execute(
+                    "UPDATE downloads SET gid = ?, status = 'pending', error_message = NULL, retry_count = retry_count + 1, updated_at = ? WHERE id = ?",
+                    (new_gid, now_iso, download_id)
+                )
+                conn.commit()
+            return web.json_response({
+                "success": True,
+                "message": f"任务已重新开始下载，新GID: {new_gid}",
+                "new_gid": new_gid
+            })
+        
         try:
             # 尝试移除旧任务（如果还在aria2中）
             try:
@@ -1220,7 +1311,7 @@ async def retry_download_handler(request: web.Request):
                     logger.debug(f"移除旧任务失败（可能已不存在）: {remove_err}")
             
             # 重新提交到aria2
-            result = await client.add_uri(uris=[source_url])
+            result = await client.add_uri(uris=[internal_link(source_url)])
             
             if not result or 'result' not in result:
                 return web.json_response({
@@ -1254,7 +1345,7 @@ async def retry_download_handler(request: web.Request):
                 logger.info(f"重试下载任务时Aria2任务不存在（历史遗留记录）: {gid}")
                 # 即使任务不存在，也尝试重新提交
                 try:
-                    result = await client.add_uri(uris=[source_url])
+                    result = await client.add_uri(uris=[internal_link(source_url)])
                     if result and 'result' in result:
                         new_gid = result.get('result')
                         # 更新数据库中的 gid 和状态
@@ -1296,10 +1387,14 @@ async def delete_download_handler(request: web.Request):
     try:
         gid = request.match_info["gid"]
         
-        # 先尝试从Aria2移除任务
+        # 先尝试从Aria2移除任务（进程内下载则取消下载）
         client = get_aria2_client()
         aria2_removed = False
-        if client:
+        if tg_downloader.is_native_gid(gid):
+            if await tg_downloader.cancel(gid):
+                aria2_removed = True
+                logger.info(f"已取消进程内下载任务 {gid}")
+        elif client:
             try:
                 result = await client.remove(gid)
                 if 'error' not in result:
@@ -1655,6 +1750,13 @@ async def stream_handler(request: web.Request):
         raise web.HTTPForbidden(text=e.message)
     except FIleNotFound as e:
         raise web.HTTPNotFound(text=e.message)
+    except StreamOverloaded as e:
+        raise web.HTTPServiceUnavailable(text=e.message, headers={"Retry-After": str(e.retry_after)})
+    except FloodWait as e:
+        # 所有机器人都在限流冷却中，无法解析文件：与过载一样返回 503，由客户端稍后重试
+        raise web.HTTPServiceUnavailable(
+            text="Telegram 限流中，请稍后重试", headers={"Retry-After": str(max(1, int(e.value or 0)))}
+        )
     except (AttributeError, BadStatusLine, ConnectionResetError):
         # 连接错误,尝试 SPA 回退
         pass
@@ -1675,62 +1777,236 @@ async def stream_handler(request: web.Request):
 
 class_cache = {}
 
+
+def get_byte_streamer(index: int) -> "utils.ByteStreamer":
+    """获取（或创建并缓存）指定客户端的 ByteStreamer 对象"""
+    client = multi_clients[index]
+    if client in class_cache:
+        logger.debug(f"Using cached ByteStreamer object for client {index}")
+        return class_cache[client]
+    logger.debug(f"Creating new ByteStreamer object for client {index}")
+    tg_connect = utils.ByteStreamer(client)
+    class_cache[client] = tg_connect
+    return tg_connect
+
+
+async def get_stripe_lanes(message_id: int, index: int, file_id) -> list:
+    """
+    构建条带化传输的 lanes：主客户端在前，其余可访问频道的客户端随后
+    每个客户端使用自己获取的 FileId（各自的 file_reference 与媒体会话）；获取失败的客户端不参与条带化
+    """
+    lanes = [(index, class_cache[multi_clients[index]], file_id)]
+    if not Var.STRIPED:
+        return lanes
+    other_indices = sorted(
+        i for i in channel_accessible_clients
+        if i != index and i in multi_clients and i in work_loads and not client_scheduler.is_flooded(i)
+    )
+    if not other_indices:
+        return lanes
+
+    streamers = [get_byte_streamer(i) for i in other_indices]
+    results = await asyncio.gather(
+        *(streamer.get_file_properties(message_id) for streamer in streamers),
+        return_exceptions=True
+    )
+    for i, streamer, result in zip(other_indices, streamers, results):
+        if isinstance(result, Exception):
+            logger.warning(f"客户端 {i} 无法获取文件属性，不参与条带化传输: {result}")
+            continue
+        lanes.append((i, streamer, result))
+    return lanes
+
+
+def find_local_file(file_unique_id: str, file_size: int):
+    """查找已下载完成且仍在磁盘上、大小一致的本地文件，没有时返回 None"""
+    if not file_unique_id or not file_size:
+        return None
+    try:
+        paths = get_local_paths_by_unique_id(file_unique_id)
+    except Exception as e:
+        logger.debug(f"查询本地文件失败: {e}")
+        return None
+    for path in paths:
+        try:
+            if os.path.isfile(path) and os.path.getsize(path) == file_size:
+                return path
+        except OSError:
+            continue
+    return None
+
+
+def media_type_and_disposition(file_id) -> tuple:
+    """返回 (Content-Type, 文件名, Content-Disposition 类型)"""
+    mime_type = file_id.mime_type
+    file_name = utils.get_name(file_id)
+    if not mime_type:
+        mime_type = mimetypes.guess_type(file_name)[0] or "application/octet-stream"
+    disposition = "inline" if ("video/" in mime_type or "audio/" in mime_type or "/html" in mime_type) else "attachment"
+    return mime_type, file_name, disposition
+
+
+def stream_etag(file_id) -> str:
+    """直链的强 ETag：由文件的 unique_id 生成（同一文件内容不变，与由哪个机器人提供无关）"""
+    return f'"{file_id.unique_id}"'
+
+
+def etag_matches(header_value: str, etag: str, weak: bool = True) -> bool:
+    """If-None-Match（弱比较）/ If-Range（强比较）中是否包含该 ETag，支持 * 与逗号分隔的列表"""
+    if not header_value:
+        return False
+    for candidate in header_value.split(","):
+        candidate = candidate.strip()
+        if weak and candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == etag or (weak and candidate == "*"):
+            return True
+    return False
+
+
+def parse_range(range_header: str, file_size: int):
+    """
+    解析单个字节区间：bytes=a-b、bytes=a-、后缀区间 bytes=-N
+    返回 (from_bytes, until_bytes)，区间不可满足时 from_bytes > until_bytes；
+    格式无法识别（包括多区间）时返回 None，按完整文件响应
+    """
+    match = re.fullmatch(r"\s*bytes=(\d*)-(\d*)\s*", range_header)
+    if not match or not (match.group(1) or match.group(2)):
+        return None
+    start, end = match.groups()
+    if not start:
+        # 后缀区间：最后 N 个字节
+        suffix = int(end)
+        if suffix == 0:
+            return file_size, file_size - 1
+        return max(0, file_size - suffix), file_size - 1
+    from_bytes = int(start)
+    until_bytes = min(int(end), file_size - 1) if end else file_size - 1
+    if end and int(end) < from_bytes:
+        return None
+    return from_bytes, until_bytes
+
+
+class LocalFileResponse(web.FileResponse):
+    """FileResponse 在 prepare 时按 mtime/大小生成 ETag，这里保留传入的直链 ETag，同一文件不因来源不同而变化"""
+
+    @web.FileResponse.etag.setter
+    def etag(self, value) -> None:
+        pass
+
+
+def local_file_response(path: str, file_id) -> web.FileResponse:
+    """以与 Telegram 直链相同的响应头（包括 ETag）返回本地文件，Range 由 FileResponse 处理"""
+    mime_type, file_name, disposition = media_type_and_disposition(file_id)
+    return LocalFileResponse(
+        path,
+        headers={
+            "Content-Type": mime_type,
+            "Content-Disposition": f'{disposition}; filename="{file_name}"',
+            "Accept-Ranges": "bytes",
+            "ETag": stream_etag(file_id),
+        },
+    )
+
+
+# 检测客户端断开的间隔（秒）：aiohttp 默认不会因客户端断开取消处理函数，需要主动检查连接状态
+DISCONNECT_CHECK_INTERVAL = 0.5
+
+
+async def wait_for_disconnect(request: web.Request) -> None:
+    """等待直到客户端连接关闭"""
+    while True:
+        transport = request.transport
+        if transport is None or transport.is_closing():
+            return
+        await asyncio.sleep(DISCONNECT_CHECK_INTERVAL)
+
+
+async def send_stream_body(request: web.Request, response: web.StreamResponse, body) -> None:
+    """
+    逐块写出直链响应（write() 等待发送缓冲区排空，天然背压）
+    分块按套接字发送缓冲区大小切片写出，首尾裁剪剩下的小块合并后再写
+    客户端断开时立即关闭分块生成器：取消所有在途的 GetFile 与预读任务、释放客户端负载，
+    已获取但未发送的字节计入浪费统计
+    """
+    sent = 0
+    pending_chunk = 0  # 正在写出的分块大小（写入失败时计入浪费）
+    transport = request.transport
+    writer = WriteCoalescer(
+        response.write,
+        socket_write_size(transport.get_extra_info("socket") if transport is not None else None),
+    )
+
+    async def pump():
+        nonlocal sent, pending_chunk
+        async for chunk in body:
+            pending_chunk = len(chunk)
+            await writer.write(chunk)
+            sent += pending_chunk
+            pending_chunk = 0
+        await writer.flush()
+        await response.write_eof()
+
+    stream_stats.stream_started()
+    pump_task = asyncio.create_task(pump())
+    watch_task = asyncio.create_task(wait_for_disconnect(request))
+    disconnected = False
+    try:
+        await asyncio.wait({pump_task, watch_task}, return_when=asyncio.FIRST_COMPLETED)
+        if not pump_task.done():
+            disconnected = True
+            pump_task.cancel()
+        try:
+            await pump_task
+        except asyncio.CancelledError:
+            if not disconnected:
+                raise
+        except ConnectionError as e:
+            disconnected = True
+            logger.debug(f"客户端已断开 {request.remote}: {e}")
+        except Exception as e:
+            # 响应头已发送，无法再返回错误页面，只能中止本次传输
+            disconnected = True
+            logger.error(f"直链传输中止 {request.remote}: {e}", exc_info=True)
+    finally:
+        watch_task.cancel()
+        if not pump_task.done():
+            disconnected = True
+            pump_task.cancel()
+            await asyncio.gather(pump_task, return_exceptions=True)
+        # 生成器的 finally 负责取消预读任务并释放客户端租约
+        await body.aclose()
+        if disconnected and (pending_chunk or writer.buffered):
+            stream_stats.record_wasted(pending_chunk + writer.buffered)
+            sent -= writer.buffered
+        stream_stats.stream_finished(sent, disconnected)
+        if disconnected:
+            logger.debug(f"客户端 {request.remote} 提前断开，已发送 {sent} 字节")
+
+
 async def media_streamer(request: web.Request, message_id: int, secure_hash: str):
     range_header = request.headers.get("Range", 0)
     
-    # 负载均衡：选择负载最小的客户端
+    # 负载均衡：由调度器按延迟、在途字节、错误率与 FloodWait 冷却选择客户端
     # 优先选择能访问频道的客户端，如果都不可用则使用所有客户端
-    
-    # 检查是否有可用的客户端
     if not work_loads:
         logger.error("没有可用的客户端")
         raise web.HTTPInternalServerError(text="No available clients")
-    
-    # 优先选择能访问频道的客户端
-    if channel_accessible_clients:
-        # 筛选出能访问频道且存在的客户端及其负载
-        available_work_loads = {
-            k: v for k, v in work_loads.items() 
-            if k in channel_accessible_clients and k in multi_clients
-        }
-        if available_work_loads:
-            index = min(available_work_loads, key=available_work_loads.get)
-            logger.debug(f"从可访问频道的客户端中选择: 客户端 {index} (负载: {available_work_loads[index]})")
-        else:
-            # 如果没有可访问频道的客户端，回退到所有客户端
-            logger.warning("没有能访问频道的客户端，回退到所有客户端")
-            # 确保只选择存在的客户端
-            valid_work_loads = {k: v for k, v in work_loads.items() if k in multi_clients}
-            if not valid_work_loads:
-                logger.error("没有有效的客户端")
-                raise web.HTTPInternalServerError(text="No valid clients available")
-            index = min(valid_work_loads, key=valid_work_loads.get)
-    else:
-        # 如果没有记录可访问的客户端，使用所有客户端
-        # 确保只选择存在的客户端
-        valid_work_loads = {k: v for k, v in work_loads.items() if k in multi_clients}
-        if not valid_work_loads:
-            logger.error("没有有效的客户端")
-            raise web.HTTPInternalServerError(text="No valid clients available")
-        index = min(valid_work_loads, key=valid_work_loads.get)
+
+    index = client_scheduler.pick()
+    if index is None:
+        logger.error("没有有效的客户端")
+        raise web.HTTPInternalServerError(text="No valid clients available")
     
     # 验证索引有效性
     if index not in multi_clients:
         logger.error(f"选择的客户端索引 {index} 不存在于 multi_clients 中")
         raise web.HTTPInternalServerError(text=f"Client {index} not found")
     
-    faster_client = multi_clients[index]
-    
     if Var.MULTI_CLIENT:
         logger.info(f"Client {index} is now serving {request.remote}")
 
-    if faster_client in class_cache:
-        tg_connect = class_cache[faster_client]
-        logger.debug(f"Using cached ByteStreamer object for client {index}")
-    else:
-        logger.debug(f"Creating new ByteStreamer object for client {index}")
-        tg_connect = utils.ByteStreamer(faster_client)
-        class_cache[faster_client] = tg_connect
+    tg_connect = get_byte_streamer(index)
     logger.debug("before calling get_file_properties")
     file_id = await tg_connect.get_file_properties(message_id)
     logger.debug("after calling get_file_properties")
@@ -1739,16 +2015,25 @@ async def media_streamer(request: web.Request, message_id: int, secure_hash: str
     if utils.get_hash(file_id.unique_id, Var.HASH_LENGTH) != secure_hash:
         logger.debug(f"Invalid hash for message with ID {message_id}")
         raise InvalidHash
-    
-    file_size = file_id.file_size
 
-    if range_header:
-        from_bytes, until_bytes = range_header.replace("bytes=", "").split("-")
-        from_bytes = int(from_bytes)
-        until_bytes = int(until_bytes) if until_bytes else file_size - 1
+    # 条件请求与 HEAD 只返回元数据（FileId 来自共享缓存），不创建分块生成器，也不产生 MTProto 流量
+    file_size = file_id.file_size
+    etag = stream_etag(file_id)
+    mime_type, file_name, disposition = media_type_and_disposition(file_id)
+    if etag_matches(request.headers.get("If-None-Match"), etag):
+        return web.Response(status=304, headers={"ETag": etag, "Accept-Ranges": "bytes"})
+
+    if_range = request.headers.get("If-Range")
+    if range_header and if_range and not etag_matches(if_range, etag, weak=False):
+        # If-Range 与当前文件不符：忽略 Range，返回完整文件
+        range_header = None
+
+    byte_range = parse_range(range_header, file_size) if range_header else None
+    if byte_range is None:
+        range_header = None
+        from_bytes, until_bytes = 0, file_size - 1
     else:
-        from_bytes = request.http_range.start or 0
-        until_bytes = (request.http_range.stop or file_size) - 1
+        from_bytes, until_bytes = byte_range
 
     if (until_bytes > file_size) or (from_bytes < 0) or (until_bytes < from_bytes):
         return web.Response(
@@ -1757,37 +2042,71 @@ async def media_streamer(request: web.Request, message_id: int, secure_hash: str
             headers={"Content-Range": f"bytes */{file_size}"},
         )
 
-    chunk_size = 1024 * 1024
-    until_bytes = min(until_bytes, file_size - 1)
+    req_length = until_bytes - from_bytes + 1
+    headers = {
+        "Content-Type": f"{mime_type}",
+        "Content-Range": f"bytes {from_bytes}-{until_bytes}/{file_size}",
+        "Content-Length": str(req_length),
+        "Content-Disposition": f'{disposition}; filename="{file_name}"',
+        "Accept-Ranges": "bytes",
+        "ETag": etag,
+    }
+    if request.method == "HEAD":
+        return web.Response(status=206 if range_header else 200, headers=headers)
+
+    # 本地已有完整的下载文件时直接由磁盘提供（sendfile 零拷贝，不产生 MTProto 流量）
+    local_path = find_local_file(file_id.unique_id, file_id.file_size)
+    if local_path:
+        logger.debug(f"消息 {message_id} 使用本地文件提供: {local_path}")
+        response = local_file_response(local_path, file_id)
+        # 条件请求已按直链 ETag 处理过，不再交给 FileResponse 按它自己的 ETag 比较；
+        # Range 已被忽略（If-Range 不匹配或格式无法识别）时本地文件也按完整文件返回
+        dropped = ("if-range", "if-none-match", "if-match") + (() if range_header else ("range",))
+        await response.prepare(request.clone(headers={
+            k: v for k, v in request.headers.items() if k.lower() not in dropped
+        }))
+        return response
+
+    # 文件所在 DC 已知后，按该 DC 的延迟与错误率重新选择客户端（FileId 来自共享缓存，不会再次解析）
+    dc_index = client_scheduler.pick(dc_id=file_id.dc_id)
+    if dc_index is not None and dc_index != index:
+        logger.debug(f"按 DC {file_id.dc_id} 重新选择客户端: {index} -> {dc_index}")
+        index = dc_index
+        tg_connect = get_byte_streamer(index)
+        file_id = await tg_connect.get_file_properties(message_id)
 
+    chunk_size = 1024 * 1024
     offset = from_bytes - (from_bytes % chunk_size)
     first_part_cut = from_bytes - offset
     last_part_cut = until_bytes % chunk_size + 1
+    part_count = until_bytes // chunk_size - offset // chunk_size + 1
 
-    req_length = until_bytes - from_bytes + 1
-    part_count = math.ceil(until_bytes / chunk_size) - math.floor(offset / chunk_size)
-    body = tg_connect.yield_file(
-        file_id, index, offset, first_part_cut, last_part_cut, part_count, chunk_size
-    )
-    mime_type = file_id.mime_type
-    file_name = utils.get_name(file_id)
-    disposition = "attachment"
-
-    if not mime_type:
-        mime_type = mimetypes.guess_type(file_name)[0] or "application/octet-stream"
+    # 准入控制：超过直链数量上限时排队，排队失败抛出 StreamOverloaded（503）；带内部令牌的 aria2 请求直接准入（bulk 类别）
+    ticket = await admission.admit(client_address(request), is_internal_request(request))
+    try:
+        if part_count > 1 and len(channel_accessible_clients) > 1:
+            # 多机器人条带化：分块轮流分配给所有可访问频道的机器人并行获取
+            lanes = await get_stripe_lanes(message_id, index, file_id)
+            body = utils.ByteStreamer.yield_file_striped(
+                lanes, offset, first_part_cut, last_part_cut, part_count, chunk_size, ticket.qos
+            )
+        else:
+            body = tg_connect.yield_file(
+                file_id, index, offset, first_part_cut, last_part_cut, part_count, chunk_size, ticket.qos
+            )
 
-    if "video/" in mime_type or "audio/" in mime_type or "/html" in mime_type:
-        disposition = "inline"
+        # MP4/MKV：观看时从头打开在后台预取文件头与索引（moov/Cues），跳到末尾读索引的请求用于记住索引位置
+        seek_prefetcher.observe(file_id, file_name, from_bytes, ticket.qos)
+        seek_prefetcher.maybe_prefetch(tg_connect, index, file_id, file_name, from_bytes, ticket.qos)
 
-    return web.Response(
-        status=206 if range_header else 200,
-        body=body,
-        headers={
-            "Content-Type": f"{mime_type}",
-            "Content-Range": f"bytes {from_bytes}-{until_bytes}/{file_size}",
-            "Content-Length": str(req_length),
-            "Content-Disposition": f'{disposition}; filename="{file_name}"',
-            "Accept-Ranges": "bytes",
-        },
-    )
+        response = web.StreamResponse(status=206 if range_header else 200, headers=headers)
+        try:
+            await response.prepare(request)
+        except ConnectionError:
+            await body.aclose()
+            return response
+        await send_stream_body(request, response, body)
+        return response
+    finally:
+        ticket.release()
 
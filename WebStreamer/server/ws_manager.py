@@ -21,6 +21,7 @@ class WebSocketManager:
         self._seq_lock = Lock()
         self._sequence_numbers: Dict[str, int] = {
             'download_update': 0,
+            'download_progress_batch': 0,
             'upload_update': 0,
             'cleanup_update': 0,
             'statistics_update': 0
@@ -77,6 +78,14 @@ class WebSocketManager:
             "data": download_data
         })
     
+    async def send_download_progress_batch(self, items: list):
+        """发送多个下载任务的进度更新（聚合进度轮询的一轮结果，只包含有变化的任务）"""
+        await self.broadcast({
+            "type": "download_progress_batch",
+            "seq": self._get_next_seq("download_progress_batch"),
+            "data": {"items": items}
+        })
+    
     async def send_upload_update(self, upload_data: Dict[str, Any]):
         """发送上传状态更新"""
         await self.broadcast({
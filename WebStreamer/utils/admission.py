@@ -0,0 +1,331 @@
+"""
+直链准入控制与过载保护
+
+突发的大量直链请求会让所有传输一起变慢。这里限制同时进行的外部直链数量（全局上限与单个 IP 上限），
+超出上限的请求在一个较短的队列中等待空位，队列已满或等待超时时返回 503 并带上 Retry-After。
+同时为每个机器人设置同时在途的 GetFile 分块预算，预算用完后新的分块请求排队等待。
+
+交给 aria2 的直链附带由 BOT_TOKEN 派生的内部令牌（internal 参数），带有正确令牌的请求视为内部流量，
+不受直链数量上限限制；不按来源地址判断，同机反向代理转发的观看请求同样是回环地址。
+客户端 IP 默认取连接的对端地址，只有来自 STREAM_TRUSTED_PROXIES 的请求才采用 X-Forwarded-For。
+
+分块请求分为三个 QoS 类别：interactive（浏览器、播放器）、bulk（aria2 回环、进程内下载器）、
+background（索引预取等后台任务）。预算用完时各机器人按类别权重做加权公平排队（按开始时间的公平排队，
+每个分块按 1/权重 推进该类别的虚拟时间），大文件批量下载无法把观看者拖动进度条的延迟拉长到数秒，
+同时每个类别都按权重获得份额，不会被饿死。
+"""
+import asyncio
+import hashlib
+import hmac
+import ipaddress
+import logging
+from collections import deque
+from typing import Deque, Dict, Optional
+
+from WebStreamer import Var
+from WebStreamer.server.exceptions import StreamOverloaded
+
+logger = logging.getLogger("streamer")
+
+QOS_INTERACTIVE = "interactive"
+QOS_BULK = "bulk"
+QOS_BACKGROUND = "background"
+# 各 QoS 类别的权重（预算紧张时按权重比例分配分块名额）
+QOS_WEIGHTS = {QOS_INTERACTIVE: 8, QOS_BULK: 2, QOS_BACKGROUND: 1}
+
+
+# 内部流量令牌的查询参数名
+INTERNAL_PARAM = "internal"
+
+
+def _internal_token() -> str:
+    """由 BOT_TOKEN 派生的内部流量令牌（重启后不变，aria2 会话中保存的任务仍然有效）"""
+    return hmac.new((Var.BOT_TOKEN or "").encode(), b"internal-stream-link", hashlib.sha256).hexdigest()[:32]
+
+
+def internal_link(url: str) -> str:
+    """给交给 aria2 的直链附带内部流量令牌"""
+    separator = "&" if "?" in url else "?"
+    return f"{url}{separator}{INTERNAL_PARAM}={_internal_token()}"
+
+
+def is_internal_request(request) -> bool:
+    """请求是否带有正确的内部流量令牌"""
+    token = request.query.get(INTERNAL_PARAM)
+    return bool(token) and hmac.compare_digest(token, _internal_token())
+
+
+def _parse_networks(proxies) -> list:
+    networks = []
+    for proxy in proxies:
+        try:
+            networks.append(ipaddress.ip_network(proxy, strict=False))
+        except ValueError:
+            logger.warning(f"忽略无效的可信代理地址: {proxy}")
+    return networks
+
+
+_trusted_proxies = _parse_networks(Var.TRUSTED_PROXIES)
+
+
+def _is_trusted_proxy(address: str) -> bool:
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(ip in network for network in _trusted_proxies)
+
+
+def client_address(request) -> str:
+    """
+    请求的客户端 IP：对端是可信代理时取 X-Forwarded-For 中从右往左第一个不是可信代理的地址，
+    否则取对端地址（X-Forwarded-For 可被客户端任意伪造）
+    """
+    remote = request.remote or ""
+    if not _trusted_proxies or not _is_trusted_proxy(remote):
+        return remote
+    forwarded = [address.strip() for address in request.headers.get("X-Forwarded-For", "").split(",")]
+    for address in reversed(forwarded):
+        if address and not _is_trusted_proxy(address):
+            return address
+    return remote
+
+
+class StreamTicket:
+    """一次已准入的直链传输，传输结束时释放"""
+
+    def __init__(self, controller: "AdmissionController", remote: str, internal: bool):
+        self._controller = controller
+        self.remote = remote
+        self.internal = internal
+        self.released = False
+
+    @property
+    def qos(self) -> str:
+        """带内部令牌的 aria2 请求属于 bulk，其余直链请求属于 interactive"""
+        return QOS_BULK if self.internal else QOS_INTERACTIVE
+
+    def release(self) -> None:
+        if not self.released:
+            self.released = True
+            self._controller._release(self)
+
+
+class _BotBudget:
+    """单个机器人的在途分块预算与各 QoS 类别的等待队列（按开始时间的加权公平排队）"""
+
+    def __init__(self):
+        self.inflight = 0
+        self.waiters: Dict[str, Deque[asyncio.Future]] = {qos: deque() for qos in QOS_WEIGHTS}
+        self.finish: Dict[str, float] = {qos: 0.0 for qos in QOS_WEIGHTS}  # 各类别的虚拟完成时间
+        self.vclock = 0.0  # 虚拟时钟：最近一次分配的开始时间
+        self.granted: Dict[str, int] = {qos: 0 for qos in QOS_WEIGHTS}
+
+    def _start_tag(self, qos: str) -> float:
+        return max(self.vclock, self.finish[qos])
+
+    def charge(self, qos: str) -> None:
+        """记录一次分配：推进该类别的虚拟完成时间与虚拟时钟"""
+        start = self._start_tag(qos)
+        self.finish[qos] = start + 1.0 / QOS_WEIGHTS[qos]
+        self.vclock = start
+        self.granted[qos] += 1
+
+    def has_waiters(self) -> bool:
+        return any(self.waiters.values())
+
+    def pop_next(self) -> Optional[asyncio.Future]:
+        """取出开始时间最小的类别中排在最前的等待者"""
+        while True:
+            candidates = [qos for qos, waiters in self.waiters.items() if waiters]
+            if not candidates:
+                return None
+            qos = min(candidates, key=lambda q: (self._start_tag(q), -QOS_WEIGHTS[q]))
+            future = self.waiters[qos].popleft()
+            if not future.done():
+                self.charge(qos)
+                return future
+
+
+class AdmissionController:
+    """直链数量准入（全局 / 单 IP）与每个机器人的在途分块预算"""
+
+    def __init__(
+        self,
+        max_streams: int,
+        max_streams_per_ip: int,
+        queue_size: int,
+        queue_timeout: float,
+        bot_chunk_budget: int,
+    ):
+        self.max_streams = max_streams
+        self.max_streams_per_ip = max_streams_per_ip
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.bot_chunk_budget = bot_chunk_budget
+        self.active = 0
+        self.active_internal = 0
+        self._per_ip: Dict[str, int] = {}
+        self._queue: Deque[tuple] = deque()
+        self._budgets: Dict[int, _BotBudget] = {}
+        self.admitted = 0
+        self.queued = 0
+        self.rejected = 0
+        self.budget_waits = 0
+
+    @property
+    def retry_after(self) -> int:
+        return max(1, int(self.queue_timeout))
+
+    # ---- 直链准入 ----
+
+    def _has_room(self, remote: str) -> bool:
+        if self.max_streams and self.active >= self.max_streams:
+            return False
+        if self.max_streams_per_ip and self._per_ip.get(remote, 0) >= self.max_streams_per_ip:
+            return False
+        return True
+
+    def _grant(self, remote: str, internal: bool) -> StreamTicket:
+        if internal:
+            self.active_internal += 1
+        else:
+            self.active += 1
+            self._per_ip[remote] = self._per_ip.get(remote, 0) + 1
+        self.admitted += 1
+        return StreamTicket(self, remote, internal)
+
+    async def admit(self, remote: Optional[str], internal: bool = False) -> StreamTicket:
+        """
+        申请一次直链传输：内部请求（带内部令牌）直接准入；外部请求有空位时直接准入，否则排队等待，
+        队列已满或等待超时时抛出 StreamOverloaded
+        """
+        remote = remote or ""
+        if internal:
+            return self._grant(remote, True)
+        if not self._queue and self._has_room(remote):
+            return self._grant(remote, False)
+        if len(self._queue) >= self.queue_size:
+            self.rejected += 1
+            raise StreamOverloaded(self.retry_after)
+
+        future = asyncio.get_event_loop().create_future()
+        entry = (remote, future)
+        self._queue.append(entry)
+        self.queued += 1
+        # 队列中排在前面的请求可能是因为所在 IP 已满而等待，此时本请求可以直接拿到空位
+        self._wake_queue()
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), self.queue_timeout)
+        except asyncio.TimeoutError:
+            if future.done() and not future.cancelled():
+                return future.result()
+            self.rejected += 1
+            raise StreamOverloaded(self.retry_after)
+        except asyncio.CancelledError:
+            # 已分配到名额但等待方已断开时归还名额
+            if future.done() and not future.cancelled():
+                future.result().release()
+            raise
+        finally:
+            if not future.done():
+                future.cancel()
+            if entry in self._queue:
+                self._queue.remove(entry)
+
+    def _release(self, ticket: StreamTicket) -> None:
+        if ticket.internal:
+            self.active_internal -= 1
+            return
+        self.active -= 1
+        count = self._per_ip.get(ticket.remote, 0) - 1
+        if count > 0:
+            self._per_ip[ticket.remote] = count
+        else:
+            self._per_ip.pop(ticket.remote, None)
+        self._wake_queue()
+
+    def _wake_queue(self) -> None:
+        """按排队顺序把空出来的名额分配给等待者（跳过所在 IP 仍已满的请求）"""
+        for entry in list(self._queue):
+            remote, future = entry
+            if future.done():
+                self._queue.remove(entry)
+                continue
+            if self.max_streams and self.active >= self.max_streams:
+                return
+            if self._has_room(remote):
+                self._queue.remove(entry)
+                future.set_result(self._grant(remote, False))
+
+    # ---- 每个机器人的在途分块预算 ----
+
+    async def acquire_chunk(self, index: int, qos: str = QOS_INTERACTIVE) -> bool:
+        """按 QoS 类别占用机器人 index 的一个在途分块名额；未启用预算时返回 False（无需释放）"""
+        if not self.bot_chunk_budget:
+            return False
+        qos = qos if qos in QOS_WEIGHTS else QOS_INTERACTIVE
+        budget = self._budgets.setdefault(index, _BotBudget())
+        if budget.inflight < self.bot_chunk_budget and not budget.has_waiters():
+            budget.inflight += 1
+            budget.charge(qos)
+            return True
+
+        future = asyncio.get_event_loop().create_future()
+        budget.waiters[qos].append(future)
+        self.budget_waits += 1
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # 名额已交给本请求，但请求已被取消：转交给下一个等待者
+                self.release_chunk(index)
+            else:
+                try:
+                    budget.waiters[qos].remove(future)
+                except ValueError:
+                    pass
+            raise
+        return True
+
+    def release_chunk(self, index: int) -> None:
+        budget = self._budgets.get(index)
+        if budget is None:
+            return
+        future = budget.pop_next()
+        if future is not None:
+            # 名额直接移交给等待者，inflight 不变
+            future.set_result(None)
+            return
+        budget.inflight -= 1
+
+    def stats(self) -> dict:
+        """准入统计信息（用于 /api/status）"""
+        return {
+            "active_streams": self.active,
+            "active_internal_streams": self.active_internal,
+            "max_streams": self.max_streams,
+            "max_streams_per_ip": self.max_streams_per_ip,
+            "queued_now": len(self._queue),
+            "admitted": self.admitted,
+            "queued": self.queued,
+            "rejected": self.rejected,
+            "bot_chunk_budget": self.bot_chunk_budget,
+            "bot_inflight_chunks": {str(i): b.inflight for i, b in self._budgets.items()},
+            "qos_granted": {
+                qos: sum(b.granted[qos] for b in self._budgets.values()) for qos in QOS_WEIGHTS
+            },
+            "qos_waiting": {
+                qos: sum(len(b.waiters[qos]) for b in self._budgets.values()) for qos in QOS_WEIGHTS
+            },
+            "budget_waits": self.budget_waits,
+        }
+
+
+admission = AdmissionController(
+    Var.MAX_STREAMS,
+    Var.MAX_STREAMS_PER_IP,
+    Var.STREAM_QUEUE_SIZE,
+    Var.STREAM_QUEUE_TIMEOUT,
+    Var.BOT_CHUNK_BUDGET,
+)
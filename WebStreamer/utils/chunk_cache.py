@@ -0,0 +1,145 @@
+"""
+分块单飞（single-flight）与最近分块缓存
+
+aria2 以 split 方式拉取直链、播放器重复请求重叠区间时，多个 media_streamer 会对同一文件发起
+完全相同的 GetFile(location, offset, limit) 请求。本模块在进程内按 (media_id, offset, limit)
+合并并发请求：同一个分块只向 Telegram 请求一次，其余请求方等待同一个 future；
+同时保留一个按字节数限制大小的 LRU，缓存最近输出的分块。
+
+合并后的请求（SharedFetch）不属于任何一个流：它自己占用调度器租约与机器人分块预算，
+按当前等待者中最高的 QoS 类别排队，第一个请求方断开或结束后其余等待者不受影响。
+"""
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from WebStreamer import Var
+from .admission import QOS_BACKGROUND, QOS_WEIGHTS
+
+logger = logging.getLogger("streamer")
+
+ChunkKey = Tuple[int, int, int]
+
+
+class SharedFetch:
+    """
+    一次合并后的分块获取，记录所有等待中的流
+    等待者需要提供 qos 属性与 record_latency(latency)、record_failure()、follow(from_index, to_index) 方法，
+    分块获取把延迟、失败与客户端切换反馈给当时仍在等待的每个流
+    """
+
+    def __init__(self):
+        self.task: Optional[asyncio.Task] = None
+        self.waiters: List = []
+
+    @property
+    def qos(self) -> str:
+        """等待者中权重最高的 QoS 类别"""
+        if not self.waiters:
+            return QOS_BACKGROUND
+        return max((waiter.qos for waiter in self.waiters), key=lambda qos: QOS_WEIGHTS.get(qos, 0))
+
+    def record_latency(self, latency: float) -> None:
+        for waiter in list(self.waiters):
+            waiter.record_latency(latency)
+
+    def record_failure(self) -> None:
+        for waiter in list(self.waiters):
+            waiter.record_failure()
+
+    def switched(self, from_index: int, to_index: int) -> None:
+        """分块改由其他客户端获取成功：仍在使用原客户端的流后续也从新客户端开始"""
+        for waiter in list(self.waiters):
+            waiter.follow(from_index, to_index)
+
+
+class ChunkCache:
+    """按 (media_id, offset, limit) 合并在途请求，并缓存最近的分块（LRU，按字节数限制）"""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self._chunks: "OrderedDict[ChunkKey, bytes]" = OrderedDict()
+        # 在途请求：key -> 合并后的分块获取
+        self._inflight: Dict[ChunkKey, SharedFetch] = {}
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0  # 通过单飞合并、未重复请求的次数
+
+    async def get_or_fetch(
+        self, key: ChunkKey, fetcher: Callable[[SharedFetch], Awaitable[Optional[bytes]]], waiter
+    ) -> Optional[bytes]:
+        """
+        获取分块：优先命中缓存，其次加入同 key 的在途请求，否则发起新的请求
+        fetcher 只接收合并后的 SharedFetch，不能引用某一个流的租约或状态；waiter 为等待该分块的流
+        所有等待者都取消时（例如客户端全部断开），在途请求也会被取消
+        获取失败（返回空）的结果不会被缓存
+        """
+        chunk = self._chunks.get(key)
+        if chunk is not None:
+            self._chunks.move_to_end(key)
+            self.hits += 1
+            return chunk
+
+        shared = self._inflight.get(key)
+        if shared is None:
+            self.misses += 1
+            shared = SharedFetch()
+            shared.waiters.append(waiter)
+            shared.task = asyncio.create_task(fetcher(shared))
+            self._inflight[key] = shared
+            shared.task.add_done_callback(lambda t, k=key: self._on_fetched(k, t))
+        else:
+            self.shared += 1
+            shared.waiters.append(waiter)
+
+        task = shared.task
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if not task.done() and len(shared.waiters) <= 1:
+                task.cancel()
+            raise
+        finally:
+            shared.waiters.remove(waiter)
+
+    def _on_fetched(self, key: ChunkKey, task: asyncio.Task) -> None:
+        shared = self._inflight.get(key)
+        if shared is not None and shared.task is task:
+            self._inflight.pop(key, None)
+        if task.cancelled() or task.exception() is not None:
+            return
+        chunk = task.result()
+        if chunk:
+            self._store(key, chunk)
+
+    def _store(self, key: ChunkKey, chunk: bytes) -> None:
+        size = len(chunk)
+        if size > self.max_bytes:
+            return
+        old = self._chunks.pop(key, None)
+        if old is not None:
+            self.current_bytes -= len(old)
+        self._chunks[key] = chunk
+        self.current_bytes += size
+        while self.current_bytes > self.max_bytes and self._chunks:
+            _, evicted = self._chunks.popitem(last=False)
+            self.current_bytes -= len(evicted)
+
+    def stats(self) -> dict:
+        """缓存统计信息（用于 /api/status）"""
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "shared_inflight": self.shared,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            "cached_chunks": len(self._chunks),
+            "cached_bytes": self.current_bytes,
+            "max_bytes": self.max_bytes,
+            "inflight": len(self._inflight),
+        }
+
+
+chunk_cache = ChunkCache(Var.CHUNK_CACHE_MB * 1024 * 1024)
@@ -1,59 +1,103 @@
-import math
 import asyncio
 import logging
 from WebStreamer import Var
-from typing import Dict, Union, Optional
-from WebStreamer.bot import work_loads, multi_clients, channel_accessible_clients
+from typing import Dict, List, Tuple, Union, Optional
+from WebStreamer.bot import work_loads, multi_clients
 from pyrogram import Client, utils, raw
-from .file_properties import get_file_ids
-from pyrogram.session import Session, Auth
-from pyrogram.errors import AuthBytesInvalid
-from WebStreamer.server.exceptions import FIleNotFound
+from .chunk_cache import SharedFetch, chunk_cache
+from .disk_cache import disk_cache
+from .stream_stats import stream_stats
+from .file_id_cache import file_id_cache
+from .session_pool import media_session_pool
+from .scheduler import client_scheduler
+from .admission import admission, QOS_INTERACTIVE
+from pyrogram.session import Session
+from pyrogram.errors import AuthBytesInvalid, FileReferenceExpired, FloodWait
 from pyrogram.file_id import FileId, FileType, ThumbnailSource
 
 logger = logging.getLogger("streamer")
 
-# 用于同步授权导出的锁字典（按DC ID）
-export_auth_locks: Dict[int, asyncio.Lock] = {}
-
 def get_next_available_client(current_index: int, exclude_indices: Optional[set] = None) -> Optional[int]:
     """
     获取下一个可用的客户端索引
-    优先选择能访问频道的客户端，排除当前客户端和已失败的客户端
+    由调度器按延迟、在途字节、错误率与 FloodWait 冷却选择，优先能访问频道的客户端，排除当前客户端和已失败的客户端
     """
     if exclude_indices is None:
         exclude_indices = set()
     exclude_indices.add(current_index)
-    
-    # 优先选择能访问频道的客户端
-    if channel_accessible_clients:
-        available_loads = {
-            k: v for k, v in work_loads.items()
-            if k in channel_accessible_clients 
-            and k in multi_clients
-            and k not in exclude_indices
-        }
-        if available_loads:
-            return min(available_loads, key=available_loads.get)
-    
-    # 回退到所有可用客户端
-    valid_loads = {
-        k: v for k, v in work_loads.items()
-        if k in multi_clients
-        and k not in exclude_indices
-    }
-    if valid_loads:
-        return min(valid_loads, key=valid_loads.get)
-    
-    return None
+    return client_scheduler.pick(exclude=exclude_indices)
+
+class ReadAheadWindow:
+    """
+    自适应预读窗口
+    记录每个分块的 GetFile 延迟（EWMA），延迟接近基线时逐步扩大窗口，
+    延迟明显升高（链路或服务端已饱和）或出现失败时减半收缩（AIMD）
+    """
+
+    def __init__(self, min_size: int, max_size: int):
+        self.min_size = max(1, min_size)
+        self.max_size = max(self.min_size, max_size)
+        self.size = self.min_size
+        self.ewma: Optional[float] = None  # 平滑后的分块延迟
+        self.baseline: Optional[float] = None  # 观测到的最低延迟（缓慢回升，适应网络变化）
+
+    def record_latency(self, latency: float) -> None:
+        self.ewma = latency if self.ewma is None else 0.7 * self.ewma + 0.3 * latency
+        if self.baseline is None or latency < self.baseline:
+            self.baseline = latency
+        else:
+            self.baseline = 0.98 * self.baseline + 0.02 * latency
+
+        if self.ewma <= self.baseline * 1.5:
+            self.size = min(self.max_size, self.size + 1)
+        elif self.ewma >= self.baseline * 3:
+            self.size = max(self.min_size, self.size // 2)
+
+    def record_failure(self) -> None:
+        self.size = max(self.min_size, self.size // 2)
+
+
+class _StreamState:
+    """单次流传输在一个 lane 上的状态（首选客户端、调度器租约、预读窗口），作为分块获取的等待者
+    分块获取（见 ByteStreamer._fetch_part）可能被多个流共享，只通过这里的方法反馈延迟、失败与客户端切换
+    qos: 分块请求的 QoS 类别（interactive / bulk / background），决定等待机器人分块预算时的权重
+    """
+
+    def __init__(self, index: int, client: Client, qos: str = QOS_INTERACTIVE,
+                 window: Optional["ReadAheadWindow"] = None):
+        self.current_index = index
+        self.client = client
+        self.qos = qos
+        self.window = window
+        self.lease = client_scheduler.acquire(index)
+
+    def record_latency(self, latency: float) -> None:
+        if self.window is not None:
+            self.window.record_latency(latency)
+
+    def record_failure(self) -> None:
+        if self.window is not None:
+            self.window.record_failure()
+
+    def follow(self, from_index: int, to_index: int) -> None:
+        """分块改由 to_index 获取成功：仍在使用 from_index 的流后续分块也从新客户端开始，并转移调度器租约"""
+        if self.current_index != from_index or self.lease.released:
+            return
+        self.lease.release()
+        self.current_index = to_index
+        self.client = multi_clients[to_index]
+        self.lease = client_scheduler.acquire(to_index)
+
+    def release(self) -> None:
+        self.lease.release()
+
 
 class ByteStreamer:
     def __init__(self, client: Client):
         """A custom class that holds the cache of a specific client and class functions.
         attributes:
             client: the client that the cache is for.
-            cached_file_ids: a dict of cached file IDs.
-            cached_file_properties: a dict of cached file properties.
+            （FileId 缓存由所有客户端共享，见 file_id_cache）
         
         functions:
             generate_file_properties: returns the properties for a media of a specific message contained in Tuple.
@@ -63,159 +107,29 @@ class ByteStreamer:
         This is a modified version of the <https://github.com/eyaadh/megadlbot_oss/blob/master/mega/telegram/utils/custom_download.py>
         Thanks to Eyaadh <https://github.com/eyaadh>
         """
-        self.clean_timer = 30 * 60
         self.client: Client = client
-        self.cached_file_ids: Dict[int, FileId] = {}
-        asyncio.create_task(self.clean_cache())
 
     async def get_file_properties(self, message_id: int) -> FileId:
         """
         Returns the properties of a media of a specific message in a FIleId class.
-        if the properties are cached, then it'll return the cached results.
-        or it'll generate the properties from the Message ID and cache them.
+        结果来自所有客户端共享的 FileId 缓存，未命中时由当前客户端解析（并发解析合并为一次）。
         """
-        if message_id not in self.cached_file_ids:
-            await self.generate_file_properties(message_id)
-            logger.debug(f"Cached file properties for message with ID {message_id}")
-        return self.cached_file_ids[message_id]
-    
+        return await file_id_cache.get(self.client, message_id)
+
     async def generate_file_properties(self, message_id: int) -> FileId:
         """
         Generates the properties of a media file on a specific message.
-        returns ths properties in a FIleId class.
+        强制使用当前客户端重新解析（例如 file_reference 过期时），并更新共享缓存。
         """
-        file_id = await get_file_ids(self.client, Var.BIN_CHANNEL, message_id)
-        logger.debug(f"Generated file ID and Unique ID for message with ID {message_id}")
-        if not file_id:
-            logger.debug(f"Message with ID {message_id} not found")
-            raise FIleNotFound
-        self.cached_file_ids[message_id] = file_id
-        logger.debug(f"Cached media message with ID {message_id}")
-        return self.cached_file_ids[message_id]
+        return await file_id_cache.refresh(self.client, message_id)
 
     async def generate_media_session(self, client: Client, file_id: FileId) -> Session:
         """
         Generates the media session for the DC that contains the media file.
         This is required for getting the bytes from Telegram servers.
+        会话由媒体会话池统一创建、预热和保活
         """
-
-        media_session = client.media_sessions.get(file_id.dc_id, None)
-
-        # 检查缓存的会话是否仍然有效
-        if media_session is not None:
-            try:
-                # 检查会话的连接状态和加密参数
-                if (hasattr(media_session, 'connection') and media_session.connection and
-                    hasattr(media_session.connection, 'protocol') and media_session.connection.protocol and
-                    hasattr(media_session.connection.protocol, 'encrypt') and 
-                    media_session.connection.protocol.encrypt is not None):
-                    logger.debug(f"Using cached media session for DC {file_id.dc_id}")
-                    return media_session
-                # 如果会话无效，清除它
-                logger.debug(f"Cached media session for DC {file_id.dc_id} is invalid, recreating...")
-                try:
-                    await media_session.stop()
-                except:
-                    pass
-                if file_id.dc_id in client.media_sessions:
-                    del client.media_sessions[file_id.dc_id]
-                media_session = None
-            except Exception as e:
-                logger.warning(f"Error checking cached media session: {e}")
-                try:
-                    await media_session.stop()
-                except:
-                    pass
-                if file_id.dc_id in client.media_sessions:
-                    del client.media_sessions[file_id.dc_id]
-                media_session = None
-
-        if media_session is None:
-            if file_id.dc_id != await client.storage.dc_id():
-                # 获取或创建该DC的锁，防止并发导出授权
-                if file_id.dc_id not in export_auth_locks:
-                    export_auth_locks[file_id.dc_id] = asyncio.Lock()
-                
-                lock = export_auth_locks[file_id.dc_id]
-                
-                # 使用锁来防止并发导出授权
-                async with lock:
-                    # 再次检查是否在等待期间已经创建了会话
-                    if file_id.dc_id in client.media_sessions:
-                        cached_session = client.media_sessions[file_id.dc_id]
-                        try:
-                            if (hasattr(cached_session, 'connection') and cached_session.connection and
-                                hasattr(cached_session.connection, 'protocol') and cached_session.connection.protocol and
-                                hasattr(cached_session.connection.protocol, 'encrypt') and 
-                                cached_session.connection.protocol.encrypt is not None):
-                                logger.debug(f"Using newly created media session for DC {file_id.dc_id}")
-                                return cached_session
-                        except:
-                            pass
-                    
-                    media_session = Session(
-                        client,
-                        file_id.dc_id,
-                        await Auth(
-                            client, file_id.dc_id, await client.storage.test_mode()
-                        ).create(),
-                        await client.storage.test_mode(),
-                        is_media=True,
-                    )
-                    await media_session.start()
-
-                    # 尝试导入授权，最多重试6次
-                    auth_imported = False
-                    for attempt in range(6):
-                        try:
-                            # 导出授权
-                            exported_auth = await client.invoke(
-                                raw.functions.auth.ExportAuthorization(dc_id=file_id.dc_id)
-                            )
-                            
-                            # 导入授权
-                            await media_session.invoke(
-                                raw.functions.auth.ImportAuthorization(
-                                    id=exported_auth.id, bytes=exported_auth.bytes
-                                )
-                            )
-                            auth_imported = True
-                            logger.debug(f"Successfully imported authorization for DC {file_id.dc_id} (attempt {attempt + 1})")
-                            break
-                        except AuthBytesInvalid as e:
-                            logger.warning(
-                                f"Invalid authorization bytes for DC {file_id.dc_id} (attempt {attempt + 1}/6): {e}"
-                            )
-                            if attempt < 5:
-                                # 等待一小段时间后重试，避免立即重试
-                                await asyncio.sleep(0.5 * (attempt + 1))
-                            continue
-                        except Exception as e:
-                            logger.error(f"Unexpected error during auth import for DC {file_id.dc_id}: {e}", exc_info=True)
-                            if attempt < 5:
-                                await asyncio.sleep(0.5 * (attempt + 1))
-                            continue
-                    
-                    if not auth_imported:
-                        await media_session.stop()
-                        raise AuthBytesInvalid(f"Failed to import authorization for DC {file_id.dc_id} after 6 attempts")
-                    
-                    logger.debug(f"Created media session for DC {file_id.dc_id}")
-                    client.media_sessions[file_id.dc_id] = media_session
-            else:
-                media_session = Session(
-                    client,
-                    file_id.dc_id,
-                    await client.storage.auth_key(),
-                    await client.storage.test_mode(),
-                    is_media=True,
-                )
-                await media_session.start()
-            logger.debug(f"Created media session for DC {file_id.dc_id}")
-            client.media_sessions[file_id.dc_id] = media_session
-        
-        return media_session
-
+        return await media_session_pool.get(client, file_id.dc_id)
 
     @staticmethod
     async def get_location(file_id: FileId) -> Union[raw.types.InputPhotoFileLocation,
@@ -280,14 +194,35 @@ class ByteStreamer:
                 # 生成或获取媒体会话
                 media_session = await self.generate_media_session(client, file_id)
                 
-                # 尝试获取文件块
-                r = await media_session.invoke(
-                    raw.functions.upload.GetFile(
-                        location=location, offset=offset, limit=chunk_size
-                    ),
-                )
+                # 尝试获取文件块（标记为在途请求，保活检查不会在传输中途重建该会话）
+                with media_session_pool.in_flight(client, file_id.dc_id):
+                    r = await media_session.invoke(
+                        raw.functions.upload.GetFile(
+                            location=location, offset=offset, limit=chunk_size
+                        ),
+                    )
                 return True, r, client, None
-                
+
+            except FloodWait as e:
+                # 该客户端被限流：不在此等待，交由调用方切换到其他客户端
+                logger.warning(f"获取文件块触发 FloodWait {e.value} 秒 (offset: {offset})")
+                return False, e, client, None
+
+            except FileReferenceExpired:
+                # file_reference 过期：用当前客户端重新解析消息，更新 location 后重试
+                message_id = getattr(file_id, "message_id", None)
+                if message_id is None or retry_attempt >= max_retries - 1:
+                    logger.warning(f"file_reference 已过期且无法刷新 (offset: {offset})")
+                    return False, None, client, None
+                logger.debug(f"file_reference 已过期，重新解析消息 {message_id} (offset: {offset})")
+                try:
+                    fresh = await file_id_cache.refresh(client, message_id)
+                except Exception as refresh_error:
+                    logger.warning(f"刷新 file_reference 失败 (消息 {message_id}): {refresh_error}")
+                    return False, None, client, None
+                file_id.file_reference = fresh.file_reference
+                location.file_reference = fresh.file_reference
+
             except (OSError, ConnectionError, TimeoutError, AuthBytesInvalid, TypeError, AttributeError) as e:
                 error_msg = str(e)
                 error_type = type(e).__name__
@@ -317,12 +252,7 @@ class ByteStreamer:
                         logger.debug(f"获取文件块失败，重试 (offset: {offset}, 尝试 {retry_attempt + 1}/{max_retries}): {error_type}")
                     
                     # 清除无效的会话缓存（加密错误和连接错误都需要清除）
-                    if file_id.dc_id in client.media_sessions:
-                        try:
-                            await client.media_sessions[file_id.dc_id].stop()
-                        except Exception as stop_error:
-                            logger.debug(f"停止媒体会话时出错（可能已断开）: {stop_error}")
-                        del client.media_sessions[file_id.dc_id]
+                    await media_session_pool.discard(client, file_id.dc_id)
                     
                     # 等待后重试（加密错误需要稍长的等待时间）
                     wait_time = 1.5 + retry_attempt * 0.5 if is_encryption_error else 1 + retry_attempt * 0.5
@@ -339,6 +269,82 @@ class ByteStreamer:
         
         return False, None, client, None
 
+    async def fetch_part(
+        self, state: _StreamState, file_id: FileId, location, offset: int, chunk_size: int
+    ) -> Optional[bytes]:
+        """由单个流直接获取分块，不与其他请求合并（进程内下载器）"""
+        fetch = SharedFetch()
+        fetch.waiters.append(state)
+        return await self._fetch_part(state.current_index, file_id, location, offset, chunk_size, fetch)
+
+    async def _fetch_part(
+        self,
+        index: int,
+        file_id: FileId,
+        location,
+        offset: int,
+        chunk_size: int,
+        fetch: SharedFetch,
+    ) -> Optional[bytes]:
+        """
+        从客户端 index 开始获取单个分块（供预读流水线并发调用，可能由多个流合并共享）
+        每次尝试自己占用调度器租约与机器人分块预算（按等待者中最高的 QoS 类别排队），不依赖任何一个流的状态
+        保留原有的重试与客户端切换逻辑：当前客户端失败后切换到其他可用客户端继续获取该分块
+        返回分块字节；所有客户端都失败或返回非 upload.File 时返回 None
+        """
+        loop = asyncio.get_event_loop()
+        max_client_switches = 3
+        start_index = index
+        failed_indices: set = set()
+        for switch_attempt in range(max_client_switches + 1):
+            lease = client_scheduler.acquire(index)
+            budgeted = False
+            try:
+                # 每个机器人的在途分块预算（按 QoS 类别加权公平排队）
+                budgeted = await admission.acquire_chunk(index, fetch.qos)
+                started_at = loop.time()
+                client_scheduler.begin_transfer(index, chunk_size)
+                try:
+                    success, r, _, _ = await self._try_get_file_chunk(
+                        multi_clients[index], file_id, location, offset, chunk_size,
+                        max_retries=3 if switch_attempt == 0 else 2
+                    )
+                finally:
+                    client_scheduler.end_transfer(index, chunk_size)
+            finally:
+                if budgeted:
+                    admission.release_chunk(index)
+                lease.release()
+            if success:
+                latency = loop.time() - started_at
+                fetch.record_latency(latency)
+                client_scheduler.record_success(index, file_id.dc_id, latency)
+                if index != start_index:
+                    fetch.switched(start_index, index)
+                if isinstance(r, raw.types.upload.File):
+                    return r.bytes
+                logger.warning(f"GetFile 返回了非预期类型 {type(r).__name__} (offset: {offset})")
+                return None
+
+            fetch.record_failure()
+            if isinstance(r, FloodWait):
+                client_scheduler.record_flood_wait(index, r.value)
+            else:
+                client_scheduler.record_error(index, file_id.dc_id)
+            if switch_attempt >= max_client_switches:
+                break
+
+            logger.warning(f"客户端 {index} 获取文件块失败 (offset: {offset})，尝试切换到其他客户端")
+            next_index = get_next_available_client(index, failed_indices)
+            if next_index is None:
+                logger.error(f"没有其他可用的客户端 (offset: {offset})")
+                return None
+            index = next_index
+            logger.info(f"切换到客户端 {index} 继续传输 (offset: {offset}, 尝试 {switch_attempt + 1}/{max_client_switches})")
+
+        logger.error(f"所有客户端都无法获取文件块，停止文件流传输 (offset: {offset})")
+        return None
+
     async def yield_file(
         self,
         file_id: FileId,
@@ -348,148 +354,118 @@ class ByteStreamer:
         last_part_cut: int,
         part_count: int,
         chunk_size: int,
+        qos: str = QOS_INTERACTIVE,
     ) -> Union[str, None]:
         """
         Custom generator that yields the bytes of the media file.
+        使用有界自适应预读窗口：同时保持 N 个 GetFile 请求在途，按顺序输出；
+        消费方断开（生成器关闭）时取消所有未完成的预读任务。
         支持客户端切换：当连接失败时，自动切换到其他可用客户端继续传输
         Modded from <https://github.com/eyaadh/megadlbot_oss/blob/master/mega/telegram/utils/custom_download.py#L20>
         Thanks to Eyaadh <https://github.com/eyaadh>
         """
-        client = self.client
-        current_index = index
-        failed_indices = set()  # 记录失败的客户端索引
-        
-        # 确保索引存在于 work_loads 中
-        if current_index not in work_loads:
-            logger.error(f"客户端索引 {current_index} 不存在于 work_loads 中")
+        async for chunk in self.yield_file_striped(
+            [(index, self, file_id)], offset, first_part_cut, last_part_cut, part_count, chunk_size, qos
+        ):
+            yield chunk
+
+    @staticmethod
+    async def yield_file_striped(
+        lanes: List[Tuple[int, "ByteStreamer", FileId]],
+        offset: int,
+        first_part_cut: int,
+        last_part_cut: int,
+        part_count: int,
+        chunk_size: int,
+        qos: str = QOS_INTERACTIVE,
+    ) -> Union[str, None]:
+        """
+        条带化输出文件：第 k 个分块由 lanes[k % n] 对应的机器人获取（各自使用自己的媒体会话），按顺序重组输出。
+        lanes: [(客户端索引, 该客户端的 ByteStreamer, 该客户端获取的 FileId)]，只有一个 lane 时即普通单客户端传输。
+        qos: QoS 类别（interactive 观看 / bulk 批量下载 / background 后台预取），决定分块排队的权重。
+        预读窗口随 lane 数量等比放大，保证每个机器人都有足够的在途请求。
+        某个 lane 彻底失败时，该分块依次交给其余 lane 重试。
+        """
+        lanes = [lane for lane in lanes if lane[0] in work_loads]
+        if not lanes:
+            logger.error("没有可用于传输的客户端（客户端索引不存在于 work_loads 中）")
             return
-        
-        work_loads[current_index] += 1
-        logger.debug(f"Starting to yielding file with client {current_index} (当前负载: {work_loads[current_index]}).")
-        
-        current_part = 1
-        location = await self.get_location(file_id)
 
-        # 获取初始文件块，支持客户端切换
-        success, r, client, _ = await self._try_get_file_chunk(
-            client, file_id, location, offset, chunk_size, max_retries=3
-        )
-        
-        # 如果失败，尝试切换到其他客户端
-        if not success:
-            logger.warning(f"客户端 {current_index} 获取初始文件块失败，尝试切换到其他客户端")
-            failed_indices.add(current_index)
-            
-            # 减少当前客户端负载
-            if current_index in work_loads:
-                work_loads[current_index] -= 1
-            
-            # 尝试切换到其他客户端
-            max_client_switches = 3  # 最多尝试切换3个客户端
-            switch_success = False
-            
-            for switch_attempt in range(max_client_switches):
-                next_index = get_next_available_client(current_index, failed_indices)
-                if next_index is None:
-                    logger.error("没有其他可用的客户端")
-                    return
-                
-                logger.info(f"切换到客户端 {next_index} (尝试 {switch_attempt + 1}/{max_client_switches})")
-                current_index = next_index
-                client = multi_clients[current_index]
-                work_loads[current_index] += 1
-                
-                # 更新 ByteStreamer 的客户端引用
-                self.client = client
-                
-                # 尝试获取文件块
-                success, r, client, _ = await self._try_get_file_chunk(
-                    client, file_id, location, offset, chunk_size, max_retries=2
+        lane_count = len(lanes)
+        window = ReadAheadWindow(Var.PREFETCH_MIN * lane_count, Var.PREFETCH_MAX * lane_count)
+        # 先解析所有文件位置再占用负载：_StreamState 创建后只能在下面的 finally 中释放
+        locations = [await streamer.get_location(lane_file_id) for _, streamer, lane_file_id in lanes]
+        states: List[_StreamState] = [
+            _StreamState(lane_index, streamer.client, qos, window) for lane_index, streamer, _ in lanes
+        ]
+        if lane_count > 1:
+            logger.info(f"条带化传输 {part_count} 个分块，使用客户端: {[lane[0] for lane in lanes]}")
+        else:
+            logger.debug(f"Starting to yielding file with client {lanes[0][0]} (当前负载: {work_loads[lanes[0][0]]}).")
+
+        async def fetch_from_lanes(
+            part: int, part_offset: int, indices: List[int], shared: SharedFetch
+        ) -> Optional[bytes]:
+            for attempt in range(lane_count):
+                lane = (part + attempt) % lane_count
+                _, streamer, lane_file_id = lanes[lane]
+                chunk = await streamer._fetch_part(
+                    indices[lane], lane_file_id, locations[lane], part_offset, chunk_size, shared
                 )
-                
-                if success:
-                    switch_success = True
-                    logger.info(f"成功切换到客户端 {current_index} 并获取文件块")
-                    break
-                else:
-                    failed_indices.add(current_index)
-                    if current_index in work_loads:
-                        work_loads[current_index] -= 1
-            
-            if not switch_success:
-                logger.error("所有客户端都无法获取初始文件块，停止文件流传输")
-                return
-        
-        try:
-            if isinstance(r, raw.types.upload.File):
-                while True:
-                    chunk = r.bytes
-                    if not chunk:
-                        break
-                    elif part_count == 1:
-                        yield chunk[first_part_cut:last_part_cut]
-                    elif current_part == 1:
-                        yield chunk[first_part_cut:]
-                    elif current_part == part_count:
-                        yield chunk[:last_part_cut]
-                    else:
-                        yield chunk
+                if chunk:
+                    return chunk
+            return None
 
-                    current_part += 1
-                    offset += chunk_size
+        media_id = lanes[0][2].media_id
 
-                    if current_part > part_count:
-                        break
+        async def fetch_cached(
+            part: int, part_offset: int, indices: List[int], shared: SharedFetch
+        ) -> Optional[bytes]:
+            # 先查磁盘分块缓存，未命中再请求 Telegram，获取到的分块在后台写入磁盘缓存
+            chunk = await disk_cache.get(media_id, part_offset, chunk_size)
+            if chunk is not None:
+                return chunk
+            chunk = await fetch_from_lanes(part, part_offset, indices, shared)
+            if chunk:
+                disk_cache.put(media_id, part_offset, chunk)
+            return chunk
 
-                    # 尝试获取下一个文件块
-                    success, r, new_client, _ = await self._try_get_file_chunk(
-                        client, file_id, location, offset, chunk_size, max_retries=2
-                    )
-                    
-                    if not success:
-                        # 当前客户端失败，尝试切换到其他客户端
-                        logger.warning(f"客户端 {current_index} 获取文件块失败 (offset: {offset})，尝试切换到其他客户端")
-                        failed_indices.add(current_index)
-                        
-                        # 减少当前客户端负载
-                        if current_index in work_loads:
-                            work_loads[current_index] -= 1
-                        
-                        # 尝试切换到其他客户端
-                        max_client_switches = 3
-                        switch_success = False
-                        
-                        for switch_attempt in range(max_client_switches):
-                            next_index = get_next_available_client(current_index, failed_indices)
-                            if next_index is None:
-                                logger.error(f"没有其他可用的客户端 (offset: {offset})")
-                                break
-                            
-                            logger.info(f"切换到客户端 {next_index} 继续传输 (offset: {offset}, 尝试 {switch_attempt + 1}/{max_client_switches})")
-                            current_index = next_index
-                            client = multi_clients[current_index]
-                            work_loads[current_index] += 1
-                            
-                            # 更新 ByteStreamer 的客户端引用
-                            self.client = client
-                            
-                            # 尝试获取文件块
-                            success, r, client, _ = await self._try_get_file_chunk(
-                                client, file_id, location, offset, chunk_size, max_retries=2
-                            )
-                            
-                            if success:
-                                switch_success = True
-                                logger.info(f"成功切换到客户端 {current_index} 并继续传输 (offset: {offset})")
-                                break
-                            else:
-                                failed_indices.add(current_index)
-                                if current_index in work_loads:
-                                    work_loads[current_index] -= 1
-                        
-                        if not switch_success:
-                            logger.error(f"所有客户端都无法获取文件块，停止文件流传输 (offset: {offset})")
-                            break
+        async def fetch(part: int) -> Optional[bytes]:
+            # 同一文件同一分块的并发请求（不同 Range 请求、不同机器人）合并为一次 GetFile
+            # 合并后的获取只使用发起时各 lane 的客户端索引，不持有本流的状态
+            part_offset = offset + (part - 1) * chunk_size
+            indices = [state.current_index for state in states]
+            return await chunk_cache.get_or_fetch(
+                (media_id, part_offset, chunk_size),
+                lambda shared: fetch_cached(part, part_offset, indices, shared),
+                states[part % lane_count],
+            )
+
+        pending: Dict[int, asyncio.Task] = {}
+        next_part = 1  # 下一个要调度的分块序号
+        current_part = 1  # 下一个要输出的分块序号
+
+        try:
+            while current_part <= part_count:
+                # 填充预读窗口
+                while next_part <= part_count and next_part - current_part < window.size:
+                    pending[next_part] = asyncio.create_task(fetch(next_part))
+                    next_part += 1
+
+                chunk = await pending.pop(current_part)
+                if not chunk:
+                    break
+                # 首尾分块通过 memoryview 裁剪，不复制最多 1 MiB 的数据（chunk 同时可能被缓存引用，不能原地修改）
+                elif part_count == 1:
+                    yield memoryview(chunk)[first_part_cut:last_part_cut]
+                elif current_part == 1:
+                    yield memoryview(chunk)[first_part_cut:]
+                elif current_part == part_count:
+                    yield memoryview(chunk)[:last_part_cut]
+                else:
+                    yield chunk
+
+                current_part += 1
         except (TimeoutError, AttributeError, TypeError, OSError, ConnectionError) as e:
             error_msg = str(e)
             if 'Connection lost' in error_msg or 'Connection closed' in error_msg:
@@ -503,21 +479,20 @@ class ByteStreamer:
             else:
                 logger.error(f"Unexpected error in yield_file: {e}", exc_info=True)
         finally:
-            logger.debug(f"Finished yielding file with {current_part} parts.")
-            # 确保索引存在后再减少负载（使用当前使用的客户端索引）
-            if current_index in work_loads:
-                work_loads[current_index] -= 1
-                logger.debug(f"客户端 {current_index} 负载已减少 (当前负载: {work_loads[current_index]})")
-            else:
-                logger.warning(f"尝试减少客户端 {current_index} 的负载，但索引不存在于 work_loads 中")
-
-    
-    async def clean_cache(self) -> None:
-        """
-        function to clean the cache to reduce memory usage
-        """
-        while True:
-            await asyncio.sleep(self.clean_timer)
-            self.cached_file_ids.clear()
-            logger.debug("Cleaned the cache")
-
+            # 取消所有尚未消费的预读任务（消费方断开或出错时），已完成但未输出的分块计入浪费字节数
+            wasted_bytes = 0
+            cancelled_fetches = 0
+            for task in pending.values():
+                if not task.done():
+                    task.cancel()
+                    cancelled_fetches += 1
+                elif not task.cancelled() and task.exception() is None and task.result():
+                    wasted_bytes += len(task.result())
+            if pending:
+                stream_stats.record_wasted(wasted_bytes, cancelled_fetches)
+            logger.debug(
+                f"Finished yielding file with {current_part - 1}/{part_count} parts "
+                f"(预读窗口: {window.size}, 取消的预读任务: {len(pending)})."
+            )
+            for state in states:
+                state.release()
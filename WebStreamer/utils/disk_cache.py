@@ -0,0 +1,270 @@
+"""
+磁盘分块缓存（可选）
+
+同一个文件经常被反复播放（家里多个播放器、aria2 重试），每次都会重新从 Telegram 完整获取。
+这里把输出过的 1 MiB 分块按 media_id/offset 保存到磁盘：每个媒体一个稀疏文件，分块写入其原始偏移；
+索引保存在缓存目录下独立的 SQLite 数据库中，重启后继续有效。
+总大小超过上限时按 LRU 淘汰分块（打洞释放空间，媒体的分块全部淘汰后删除文件）。
+所有文件与索引操作都在单独的单线程执行器中进行，不阻塞事件循环，也保证 SQLite 连接只在一个线程使用。
+读取完成后会再次核对索引，读取期间被淘汰（打洞或删除）的分块按未命中处理，不会返回全零数据。
+"""
+import asyncio
+import ctypes
+import ctypes.util
+import logging
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional, Tuple
+
+from WebStreamer import Var
+
+logger = logging.getLogger("streamer")
+
+SEGMENT_SIZE = 1024 * 1024
+# 同时排队的写入数量上限（超过时放弃缓存该分块，不拖慢传输）
+MAX_PENDING_WRITES = 16
+# 访问时间按批写回索引
+ACCESS_FLUSH_BATCH = 64
+
+SegmentKey = Tuple[int, int]
+
+# fallocate(FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE)，仅 Linux 可用；不可用时空间在整个文件删除时释放
+_FALLOC_FL_KEEP_SIZE = 0x01
+_FALLOC_FL_PUNCH_HOLE = 0x02
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library("c") or None, use_errno=True)
+    _fallocate = _libc.fallocate
+    _fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong]
+except (OSError, AttributeError):
+    _fallocate = None
+
+
+def _punch_hole(fd: int, offset: int, length: int) -> None:
+    if _fallocate is not None:
+        _fallocate(fd, _FALLOC_FL_PUNCH_HOLE | _FALLOC_FL_KEEP_SIZE, offset, length)
+
+
+class DiskSegmentCache:
+    """按 (media_id, offset) 缓存分块的磁盘 LRU，索引保存在 SQLite 中"""
+
+    def __init__(self, root: str, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.enabled = max_bytes > 0
+        self.current_bytes = 0
+        self._segments: "OrderedDict[SegmentKey, int]" = OrderedDict()
+        self._media_counts: Dict[int, int] = {}
+        self._touched: Dict[SegmentKey, float] = {}
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="disk-cache")
+        self._conn: Optional[sqlite3.Connection] = None
+        self._loaded = False
+        self._load_lock = asyncio.Lock()
+        self._pending_writes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _path(self, media_id: int) -> str:
+        return os.path.join(self.root, f"{media_id}.seg")
+
+    async def _run(self, func, *args):
+        return await asyncio.get_event_loop().run_in_executor(self._executor, func, *args)
+
+    async def _ensure_loaded(self) -> bool:
+        if self._loaded:
+            return self._conn is not None
+        async with self._load_lock:
+            if not self._loaded:
+                try:
+                    await self._run(self._load)
+                except Exception as e:
+                    logger.warning(f"磁盘分块缓存初始化失败，已禁用: {e}")
+                    self.enabled = False
+                self._loaded = True
+        return self._conn is not None
+
+    def _load(self) -> None:
+        os.makedirs(self.root, exist_ok=True)
+        conn = sqlite3.connect(os.path.join(self.root, "index.db"), check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL;")
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS segments (
+                media_id     INTEGER NOT NULL, -- 媒体 ID
+                offset       INTEGER NOT NULL, -- 分块起始偏移
+                size         INTEGER NOT NULL, -- 分块字节数
+                last_access  REAL NOT NULL,    -- 最近访问时间（LRU 顺序）
+                PRIMARY KEY (media_id, offset)
+            )
+            """
+        )
+        conn.commit()
+        rows = conn.execute("SELECT media_id, offset, size FROM segments ORDER BY last_access").fetchall()
+        for media_id, offset, size in rows:
+            self._segments[(media_id, offset)] = size
+            self._media_counts[media_id] = self._media_counts.get(media_id, 0) + 1
+            self.current_bytes += size
+        self._conn = conn
+        logger.info(f"磁盘分块缓存已加载: {len(rows)} 个分块, {self.current_bytes} 字节 ({self.root})")
+
+    async def get(self, media_id: int, offset: int, size: int) -> Optional[bytes]:
+        """读取缓存的分块；未缓存或读取失败时返回 None"""
+        if not self.enabled or size != SEGMENT_SIZE or not await self._ensure_loaded():
+            return None
+        key = (media_id, offset)
+        stored = self._segments.get(key)
+        if stored is None:
+            self.misses += 1
+            return None
+        try:
+            data = await self._run(self._read, media_id, offset, stored)
+        except OSError as e:
+            logger.debug(f"读取磁盘分块缓存失败 (media {media_id}, offset {offset}): {e}")
+            data = None
+        if self._segments.get(key) != stored:
+            # 读取期间分块已被淘汰，文件可能已经打洞或删除，读到的数据不可信
+            self.misses += 1
+            return None
+        if data is None or len(data) != stored:
+            self.misses += 1
+            self._forget(key)
+            return None
+        self.hits += 1
+        self._segments.move_to_end(key)
+        self._touched[key] = time.time()
+        if len(self._touched) >= ACCESS_FLUSH_BATCH:
+            touched, self._touched = self._touched, {}
+            asyncio.ensure_future(self._run(self._flush_access, touched))
+        return data
+
+    def _read(self, media_id: int, offset: int, size: int) -> Optional[bytes]:
+        fd = os.open(self._path(media_id), os.O_RDONLY)
+        try:
+            return os.pread(fd, size, offset)
+        finally:
+            os.close(fd)
+
+    def put(self, media_id: int, offset: int, data: bytes) -> None:
+        """在后台把分块写入缓存（不等待写入完成；写入队列已满时直接放弃）"""
+        if not self.enabled or not data or offset % SEGMENT_SIZE or len(data) > SEGMENT_SIZE:
+            return
+        key = (media_id, offset)
+        if key in self._segments or self._pending_writes >= MAX_PENDING_WRITES:
+            return
+        self._pending_writes += 1
+        asyncio.ensure_future(self._put(key, data))
+
+    async def _put(self, key: SegmentKey, data: bytes) -> None:
+        reserved = False
+        try:
+            if not await self._ensure_loaded() or key in self._segments:
+                return
+            evicted = self._evict_for(len(data))
+            # 写入前先登记到内存索引：并发的淘汰会把正在写入的分块计入该媒体的分块数，不会删除整个文件；
+            # 之后提交的读取在单线程执行器中排在这次写入之后，不会读到尚未写入的数据
+            self._segments[key] = len(data)
+            self._media_counts[key[0]] = self._media_counts.get(key[0], 0) + 1
+            self.current_bytes += len(data)
+            reserved = True
+            await self._run(self._write, key, data, evicted)
+        except Exception as e:
+            logger.debug(f"写入磁盘分块缓存失败 (media {key[0]}, offset {key[1]}): {e}")
+            if reserved:
+                self._forget(key)
+        finally:
+            self._pending_writes -= 1
+
+    def _evict_for(self, size: int) -> list:
+        """在内存索引中选出需要淘汰的分块（最久未访问的在前），实际删除在执行器中进行"""
+        evicted = []
+        while self._segments and self.current_bytes + size > self.max_bytes:
+            key, stored = self._segments.popitem(last=False)
+            self.current_bytes -= stored
+            self._touched.pop(key, None)
+            remaining = self._media_counts.get(key[0], 1) - 1
+            if remaining > 0:
+                self._media_counts[key[0]] = remaining
+            else:
+                self._media_counts.pop(key[0], None)
+            evicted.append((key, stored, remaining == 0))
+            self.evictions += 1
+        return evicted
+
+    def _write(self, key: SegmentKey, data: bytes, evicted: list) -> None:
+        for (media_id, offset), stored, last in evicted:
+            self._remove_segment(media_id, offset, stored, last)
+        media_id, offset = key
+        fd = os.open(self._path(media_id), os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            os.pwrite(fd, data, offset)
+        finally:
+            os.close(fd)
+        self._conn.execute(
+            "INSERT OR REPLACE INTO segments (media_id, offset, size, last_access) VALUES (?, ?, ?, ?)",
+            (media_id, offset, len(data), time.time()),
+        )
+        self._conn.commit()
+
+    def _remove_segment(self, media_id: int, offset: int, size: int, last: bool) -> None:
+        path = self._path(media_id)
+        try:
+            if last:
+                os.unlink(path)
+            else:
+                fd = os.open(path, os.O_WRONLY)
+                try:
+                    _punch_hole(fd, offset, size)
+                finally:
+                    os.close(fd)
+        except OSError:
+            pass
+        self._conn.execute("DELETE FROM segments WHERE media_id = ? AND offset = ?", (media_id, offset))
+
+    def _forget(self, key: SegmentKey) -> None:
+        """索引中有但文件中读不到的分块（文件被外部删除等）：从索引中移除"""
+        stored = self._segments.pop(key, None)
+        if stored is None:
+            return
+        self.current_bytes -= stored
+        remaining = self._media_counts.get(key[0], 1) - 1
+        if remaining > 0:
+            self._media_counts[key[0]] = remaining
+        else:
+            self._media_counts.pop(key[0], None)
+        asyncio.ensure_future(self._run(self._delete_index, key))
+
+    def _delete_index(self, key: SegmentKey) -> None:
+        self._conn.execute("DELETE FROM segments WHERE media_id = ? AND offset = ?", key)
+        self._conn.commit()
+
+    def _flush_access(self, touched: Dict[SegmentKey, float]) -> None:
+        self._conn.executemany(
+            "UPDATE segments SET last_access = ? WHERE media_id = ? AND offset = ?",
+            [(ts, media_id, offset) for (media_id, offset), ts in touched.items()],
+        )
+        self._conn.commit()
+
+    def stats(self) -> dict:
+        """缓存统计信息（用于 /api/status）"""
+        total = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            "cached_segments": len(self._segments),
+            "cached_bytes": self.current_bytes,
+            "max_bytes": self.max_bytes,
+            "evictions": self.evictions,
+        }
+
+
+def _default_cache_dir() -> str:
+    from db import DB_PATH
+    return os.path.join(os.path.dirname(DB_PATH) or ".", "segment_cache")
+
+
+disk_cache = DiskSegmentCache(Var.DISK_CACHE_DIR or _default_cache_dir(), Var.DISK_CACHE_MB * 1024 * 1024)
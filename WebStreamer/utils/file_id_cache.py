@@ -0,0 +1,189 @@
+"""
+跨客户端共享的 FileId 缓存
+
+同一条日志频道消息只需解析一次（get_messages）：媒体位置与文件属性（dc_id、media_id、access_hash、
+文件大小、MIME 等）所有机器人共用，只有 file_reference 按机器人单独记录。
+缓存按 LRU + TTL 逐条淘汰，同一消息的并发解析（或 file_reference 刷新）合并为一次请求。
+解析结果同时持久化到 tg_file_locations 表，重启后按需从数据库加载，不再对每个文件重新 get_messages。
+"""
+import asyncio
+import copy
+import logging
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from pyrogram import Client
+from pyrogram.errors import FloodWait
+from pyrogram.file_id import FileId
+
+from db import get_file_location, save_file_location
+
+from WebStreamer import Var
+from WebStreamer.bot import multi_clients
+from WebStreamer.server.exceptions import FIleNotFound
+from .file_properties import get_file_ids
+from .scheduler import client_scheduler
+from .rate_limiter import rate_limiter
+
+logger = logging.getLogger("streamer")
+
+# 缓存条目数量上限与有效期（秒）
+FILE_ID_CACHE_MAX_ENTRIES = 2048
+FILE_ID_CACHE_TTL = 6 * 60 * 60
+
+
+class _Entry:
+    __slots__ = ("file_id", "references", "expires_at")
+
+    def __init__(self, file_id: FileId):
+        self.file_id = file_id  # 共享的媒体位置与文件属性
+        self.references: Dict[Client, bytes] = {}  # 各机器人自己解析得到的 file_reference
+        self.expires_at = time.monotonic() + FILE_ID_CACHE_TTL
+
+
+class FileIdCache:
+    """message_id -> FileId 的共享缓存（LRU + TTL，单飞解析）"""
+
+    def __init__(self, max_entries: int = FILE_ID_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[int, _Entry]" = OrderedDict()
+        self._inflight: Dict[Tuple[int, Optional[Client]], asyncio.Task] = {}
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, client: Client, message_id: int) -> FileId:
+        """获取 FileId：命中缓存时不再调用 get_messages，使用该机器人自己的 file_reference（没有时使用首次解析得到的）"""
+        entry = self._get_entry(message_id)
+        if entry is None:
+            self.misses += 1
+            await self._single_flight((message_id, "load"), self._load(client, message_id))
+            entry = self._get_entry(message_id)
+            if entry is None:
+                raise FIleNotFound
+        else:
+            self.hits += 1
+        return self._build(entry, client, message_id)
+
+    async def refresh(self, client: Client, message_id: int) -> FileId:
+        """
+        使用指定机器人重新解析消息（FILE_REFERENCE_EXPIRED 时调用），并记录该机器人的 file_reference
+        同一文件同时只会有一次刷新，其余请求方等待并使用刷新后的结果
+        """
+        await self._single_flight((message_id, "refresh"), self._resolve(client, message_id))
+        entry = self._get_entry(message_id)
+        if entry is None:
+            raise FIleNotFound
+        return self._build(entry, client, message_id)
+
+    def invalidate(self, message_id: int) -> None:
+        self._entries.pop(message_id, None)
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+    def _get_entry(self, message_id: int) -> Optional[_Entry]:
+        entry = self._entries.get(message_id)
+        if entry is None:
+            return None
+        if entry.expires_at <= time.monotonic():
+            del self._entries[message_id]
+            return None
+        self._entries.move_to_end(message_id)
+        return entry
+
+    async def _single_flight(self, key, coro) -> None:
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(coro)
+            self._inflight[key] = task
+            task.add_done_callback(lambda _, k=key: self._inflight.pop(k, None))
+        else:
+            coro.close()
+        await asyncio.shield(task)
+
+    async def _load(self, client: Client, message_id: int) -> None:
+        """缓存未命中：优先从数据库加载已持久化的解析结果，没有时再通过 get_messages 解析"""
+        try:
+            row = get_file_location(Var.BIN_CHANNEL, message_id)
+        except Exception as e:
+            logger.warning(f"读取已持久化的文件属性失败 (消息 {message_id}): {e}")
+            row = None
+        if row:
+            try:
+                file_id = FileId.decode(row["file_id"])
+                if row["file_reference"] is not None:
+                    file_id.file_reference = bytes(row["file_reference"])
+                setattr(file_id, "file_size", row["file_size"] or 0)
+                setattr(file_id, "mime_type", row["mime_type"] or "")
+                setattr(file_id, "file_name", row["file_name"] or "")
+                setattr(file_id, "unique_id", row["file_unique_id"])
+                self._store(message_id, file_id)
+                logger.debug(f"Loaded persisted file ID for message with ID {message_id}")
+                return
+            except Exception as e:
+                logger.warning(f"解码已持久化的文件属性失败，重新解析 (消息 {message_id}): {e}")
+        await self._resolve(client, message_id)
+
+    def _store(self, message_id: int, file_id: FileId) -> _Entry:
+        entry = _Entry(file_id)
+        self._entries[message_id] = entry
+        self._entries.move_to_end(message_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return entry
+
+    async def _resolve(self, client: Client, message_id: int) -> None:
+        # 指定的机器人处于限流冷却中或解析时触发限流，改用其他未被限流的机器人解析
+        tried = set()
+        while True:
+            index = client_scheduler.client_index(client)
+            if index is not None and client_scheduler.is_flooded(index):
+                tried.add(index)
+            else:
+                try:
+                    await rate_limiter.acquire(client, "get")
+                    file_id = await get_file_ids(client, Var.BIN_CHANNEL, message_id)
+                    break
+                except FloodWait as e:
+                    if index is None:
+                        raise
+                    client_scheduler.record_flood_wait(index, e.value, "get")
+                    tried.add(index)
+            next_index = client_scheduler.pick(exclude=tried)
+            if next_index is None or client_scheduler.is_flooded(next_index):
+                raise FloodWait(value=int(client_scheduler.flood_wait_remaining(next_index)) if next_index is not None else 0)
+            client = multi_clients[next_index]
+
+        if not file_id:
+            logger.debug(f"Message with ID {message_id} not found")
+            raise FIleNotFound
+        logger.debug(f"Resolved file ID for message with ID {message_id}")
+
+        entry = self._entries.get(message_id)
+        if entry is None or entry.file_id.media_id != file_id.media_id:
+            entry = self._store(message_id, file_id)
+        else:
+            # 刷新后其他机器人旧的 file_reference 同样可能已过期，统一改用最新的
+            entry.references.clear()
+            entry.file_id.file_reference = file_id.file_reference
+        entry.references[client] = file_id.file_reference
+
+        try:
+            save_file_location(Var.BIN_CHANNEL, message_id, file_id)
+        except Exception as e:
+            logger.warning(f"持久化文件属性失败 (消息 {message_id}): {e}")
+
+    @staticmethod
+    def _build(entry: _Entry, client: Client, message_id: int) -> FileId:
+        file_id = copy.copy(entry.file_id)
+        file_id.file_reference = entry.references.get(client, entry.file_id.file_reference)
+        setattr(file_id, "message_id", message_id)
+        return file_id
+
+
+file_id_cache = FileIdCache()
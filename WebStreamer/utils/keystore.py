@@ -0,0 +1,115 @@
+"""
+媒体 DC 授权密钥的加密存储
+
+机器人默认以 in_memory 方式运行，每次重启后首次访问非所在 DC 时都需要重新创建 Auth key 并
+Export/ImportAuthorization。这里将已导入授权的媒体 DC auth key 加密保存到数据库目录下，重启后直接复用，
+只有 Telegram 拒绝该密钥时才重新创建。
+
+每条记录使用由对应机器人 BOT_TOKEN 派生的密钥加密（AES-256-CTR，TgCrypto），并附带 HMAC-SHA256 校验；
+更换 token 后旧记录无法解密，会被自动忽略。
+"""
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import os
+import threading
+from typing import Dict, Optional
+
+import tgcrypto
+
+from db import DB_PATH
+
+logger = logging.getLogger("streamer")
+
+KEYSTORE_PATH = os.path.join(os.path.dirname(DB_PATH) or ".", "media_auth_keys.json")
+
+
+class MediaAuthKeyStore:
+    """按 (机器人, DC, 测试模式) 保存媒体会话 auth key 的加密文件存储"""
+
+    def __init__(self, path: str = KEYSTORE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries: Optional[Dict[str, str]] = None
+
+    @staticmethod
+    def _derive_keys(bot_token: str):
+        secret = bot_token.encode("utf-8")
+        enc_key = hashlib.sha256(b"mistrelay-media-keystore-enc:" + secret).digest()
+        mac_key = hashlib.sha256(b"mistrelay-media-keystore-mac:" + secret).digest()
+        return enc_key, mac_key
+
+    @staticmethod
+    def _entry_name(bot_token: str, dc_id: int, test_mode: bool) -> str:
+        bot_id = bot_token.split(":", 1)[0]
+        return f"{bot_id}:{dc_id}:{int(bool(test_mode))}"
+
+    def _read(self) -> Dict[str, str]:
+        if self._entries is None:
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    self._entries = json.load(f)
+            except FileNotFoundError:
+                self._entries = {}
+            except Exception as e:
+                logger.warning(f"读取媒体授权密钥存储失败，将重新创建: {e}")
+                self._entries = {}
+        return self._entries
+
+    def _write(self) -> None:
+        tmp_path = self.path + ".tmp"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(self._entries, f)
+        os.replace(tmp_path, self.path)
+
+    def load(self, bot_token: Optional[str], dc_id: int, test_mode: bool) -> Optional[bytes]:
+        """读取并解密 auth key；不存在、校验失败或无法解密时返回 None"""
+        if not bot_token:
+            return None
+        with self._lock:
+            blob = self._read().get(self._entry_name(bot_token, dc_id, test_mode))
+        if not blob:
+            return None
+        try:
+            raw_blob = base64.b64decode(blob)
+            iv, ciphertext, tag = raw_blob[:16], raw_blob[16:-32], raw_blob[-32:]
+            enc_key, mac_key = self._derive_keys(bot_token)
+            if not hmac.compare_digest(hmac.new(mac_key, iv + ciphertext, hashlib.sha256).digest(), tag):
+                logger.warning(f"DC {dc_id} 的媒体授权密钥校验失败，忽略")
+                return None
+            return tgcrypto.ctr256_decrypt(ciphertext, enc_key, iv, bytes(1))
+        except Exception as e:
+            logger.warning(f"解密 DC {dc_id} 的媒体授权密钥失败: {e}")
+            return None
+
+    def save(self, bot_token: Optional[str], dc_id: int, test_mode: bool, auth_key: bytes) -> None:
+        """加密保存 auth key"""
+        if not bot_token:
+            return
+        enc_key, mac_key = self._derive_keys(bot_token)
+        iv = os.urandom(16)
+        ciphertext = tgcrypto.ctr256_encrypt(auth_key, enc_key, iv, bytes(1))
+        tag = hmac.new(mac_key, iv + ciphertext, hashlib.sha256).digest()
+        with self._lock:
+            self._read()[self._entry_name(bot_token, dc_id, test_mode)] = base64.b64encode(iv + ciphertext + tag).decode("ascii")
+            try:
+                self._write()
+            except Exception as e:
+                logger.warning(f"保存媒体授权密钥失败: {e}")
+
+    def delete(self, bot_token: Optional[str], dc_id: int, test_mode: bool) -> None:
+        """删除被 Telegram 拒绝的 auth key"""
+        if not bot_token:
+            return
+        with self._lock:
+            if self._read().pop(self._entry_name(bot_token, dc_id, test_mode), None) is not None:
+                try:
+                    self._write()
+                except Exception as e:
+                    logger.warning(f"删除媒体授权密钥失败: {e}")
+
+
+media_keystore = MediaAuthKeyStore()
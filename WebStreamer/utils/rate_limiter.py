@@ -0,0 +1,168 @@
+"""
+按机器人、按方法类别的令牌桶限速
+
+在调用 Telegram 之前主动限速，而不是等触发 FloodWait 后再暂停：
+- send：发送/转发消息（send_*、forward_messages、reply），机器人整体约 30 条/秒，
+  同一私聊约 1 条/秒，同一群组/频道约 20 条/分钟
+- edit：编辑消息（edit_text），按聊天限速同 send
+- get：get_messages 等读取类调用
+- delete：删除消息
+
+触发 FloodWait 时对应的桶按等待时长成比例降速，之后无限流时逐步恢复到基础速率。
+"""
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from WebStreamer.bot import multi_clients
+
+logger = logging.getLogger("streamer")
+
+# 各方法类别的机器人整体速率（令牌/秒）与突发容量
+CLASS_LIMITS: Dict[str, Tuple[float, float]] = {
+    "send": (25.0, 25.0),
+    "edit": (25.0, 25.0),
+    "get": (10.0, 20.0),
+    "delete": (25.0, 25.0),
+}
+# 按聊天限速：私聊与群组/频道（令牌/秒，突发容量）
+PRIVATE_CHAT_LIMIT = (1.0, 3.0)
+GROUP_CHAT_LIMIT = (20.0 / 60.0, 5.0)
+# 需要按聊天限速的方法类别
+PER_CHAT_CLASSES = ("send", "edit")
+# 按聊天的桶最多保留数量
+MAX_CHAT_BUCKETS = 1024
+# 降速后的最低比例与恢复节奏
+MIN_RATE_FACTOR = 1 / 16
+RECOVERY_INTERVAL = 60
+RECOVERY_FACTOR = 1.25
+
+
+class TokenBucket:
+    """令牌桶：acquire() 在令牌不足时等待，支持按 FloodWait 降速与逐步恢复"""
+
+    def __init__(self, rate: float, burst: float):
+        self.base_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+        self.penalized_at = 0.0
+        self.flood_waits = 0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float) -> None:
+        # 距上次降速或恢复已超过恢复间隔：逐步恢复速率
+        if self.rate < self.base_rate and now - self.penalized_at >= RECOVERY_INTERVAL:
+            self.rate = min(self.base_rate, self.rate * RECOVERY_FACTOR)
+            self.penalized_at = now
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    async def acquire(self, tokens: float = 1) -> float:
+        """
+        获取令牌，返回等待的秒数
+        超过突发容量的请求（如转发整个媒体组）按突发容量分批扣除，等待多次补充，不会少扣
+        """
+        remaining = tokens
+        waited = 0.0
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                step = min(remaining, self.burst)
+                if self.tokens >= step:
+                    self.tokens -= step
+                    remaining -= step
+                    if remaining <= 0:
+                        return waited
+                    continue
+                delay = (step - self.tokens) / self.rate
+                waited += delay
+                await asyncio.sleep(delay)
+
+    def penalize(self, flood_seconds: float) -> None:
+        """触发 FloodWait：等待时间越长降速越多，并清空当前令牌"""
+        factor = 0.5 if flood_seconds < 30 else 0.25
+        self.rate = max(self.base_rate * MIN_RATE_FACTOR, self.rate * factor)
+        self.tokens = 0
+        self.penalized_at = time.monotonic()
+        self.flood_waits += 1
+
+
+class RateLimiter:
+    """管理所有机器人、所有方法类别（以及按聊天）的令牌桶"""
+
+    def __init__(self):
+        self._buckets: Dict[Tuple[int, str], TokenBucket] = {}
+        self._chat_buckets: "OrderedDict[Tuple[int, str, int], TokenBucket]" = OrderedDict()
+
+    @staticmethod
+    def _index(client) -> Optional[int]:
+        if isinstance(client, int):
+            return client
+        return next((i for i, c in multi_clients.items() if c is client), None)
+
+    def _bucket(self, index: int, method_class: str) -> TokenBucket:
+        key = (index, method_class)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            rate, burst = CLASS_LIMITS.get(method_class, (10.0, 10.0))
+            bucket = self._buckets[key] = TokenBucket(rate, burst)
+        return bucket
+
+    def _chat_bucket(self, index: int, method_class: str, chat_id: int) -> TokenBucket:
+        key = (index, method_class, chat_id)
+        bucket = self._chat_buckets.get(key)
+        if bucket is None:
+            rate, burst = PRIVATE_CHAT_LIMIT if chat_id > 0 else GROUP_CHAT_LIMIT
+            bucket = self._chat_buckets[key] = TokenBucket(rate, burst)
+            while len(self._chat_buckets) > MAX_CHAT_BUCKETS:
+                self._chat_buckets.popitem(last=False)
+        else:
+            self._chat_buckets.move_to_end(key)
+        return bucket
+
+    async def acquire(self, client, method_class: str, chat_id: Optional[int] = None, tokens: int = 1) -> None:
+        """
+        调用 Telegram 前获取令牌（client 可以是客户端对象或索引；非本模块管理的客户端直接放行）
+        tokens 用于一次调用包含多条消息的情况（如 forward_messages 转发媒体组）
+        """
+        index = self._index(client)
+        if index is None:
+            return
+        waited = await self._bucket(index, method_class).acquire(tokens)
+        if chat_id is not None and method_class in PER_CHAT_CLASSES:
+            waited += await self._chat_bucket(index, method_class, int(chat_id)).acquire(tokens)
+        if waited >= 1:
+            logger.debug(f"客户端 {index} 的 {method_class} 调用限速等待 {waited:.1f} 秒")
+
+    async def acquire_for_message(self, message, method_class: str) -> None:
+        """回复/编辑某条消息前获取令牌（按该消息所属机器人与聊天限速）"""
+        chat = getattr(message, "chat", None)
+        await self.acquire(getattr(message, "_client", None), method_class, chat.id if chat else None)
+
+    def on_flood_wait(self, index: int, method_class: Optional[str], seconds: float, chat_id: Optional[int] = None) -> None:
+        """根据 FloodWait 学习：降低对应类别（及聊天）的速率"""
+        if method_class is None:
+            return
+        self._bucket(index, method_class).penalize(seconds)
+        if chat_id is not None and method_class in PER_CHAT_CLASSES:
+            self._chat_bucket(index, method_class, int(chat_id)).penalize(seconds)
+        logger.info(f"客户端 {index} 的 {method_class} 调用因 FloodWait {seconds} 秒降速")
+
+    def stats(self) -> dict:
+        """各机器人各类别的当前速率（用于 /api/status）"""
+        result: Dict[str, dict] = {}
+        for (index, method_class), bucket in sorted(self._buckets.items()):
+            result.setdefault(f"bot{index + 1}", {})[method_class] = {
+                "rate": round(bucket.rate, 3),
+                "base_rate": bucket.base_rate,
+                "flood_waits": bucket.flood_waits,
+            }
+        return result
+
+
+rate_limiter = RateLimiter()
@@ -0,0 +1,234 @@
+"""
+客户端调度器（按机器人、按 DC 统计）
+
+替代单纯比较 work_loads 计数的负载均衡：对每个机器人记录活跃任务数、在途字节数、
+分块延迟 EWMA（整体与按 DC）、近期错误率以及 FloodWait 冷却时间，选择预计最快完成的机器人。
+任务通过 acquire() 返回的租约登记与释放，释放是幂等的，异常路径不会造成计数漂移；
+work_loads / upload_work_loads 仍由租约同步更新，仅用于展示。
+"""
+import logging
+import time
+from typing import Dict, Iterable, Optional
+
+from WebStreamer.bot import multi_clients, work_loads, channel_accessible_clients
+from .rate_limiter import rate_limiter
+
+logger = logging.getLogger("streamer")
+
+# 没有任何延迟样本时使用的默认分块延迟（秒）
+DEFAULT_CHUNK_LATENCY = 0.5
+# EWMA 平滑系数
+LATENCY_ALPHA = 0.2
+ERROR_ALPHA = 0.2
+# 在途字节折算为活跃任务数的单位（1 个分块）
+IN_FLIGHT_UNIT = 1024 * 1024
+
+
+class _DcStats:
+    __slots__ = ("latency", "error_rate")
+
+    def __init__(self):
+        self.latency: Optional[float] = None
+        self.error_rate = 0.0
+
+
+class _ClientStats:
+    __slots__ = ("active", "bytes_in_flight", "latency", "error_rate", "flood_until", "flood_seconds", "dcs")
+
+    def __init__(self):
+        self.active = 0
+        self.bytes_in_flight = 0
+        self.latency: Optional[float] = None
+        self.error_rate = 0.0
+        self.flood_until = 0.0
+        self.flood_seconds = 0
+        self.dcs: Dict[int, _DcStats] = {}
+
+    def dc(self, dc_id: int) -> _DcStats:
+        stats = self.dcs.get(dc_id)
+        if stats is None:
+            stats = self.dcs[dc_id] = _DcStats()
+        return stats
+
+
+class Lease:
+    """调度器租约：登记一个使用某机器人的任务，release() 可重复调用"""
+
+    def __init__(self, scheduler: "ClientScheduler", index: int, counters: Optional[dict]):
+        self.scheduler = scheduler
+        self.index = index
+        self.counters = counters
+        self.released = False
+
+    def release(self) -> None:
+        if self.released:
+            return
+        self.released = True
+        self.scheduler._release(self)
+
+    def __enter__(self) -> "Lease":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.release()
+
+
+class ClientScheduler:
+    """按延迟、在途字节、错误率与 FloodWait 冷却选择机器人"""
+
+    def __init__(self):
+        self._stats: Dict[int, _ClientStats] = {}
+
+    def _get(self, index: int) -> _ClientStats:
+        stats = self._stats.get(index)
+        if stats is None:
+            stats = self._stats[index] = _ClientStats()
+        return stats
+
+    def candidates(self, exclude: Iterable[int] = ()) -> list:
+        """可选的机器人：优先能访问频道的，排除指定的机器人"""
+        exclude = set(exclude)
+        accessible = [i for i in multi_clients if i in channel_accessible_clients and i not in exclude]
+        if accessible:
+            return accessible
+        return [i for i in multi_clients if i not in exclude]
+
+    @staticmethod
+    def client_index(client) -> Optional[int]:
+        """根据客户端对象查找其索引"""
+        return next((i for i, c in multi_clients.items() if c is client), None)
+
+    def is_flooded(self, index: int) -> bool:
+        return self._get(index).flood_until > time.monotonic()
+
+    def all_flooded(self) -> bool:
+        """是否所有客户端都处于 FloodWait 冷却中"""
+        return bool(multi_clients) and all(self.is_flooded(i) for i in multi_clients)
+
+    def flood_wait_remaining(self, index: int) -> float:
+        return max(0.0, self._get(index).flood_until - time.monotonic())
+
+    def score(self, index: int, dc_id: Optional[int] = None) -> float:
+        """预计代价（越小越好）"""
+        stats = self._get(index)
+        latency = stats.latency
+        error_rate = stats.error_rate
+        if dc_id is not None and dc_id in stats.dcs:
+            dc_stats = stats.dcs[dc_id]
+            if dc_stats.latency is not None:
+                latency = dc_stats.latency
+            error_rate = max(error_rate, dc_stats.error_rate)
+        if latency is None:
+            latency = DEFAULT_CHUNK_LATENCY
+        load = stats.active + stats.bytes_in_flight / IN_FLIGHT_UNIT
+        return latency * (1 + load) * (1 + 4 * error_rate)
+
+    def pick(
+        self,
+        dc_id: Optional[int] = None,
+        exclude: Iterable[int] = (),
+        candidates: Optional[Iterable[int]] = None,
+    ) -> Optional[int]:
+        """
+        选择代价最小的机器人；处于 FloodWait 冷却中的机器人不参与，
+        全部都在冷却时选择最早结束冷却的那个
+        candidates: 只在这些机器人中选择（默认为 candidates()，优先能访问频道的）
+        """
+        if candidates is None:
+            candidates = self.candidates(exclude)
+        else:
+            exclude = set(exclude)
+            candidates = [i for i in candidates if i not in exclude]
+        if not candidates:
+            return None
+        ready = [i for i in candidates if not self.is_flooded(i)]
+        if not ready:
+            return min(candidates, key=lambda i: self._get(i).flood_until)
+        return min(ready, key=lambda i: (self.score(i, dc_id), i))
+
+    def acquire(self, index: int, counters: Optional[dict] = None) -> Lease:
+        """登记一个使用该机器人的任务，counters 为需要同步更新的展示用计数（默认 work_loads）"""
+        if counters is None:
+            counters = work_loads
+        self._get(index).active += 1
+        counters[index] = counters.get(index, 0) + 1
+        return Lease(self, index, counters)
+
+    def _release(self, lease: Lease) -> None:
+        stats = self._get(lease.index)
+        stats.active = max(0, stats.active - 1)
+        if lease.counters is not None and lease.index in lease.counters:
+            lease.counters[lease.index] = max(0, lease.counters[lease.index] - 1)
+
+    def begin_transfer(self, index: int, nbytes: int) -> None:
+        self._get(index).bytes_in_flight += nbytes
+
+    def end_transfer(self, index: int, nbytes: int) -> None:
+        stats = self._get(index)
+        stats.bytes_in_flight = max(0, stats.bytes_in_flight - nbytes)
+
+    def record_success(self, index: int, dc_id: Optional[int], latency: float) -> None:
+        stats = self._get(index)
+        stats.latency = latency if stats.latency is None else (1 - LATENCY_ALPHA) * stats.latency + LATENCY_ALPHA * latency
+        stats.error_rate *= (1 - ERROR_ALPHA)
+        if dc_id is not None:
+            dc_stats = stats.dc(dc_id)
+            dc_stats.latency = latency if dc_stats.latency is None else (1 - LATENCY_ALPHA) * dc_stats.latency + LATENCY_ALPHA * latency
+            dc_stats.error_rate *= (1 - ERROR_ALPHA)
+
+    def record_error(self, index: int, dc_id: Optional[int] = None) -> None:
+        stats = self._get(index)
+        stats.error_rate = (1 - ERROR_ALPHA) * stats.error_rate + ERROR_ALPHA
+        if dc_id is not None:
+            dc_stats = stats.dc(dc_id)
+            dc_stats.error_rate = (1 - ERROR_ALPHA) * dc_stats.error_rate + ERROR_ALPHA
+
+    def record_flood_wait(self, index: int, seconds: float, method_class: Optional[str] = None,
+                          chat_id: Optional[int] = None) -> None:
+        """记录 FloodWait 冷却；指定 method_class 时令牌桶限速器同时对该类调用降速"""
+        rate_limiter.on_flood_wait(index, method_class, seconds, chat_id)
+        stats = self._get(index)
+        until = time.monotonic() + seconds
+        if until > stats.flood_until:
+            stats.flood_until = until
+            stats.flood_seconds = int(seconds)
+        logger.warning(f"客户端 {index} 触发 FloodWait，{seconds} 秒内不再调度")
+
+    def flood_wait_status(self) -> dict:
+        """各机器人的 FloodWait 冷却状态（用于 /api/status）"""
+        now_wall = time.time()
+        result = {}
+        for index in sorted(multi_clients):
+            remaining = self.flood_wait_remaining(index)
+            result[f"bot{index + 1}"] = {
+                "flood_waiting": remaining > 0,
+                "remaining_seconds": int(remaining),
+                "wait_seconds": self._get(index).flood_seconds if remaining > 0 else 0,
+                "resume_time": int(now_wall + remaining) if remaining > 0 else None,
+            }
+        return result
+
+    def stats(self) -> dict:
+        """各机器人的调度统计（用于 /api/status）"""
+        now = time.monotonic()
+        result = {}
+        for index in sorted(multi_clients):
+            stats = self._get(index)
+            result[f"bot{index + 1}"] = {
+                "active": stats.active,
+                "bytes_in_flight": stats.bytes_in_flight,
+                "latency_ms": round(stats.latency * 1000, 1) if stats.latency is not None else None,
+                "error_rate": round(stats.error_rate, 3),
+                "flood_wait_remaining": max(0, int(stats.flood_until - now)),
+                "dcs": {
+                    f"dc{dc_id}": {
+                        "latency_ms": round(dc.latency * 1000, 1) if dc.latency is not None else None,
+                        "error_rate": round(dc.error_rate, 3),
+                    }
+                    for dc_id, dc in sorted(stats.dcs.items())
+                },
+            }
+        return result
+
+
+client_scheduler = ClientScheduler()
@@ -0,0 +1,225 @@
+"""
+MP4/MKV 索引预取
+
+播放器打开直链时先读文件头，再跳到 moov（MP4 未做 faststart 时位于文件末尾）或 Cues（MKV）所在位置，
+拿到索引后才能开始播放，每次跳转都是一次冷的 Telegram 请求。
+这里在观看请求第一次从头打开容器文件时，后台预取文件头与索引所在区间，结果进入分块缓存，
+播放器随后的请求直接命中缓存（内存与磁盘分块缓存都未启用时不预取）。
+MP4 先获取文件头并解析顶层 box 定位 moov（moov 已在文件头中时不再获取末尾）；MKV 默认取文件末尾。
+MKV 或无法解析时记录播放器实际跳转的位置（只记录观看请求，aria2 等批量下载的分段请求不代表索引位置），
+之后解析得到的 moov 位置会覆盖记录的位置。
+每个 media_id 的索引位置保存在内存中，之后再次打开时文件头与索引一次性并行获取。
+"""
+import asyncio
+import logging
+import os
+import struct
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Set, Tuple
+
+from .admission import QOS_BACKGROUND, QOS_INTERACTIVE
+from .chunk_cache import chunk_cache
+from .custom_dl import ByteStreamer
+from .disk_cache import disk_cache
+
+logger = logging.getLogger("streamer")
+
+CHUNK_SIZE = 1024 * 1024
+# 默认预取的末尾字节数，以及单个索引区间的最大预取字节数
+TAIL_BYTES = 2 * CHUNK_SIZE
+MAX_INDEX_BYTES = 16 * CHUNK_SIZE
+# 同一文件两次预取之间的最小间隔（秒），避免 aria2 分段连接、播放器重连反复触发
+PREFETCH_INTERVAL = 60
+# 记住的索引位置数量上限
+MAX_HINTS = 4096
+
+CONTAINER_EXTENSIONS = {
+    ".mp4": "mp4", ".m4v": "mp4", ".m4a": "mp4", ".mov": "mp4", ".3gp": "mp4",
+    ".mkv": "mkv", ".webm": "mkv", ".mka": "mkv",
+}
+CONTAINER_MIME_TYPES = {
+    "video/mp4": "mp4", "audio/mp4": "mp4", "video/quicktime": "mp4", "video/3gpp": "mp4",
+    "video/x-matroska": "mkv", "video/webm": "mkv", "audio/webm": "mkv", "audio/x-matroska": "mkv",
+}
+
+IndexRange = Tuple[int, int]
+
+
+def detect_container(mime_type: Optional[str], file_name: Optional[str]) -> Optional[str]:
+    """根据 MIME 类型或文件扩展名判断容器类型（"mp4" / "mkv"），不是这两类时返回 None"""
+    container = CONTAINER_MIME_TYPES.get((mime_type or "").lower())
+    if container:
+        return container
+    return CONTAINER_EXTENSIONS.get(os.path.splitext(file_name or "")[1].lower())
+
+
+def find_mp4_index(head: bytes, file_size: int) -> Optional[IndexRange]:
+    """
+    遍历文件头中的 MP4 顶层 box 定位 moov
+    返回 moov 所在区间；moov 已完整包含在文件头中、或文件头无法解析时返回 None
+    """
+    if len(head) < 8 or head[4:8] != b"ftyp":
+        return None
+    pos = 0
+    while pos + 8 <= len(head):
+        size, box_type = struct.unpack(">I4s", head[pos:pos + 8])
+        header = 8
+        if size == 1:
+            if pos + 16 > len(head):
+                break
+            size = struct.unpack(">Q", head[pos + 8:pos + 16])[0]
+            header = 16
+        elif size == 0:
+            size = file_size - pos
+        if size < header:
+            return None
+        if box_type == b"moov":
+            if pos + size <= len(head):
+                return None
+            return pos, min(pos + size, file_size) - 1
+        pos += size
+    if pos >= file_size:
+        return None
+    # 文件头之后的下一个顶层 box（通常是 mdat 之后的 moov），其大小未知时一直取到文件末尾
+    return pos, file_size - 1
+
+
+class SeekIndexPrefetcher:
+    """按容器类型预取文件头与索引区间，并记住每个 media_id 的索引位置"""
+
+    def __init__(self):
+        self._hints: "OrderedDict[int, IndexRange]" = OrderedDict()
+        # 索引位置由文件头解析得到（而不是从播放器跳转记录）的 media_id
+        self._parsed: Set[int] = set()
+        self._recent: Dict[int, float] = {}
+        self._tasks: Dict[int, asyncio.Task] = {}
+        self.prefetches = 0
+        self.hinted_prefetches = 0
+        self.learned_hints = 0
+        self.failures = 0
+
+    def maybe_prefetch(
+        self,
+        streamer: ByteStreamer,
+        index: int,
+        file_id,
+        file_name: Optional[str],
+        from_bytes: int,
+        qos: str = QOS_INTERACTIVE,
+    ) -> None:
+        """观看请求从头打开容器文件时在后台预取文件头与索引区间（不等待结果）"""
+        if qos != QOS_INTERACTIVE or from_bytes != 0 or file_id.file_size <= TAIL_BYTES + CHUNK_SIZE:
+            return
+        # 预取的分块只能通过缓存被之后的请求使用
+        if not chunk_cache.max_bytes and not disk_cache.enabled:
+            return
+        container = detect_container(file_id.mime_type, file_name)
+        if not container:
+            return
+        media_id = file_id.media_id
+        now = time.time()
+        if media_id in self._tasks or now - self._recent.get(media_id, 0) < PREFETCH_INTERVAL:
+            return
+        self._recent[media_id] = now
+        if len(self._recent) > MAX_HINTS:
+            self._recent = {k: v for k, v in self._recent.items() if now - v < PREFETCH_INTERVAL}
+        task = asyncio.create_task(self._prefetch(streamer, index, file_id, container))
+        self._tasks[media_id] = task
+        task.add_done_callback(lambda _, m=media_id: self._tasks.pop(m, None))
+
+    def observe(self, file_id, file_name: Optional[str], from_bytes: int, qos: str = QOS_INTERACTIVE) -> None:
+        """
+        记录播放器跳转到文件末尾读取索引的位置（MKV 的 Cues、无法从文件头解析的 moov）
+        只记录观看请求；已记录的位置按更靠前的起点合并，已由文件头解析出的位置不再改变
+        """
+        if qos != QOS_INTERACTIVE:
+            return
+        file_size = file_id.file_size
+        media_id = file_id.media_id
+        if from_bytes <= 0 or from_bytes < file_size - MAX_INDEX_BYTES or media_id in self._parsed:
+            return
+        if not detect_container(file_id.mime_type, file_name):
+            return
+        hint = self._hints.get(media_id)
+        if hint and hint[0] <= from_bytes:
+            return
+        self._remember(media_id, (from_bytes, file_size - 1))
+        self.learned_hints += 1
+
+    def _remember(self, media_id: int, index_range: IndexRange, parsed: bool = False) -> None:
+        self._hints[media_id] = index_range
+        self._hints.move_to_end(media_id)
+        if parsed:
+            self._parsed.add(media_id)
+        while len(self._hints) > MAX_HINTS:
+            evicted, _ = self._hints.popitem(last=False)
+            self._parsed.discard(evicted)
+
+    async def _prefetch(self, streamer: ByteStreamer, index: int, file_id, container: str) -> None:
+        file_size = file_id.file_size
+        media_id = file_id.media_id
+        hint = self._hints.get(media_id)
+        try:
+            if hint and (container != "mp4" or media_id in self._parsed):
+                # 索引位置已知：文件头与索引一次性并行获取
+                await asyncio.gather(
+                    self._fetch_range(streamer, index, file_id, 0, CHUNK_SIZE - 1),
+                    self._fetch_range(streamer, index, file_id, *hint),
+                )
+                self.prefetches += 1
+                self.hinted_prefetches += 1
+                logger.debug(f"按记录的索引位置预取 media {media_id}: {hint}")
+                return
+
+            head = await self._fetch_range(streamer, index, file_id, 0, CHUNK_SIZE - 1, keep=True)
+            self.prefetches += 1
+            index_range = hint or (file_size - TAIL_BYTES, file_size - 1)
+            # 从播放器跳转记录的位置不一定准确，MP4 以解析文件头得到的 moov 位置为准
+            if container == "mp4" and head[4:8] == b"ftyp":
+                moov = find_mp4_index(head, file_size)
+                if moov is None:
+                    # moov 已在文件头中（faststart），不需要再获取文件末尾
+                    self._hints.pop(media_id, None)
+                    return
+                self._remember(media_id, moov, parsed=True)
+                index_range = moov
+                logger.debug(f"media {media_id} 的 moov 位于 {moov}")
+            elif hint:
+                self.hinted_prefetches += 1
+            await self._fetch_range(streamer, index, file_id, *index_range)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.failures += 1
+            logger.debug(f"预取 media {media_id} 的索引失败: {e}")
+
+    @staticmethod
+    async def _fetch_range(
+        streamer: ByteStreamer, index: int, file_id, start: int, end: int, keep: bool = False
+    ) -> bytes:
+        """获取 [start, end] 所在的分块（经过分块缓存与磁盘缓存），区间最多 MAX_INDEX_BYTES；keep 为真时返回数据"""
+        end = min(end, file_id.file_size - 1, start + MAX_INDEX_BYTES - 1)
+        offset = start - start % CHUNK_SIZE
+        part_count = end // CHUNK_SIZE - offset // CHUNK_SIZE + 1
+        data = bytearray()
+        async for chunk in streamer.yield_file(
+            file_id, index, offset, 0, CHUNK_SIZE, part_count, CHUNK_SIZE, QOS_BACKGROUND
+        ):
+            if keep:
+                data += chunk
+        return bytes(data)
+
+    def stats(self) -> dict:
+        """预取统计信息（用于 /api/status）"""
+        return {
+            "prefetches": self.prefetches,
+            "hinted_prefetches": self.hinted_prefetches,
+            "learned_hints": self.learned_hints,
+            "remembered_indexes": len(self._hints),
+            "inflight": len(self._tasks),
+            "failures": self.failures,
+        }
+
+
+seek_prefetcher = SeekIndexPrefetcher()
@@ -0,0 +1,292 @@
+"""
+媒体会话池（按机器人、按 DC）
+
+首次访问其他 DC 的文件时需要创建 Auth key 并 Export/ImportAuthorization，耗时可达数秒。
+已导入授权的 auth key 加密保存在 keystore 中，重启后直接复用。
+会话池在启动后于后台为每个机器人预先建立到其用过的所有 DC（tg_file_locations 中记录的 DC 与机器人自身 DC）
+的媒体会话，定期发送轻量 Ping 保活，发现失效的会话主动重建，并记录每个 DC 的会话状态供 API 查询。
+Ping 超时的会话先标记为 suspect：仍有在途请求时只在连续多次失败后才重建，避免中断正在 GetFile 的直链。
+直链请求只需从池中取用已就绪的会话，不再在首字节之前等待授权握手。
+"""
+import asyncio
+import logging
+import random
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional, Set, Tuple
+
+from pyrogram import Client, raw
+from pyrogram.errors import AuthBytesInvalid, AuthKeyInvalid, AuthKeyUnregistered, Unauthorized
+from pyrogram.session import Session, Auth
+
+from WebStreamer import Var
+from WebStreamer.bot import multi_clients
+from db import get_used_dc_ids
+from .keystore import media_keystore
+
+logger = logging.getLogger("streamer")
+
+# 保活 Ping 间隔与超时（秒）
+KEEPALIVE_INTERVAL = 60
+PING_TIMEOUT = 10
+# 有在途请求的会话连续 Ping 失败多少次后才重建
+SUSPECT_FAILURES = 3
+
+
+def is_session_usable(media_session: Session) -> bool:
+    """检查会话的连接状态和加密参数"""
+    try:
+        return bool(
+            hasattr(media_session, 'connection') and media_session.connection and
+            hasattr(media_session.connection, 'protocol') and media_session.connection.protocol and
+            hasattr(media_session.connection.protocol, 'encrypt') and
+            media_session.connection.protocol.encrypt is not None
+        )
+    except Exception:
+        return False
+
+
+class MediaSessionPool:
+    """管理所有机器人的媒体会话：按需创建、启动预热、保活与失效重建"""
+
+    def __init__(self):
+        # 创建会话的锁（按机器人 + DC），防止并发导出授权
+        self._locks: Dict[Tuple[Client, int], asyncio.Lock] = {}
+        # 每个机器人用到过的 DC
+        self._dcs: Dict[Client, Set[int]] = {}
+        # 会话状态：(客户端索引, DC) -> {state, last_ping_ms, last_error, updated_at}
+        self._states: Dict[Tuple[int, int], dict] = {}
+        # 客户端 -> 索引（避免每次更新状态时遍历 multi_clients）
+        self._indices: Dict[Client, int] = {}
+        # 在途请求数与连续 Ping 失败次数：(客户端, DC) -> 次数
+        self._in_flight: Dict[Tuple[Client, int], int] = {}
+        self._ping_failures: Dict[Tuple[Client, int], int] = {}
+        self._task = None
+
+    async def get(self, client: Client, dc_id: int) -> Session:
+        """获取指定机器人到指定 DC 的媒体会话，不存在或已失效时创建"""
+        self._dcs.setdefault(client, set()).add(dc_id)
+        media_session = client.media_sessions.get(dc_id, None)
+        if media_session is not None:
+            if is_session_usable(media_session):
+                logger.debug(f"Using cached media session for DC {dc_id}")
+                return media_session
+            logger.debug(f"Cached media session for DC {dc_id} is invalid, recreating...")
+            await self.discard(client, dc_id)
+
+        lock = self._locks.setdefault((client, dc_id), asyncio.Lock())
+        async with lock:
+            # 再次检查是否在等待期间已经创建了会话
+            media_session = client.media_sessions.get(dc_id, None)
+            if media_session is not None and is_session_usable(media_session):
+                logger.debug(f"Using newly created media session for DC {dc_id}")
+                return media_session
+
+            self._set_state(client, dc_id, "connecting")
+            try:
+                media_session = await self._create(client, dc_id)
+            except Exception as e:
+                self._set_state(client, dc_id, "failed", error=str(e))
+                raise
+            client.media_sessions[dc_id] = media_session
+            self._set_state(client, dc_id, "ready")
+            logger.debug(f"Created media session for DC {dc_id}")
+            return media_session
+
+    @contextmanager
+    def in_flight(self, client: Client, dc_id: int):
+        """标记一个正在使用该会话的请求（保活检查据此决定是否立即重建可疑会话）"""
+        key = (client, dc_id)
+        self._in_flight[key] = self._in_flight.get(key, 0) + 1
+        try:
+            yield
+        finally:
+            remaining = self._in_flight.get(key, 1) - 1
+            if remaining > 0:
+                self._in_flight[key] = remaining
+            else:
+                self._in_flight.pop(key, None)
+
+    async def discard(self, client: Client, dc_id: int) -> None:
+        """停止并移除失效的会话"""
+        self._ping_failures.pop((client, dc_id), None)
+        media_session = client.media_sessions.pop(dc_id, None)
+        if media_session is not None:
+            try:
+                await media_session.stop()
+            except Exception as stop_error:
+                logger.debug(f"停止媒体会话时出错（可能已断开）: {stop_error}")
+        self._set_state(client, dc_id, "closed")
+
+    async def _create(self, client: Client, dc_id: int) -> Session:
+        if dc_id == await client.storage.dc_id():
+            media_session = Session(
+                client,
+                dc_id,
+                await client.storage.auth_key(),
+                await client.storage.test_mode(),
+                is_media=True,
+            )
+            await media_session.start()
+            return media_session
+
+        test_mode = await client.storage.test_mode()
+        bot_token = getattr(client, "bot_token", None)
+
+        # 优先复用上次保存的、已导入授权的 auth key
+        stored_key = media_keystore.load(bot_token, dc_id, test_mode)
+        if stored_key:
+            media_session = Session(client, dc_id, stored_key, test_mode, is_media=True)
+            try:
+                await media_session.start()
+                # 需要授权的调用：密钥未注册或已失效时会被 Telegram 拒绝
+                await asyncio.wait_for(
+                    media_session.invoke(raw.functions.users.GetUsers(id=[raw.types.InputUserSelf()])),
+                    timeout=PING_TIMEOUT
+                )
+                logger.debug(f"Reused stored authorization for DC {dc_id}")
+                return media_session
+            except Exception as e:
+                try:
+                    await media_session.stop()
+                except Exception:
+                    pass
+                if isinstance(e, (AuthKeyUnregistered, AuthKeyInvalid, Unauthorized, AuthBytesInvalid)):
+                    logger.info(f"已保存的 DC {dc_id} 授权密钥已失效，重新创建: {type(e).__name__}")
+                    media_keystore.delete(bot_token, dc_id, test_mode)
+                else:
+                    # 超时、网络等临时错误：保留密钥供下次复用，本次改为新建授权
+                    logger.info(f"使用已保存的 DC {dc_id} 授权密钥失败，本次重新创建: {type(e).__name__}")
+
+        auth_key = await Auth(client, dc_id, test_mode).create()
+        media_session = Session(client, dc_id, auth_key, test_mode, is_media=True)
+        await media_session.start()
+
+        # 尝试导入授权，最多重试6次
+        for attempt in range(6):
+            try:
+                exported_auth = await client.invoke(
+                    raw.functions.auth.ExportAuthorization(dc_id=dc_id)
+                )
+                await media_session.invoke(
+                    raw.functions.auth.ImportAuthorization(
+                        id=exported_auth.id, bytes=exported_auth.bytes
+                    )
+                )
+                logger.debug(f"Successfully imported authorization for DC {dc_id} (attempt {attempt + 1})")
+                media_keystore.save(bot_token, dc_id, test_mode, auth_key)
+                return media_session
+            except AuthBytesInvalid as e:
+                logger.warning(f"Invalid authorization bytes for DC {dc_id} (attempt {attempt + 1}/6): {e}")
+            except Exception as e:
+                logger.error(f"Unexpected error during auth import for DC {dc_id}: {e}", exc_info=True)
+            if attempt < 5:
+                await asyncio.sleep(0.5 * (attempt + 1))
+
+        await media_session.stop()
+        raise AuthBytesInvalid(f"Failed to import authorization for DC {dc_id} after 6 attempts")
+
+    def start(self) -> None:
+        """启动后台预热与保活任务（重复调用无效）"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        await self.warmup()
+        while True:
+            await asyncio.sleep(KEEPALIVE_INTERVAL)
+            try:
+                await self.keepalive()
+            except Exception as e:
+                logger.warning(f"媒体会话保活检查出错: {e}")
+
+    async def warmup(self) -> None:
+        """为每个机器人建立到其用过的所有 DC 的媒体会话"""
+        try:
+            used_dcs = set(get_used_dc_ids(Var.BIN_CHANNEL)) if Var.BIN_CHANNEL else set()
+        except Exception as e:
+            logger.warning(f"读取已使用的 DC 列表失败: {e}")
+            used_dcs = set()
+
+        for index, client in list(multi_clients.items()):
+            self._indices[client] = index
+            try:
+                dcs = used_dcs | {await client.storage.dc_id()} | self._dcs.get(client, set())
+            except Exception as e:
+                logger.debug(f"客户端 {index} 无法获取所在 DC: {e}")
+                continue
+            for dc_id in sorted(dcs):
+                try:
+                    await self.get(client, dc_id)
+                except Exception as e:
+                    logger.warning(f"客户端 {index} 预热 DC {dc_id} 媒体会话失败: {e}")
+        logger.info(f"媒体会话预热完成: {self.stats()}")
+
+    async def keepalive(self) -> None:
+        """
+        对所有已建立的会话发送 Ping：已断开的会话立即重建；
+        Ping 失败的会话标记为 suspect，没有在途请求或连续失败 SUSPECT_FAILURES 次后才重建
+        """
+        for index, client in list(multi_clients.items()):
+            self._indices[client] = index
+            for dc_id in sorted(self._dcs.get(client, set())):
+                key = (client, dc_id)
+                media_session = client.media_sessions.get(dc_id, None)
+                started_at = time.monotonic()
+                try:
+                    if media_session is None or not is_session_usable(media_session):
+                        raise ConnectionError("会话不可用")
+                    await asyncio.wait_for(
+                        media_session.invoke(raw.functions.Ping(ping_id=random.randint(0, 2 ** 31 - 1))),
+                        timeout=PING_TIMEOUT
+                    )
+                    self._ping_failures.pop(key, None)
+                    self._set_state(client, dc_id, "ready", ping_ms=(time.monotonic() - started_at) * 1000)
+                except Exception as e:
+                    usable = media_session is not None and is_session_usable(media_session)
+                    failures = self._ping_failures.get(key, 0) + 1
+                    self._ping_failures[key] = failures
+                    if usable and self._in_flight.get(key, 0) > 0 and failures < SUSPECT_FAILURES:
+                        # 会话仍在为直链传输数据（Ping 可能只是排在 GetFile 之后），暂不打断
+                        logger.info(
+                            f"客户端 {index} 的 DC {dc_id} 媒体会话 Ping 失败 {failures}/{SUSPECT_FAILURES}，"
+                            f"有在途请求，暂不重建: {type(e).__name__}"
+                        )
+                        self._set_state(client, dc_id, "suspect", error=type(e).__name__)
+                        continue
+                    logger.info(f"客户端 {index} 的 DC {dc_id} 媒体会话失效，重建: {type(e).__name__}")
+                    await self.discard(client, dc_id)
+                    try:
+                        await self.get(client, dc_id)
+                    except Exception as create_error:
+                        logger.warning(f"客户端 {index} 重建 DC {dc_id} 媒体会话失败: {create_error}")
+
+    def _index_of(self, client: Client) -> Optional[int]:
+        index = self._indices.get(client)
+        if index is None:
+            index = next((i for i, c in multi_clients.items() if c is client), None)
+            if index is not None:
+                self._indices[client] = index
+        return index
+
+    def _set_state(self, client: Client, dc_id: int, state: str, error: str = None, ping_ms: float = None) -> None:
+        index = self._index_of(client)
+        if index is None:
+            return
+        info = self._states.setdefault((index, dc_id), {})
+        info["state"] = state
+        info["updated_at"] = int(time.time())
+        if error is not None:
+            info["last_error"] = error
+        if ping_ms is not None:
+            info["last_ping_ms"] = round(ping_ms, 1)
+
+    def stats(self) -> dict:
+        """各机器人各 DC 的会话状态（用于 /api/status）"""
+        result: Dict[str, dict] = {}
+        for (index, dc_id), info in sorted(self._states.items()):
+            result.setdefault(f"bot{index + 1}", {})[f"dc{dc_id}"] = dict(info)
+        return result
+
+
+media_session_pool = MediaSessionPool()
@@ -0,0 +1,48 @@
+"""
+直链传输统计
+
+记录直链响应的整体情况：正常完成/客户端中途断开的次数、实际发送的字节数，
+以及客户端断开时已经从 Telegram 获取但没能发送出去的字节数（预读窗口中已完成的分块、写入失败的分块），
+用于观察播放器拖动进度条、aria2 断开分段连接造成的浪费。
+"""
+
+
+class StreamStats:
+    """直链响应计数器（用于 /api/status）"""
+
+    def __init__(self):
+        self.active = 0
+        self.completed = 0
+        self.disconnected = 0
+        self.bytes_sent = 0
+        self.wasted_bytes = 0
+        self.cancelled_fetches = 0
+
+    def stream_started(self) -> None:
+        self.active += 1
+
+    def stream_finished(self, bytes_sent: int, disconnected: bool) -> None:
+        self.active -= 1
+        self.bytes_sent += bytes_sent
+        if disconnected:
+            self.disconnected += 1
+        else:
+            self.completed += 1
+
+    def record_wasted(self, wasted_bytes: int, cancelled_fetches: int = 0) -> None:
+        """记录已获取但未发送的字节数，以及被取消的在途分块请求数"""
+        self.wasted_bytes += wasted_bytes
+        self.cancelled_fetches += cancelled_fetches
+
+    def stats(self) -> dict:
+        return {
+            "active": self.active,
+            "completed": self.completed,
+            "disconnected": self.disconnected,
+            "bytes_sent": self.bytes_sent,
+            "wasted_bytes": self.wasted_bytes,
+            "cancelled_fetches": self.cancelled_fetches,
+        }
+
+
+stream_stats = StreamStats()
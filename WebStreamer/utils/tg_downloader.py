@@ -0,0 +1,445 @@
+"""
+进程内 Telegram 媒体下载器
+
+原先 Telegram 媒体是把直链交给 aria2，由 aria2 再通过 HTTP Range 请求回到本进程的 media_streamer，
+每个字节都要经过 MTProto → aiohttp → 本地回环 TCP → aria2 → 磁盘。
+这里直接用 GetFile 获取分块：分块轮流分配给所有可访问频道的机器人并行获取，
+用 os.pwrite 写入预先分配好大小的文件的对应偏移。
+进度写入同一张 downloads 表（同时触发 WebSocket 推送），完成后交给 aria2 下载处理器同样的完成流程，
+上传与清理阶段不受影响。HTTP、磁力与种子任务仍由 aria2 下载。
+
+每个下载在 download_chunks 表中记录已落盘分块的位图（先 fsync 再按批写入），
+进程重启后只重新获取缺失的 1 MiB 分块；未启用进程内下载时改由 aria2 重新下载该直链。
+网络中断等临时错误会在稍后按位图续传；多次重试仍失败时保留文件与分块日志，重试该下载时继续续传。
+"""
+import asyncio
+import logging
+import math
+import os
+import time
+import uuid
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from pyrogram.errors import FloodWait
+
+from WebStreamer import Var
+from WebStreamer.bot import multi_clients
+from db import (
+    update_download_progress, mark_download_failed, get_download_id_by_gid, update_download_gid,
+    save_download_journal, delete_download_journal, get_interrupted_downloads
+)
+from .admission import QOS_BULK, internal_link
+from .custom_dl import ByteStreamer, _StreamState
+from .scheduler import client_scheduler
+
+logger = logging.getLogger("streamer")
+
+# GetFile 分块大小（Telegram 允许的最大值）
+CHUNK_SIZE = 1024 * 1024
+# 下载进度写入数据库的间隔（秒）
+PROGRESS_INTERVAL = 3
+# 分块日志刷新间隔（秒）：先 fsync 文件，再写入这之前已完成写入的分块位图
+JOURNAL_FLUSH_INTERVAL = 10
+# 临时错误（网络中断、所有客户端暂时不可用）的续传次数与间隔（秒，按次数递增）
+RETRY_ATTEMPTS = 3
+RETRY_DELAY = 5
+
+CompletionHandler = Callable[[str, str, int], Awaitable[None]]
+
+
+class _TransientDownloadError(RuntimeError):
+    """可以稍后续传的错误（暂时没有可用的客户端、所有客户端都无法获取某个分块）"""
+
+
+class _NativeDownload:
+    """单个进程内下载任务的状态"""
+    __slots__ = (
+        "gid", "message_id", "path", "total_length", "completed_length", "sampled_length", "sampled_at",
+        "download_id", "bitmap", "cancelled", "task",
+    )
+
+    def __init__(self, gid: str, message_id: int, path: str, total_length: int):
+        self.gid = gid
+        self.message_id = message_id
+        self.path = path
+        self.total_length = total_length
+        self.completed_length = 0
+        # 上次写入进度时的已完成字节数与时间，用于计算速度
+        self.sampled_length = 0
+        self.sampled_at = time.monotonic()
+        self.download_id: Optional[int] = None
+        # 已写入分块的位图（续传时来自分块日志）
+        self.bitmap: Optional[bytearray] = None
+        # 由用户取消（区别于进程退出时任务被取消）
+        self.cancelled = False
+        self.task: Optional[asyncio.Task] = None
+
+    def has_part(self, part: int) -> bool:
+        return bool(self.bitmap[part >> 3] & (1 << (part & 7)))
+
+    def set_part(self, part: int) -> None:
+        self.bitmap[part >> 3] |= 1 << (part & 7)
+
+
+class TelegramDownloader:
+    """管理所有进程内 Telegram 下载任务"""
+
+    def __init__(self):
+        self._downloads: Dict[str, _NativeDownload] = {}
+        # 任务结束（完成、失败、取消）时调用，用于唤醒等待下载槽位的任务
+        self.on_finished: Optional[Callable[[], None]] = None
+
+    @staticmethod
+    def new_gid() -> str:
+        """生成与 aria2 GID 等长的 16 位任务 ID，tg 前缀（非十六进制）保证不会与 aria2 的 GID 冲突"""
+        return "tg" + uuid.uuid4().hex[:14]
+
+    @staticmethod
+    def is_native_gid(gid: Optional[str]) -> bool:
+        return bool(gid) and gid.startswith("tg")
+
+    def active_count(self) -> int:
+        """正在进行的进程内下载数量（计入下载并发槽位）"""
+        return len(self._downloads)
+
+    def is_active(self, gid: str) -> bool:
+        return gid in self._downloads
+
+    @staticmethod
+    def _target_path(save_dir: str, file_name: str) -> str:
+        """
+        创建并返回目标文件路径；同名文件已存在时与 aria2 一样追加 .1、.2 等后缀
+        文件在这里就创建出来，避免同时开始的同名下载选中同一路径
+        """
+        os.makedirs(save_dir, exist_ok=True)
+        file_name = os.path.basename(file_name) or "file"
+        name, ext = os.path.splitext(file_name)
+        suffix = 0
+        while True:
+            path = os.path.join(save_dir, file_name if suffix == 0 else f"{name}.{suffix}{ext}")
+            try:
+                os.close(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644))
+                return path
+            except FileExistsError:
+                suffix += 1
+
+    def start(
+        self,
+        message_id: int,
+        file_name: str,
+        save_dir: str,
+        on_complete: CompletionHandler,
+        gid: Optional[str] = None,
+    ) -> str:
+        """创建下载任务并在后台开始下载，返回任务 GID"""
+        gid = gid or self.new_gid()
+        path = self._target_path(save_dir, file_name)
+        download = _NativeDownload(gid, message_id, path, 0)
+        self._launch(download, on_complete)
+        logger.info(f"进程内下载已开始: {path} (消息 {message_id}, GID: {gid})")
+        return gid
+
+    def resume(self, journal: dict, on_complete: CompletionHandler) -> str:
+        """根据分块日志续传中断的下载（只获取位图中缺失的分块）"""
+        download = _NativeDownload(journal["gid"], journal["message_id"], journal["file_path"], journal["file_size"])
+        download.download_id = journal["download_id"]
+        if journal["chunk_size"] == CHUNK_SIZE:
+            download.bitmap = bytearray(journal["bitmap"])
+        self._launch(download, on_complete)
+        logger.info(f"进程内下载续传: {download.path} (消息 {download.message_id}, GID: {download.gid})")
+        return download.gid
+
+    def _launch(self, download: _NativeDownload, on_complete: CompletionHandler) -> None:
+        self._downloads[download.gid] = download
+        download.task = asyncio.create_task(self._run(download, on_complete))
+
+    async def cancel(self, gid: str) -> bool:
+        """取消下载并等待任务结束（删除未完成的文件与分块日志），任务不存在时返回 False"""
+        download = self._downloads.get(gid)
+        if download is None or download.task is None:
+            return False
+        download.cancelled = True
+        download.task.cancel()
+        await asyncio.wait({download.task})
+        return True
+
+    async def shutdown(self) -> None:
+        """进程退出前中断所有下载，等待它们把已写入的分块落盘并保存分块日志"""
+        tasks = [download.task for download in self._downloads.values() if download.task is not None]
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.wait(tasks)
+
+    async def resume_interrupted(self, aria2_client) -> None:
+        """
+        启动时续传重启前中断的下载：启用进程内下载时按分块日志只补齐缺失的分块，
+        否则删除未完成的文件，改由 aria2 重新下载该直链
+        """
+        try:
+            journals = get_interrupted_downloads()
+        except Exception as e:
+            logger.warning(f"读取下载分块日志失败: {e}")
+            return
+        for journal in journals:
+            if journal["gid"] in self._downloads:
+                continue
+            try:
+                if Var.NATIVE_DOWNLOAD and self.is_native_gid(journal["gid"]):
+                    self.resume(journal, aria2_client.download_handler.on_native_download_complete)
+                else:
+                    await self._requeue_with_aria2(journal, aria2_client)
+            except Exception as e:
+                logger.error(f"续传下载失败 (GID: {journal['gid']}): {e}", exc_info=True)
+
+    @staticmethod
+    async def _requeue_with_aria2(journal: dict, aria2_client) -> None:
+        # aria2 无法识别我们的位图（预分配的文件会被当成已下载完成），只能删除后完整重新下载
+        try:
+            os.unlink(journal["file_path"])
+        except OSError:
+            pass
+        delete_download_journal(journal["download_id"])
+        if not journal["source_url"]:
+            mark_download_failed(journal["gid"], "进程重启后无法续传：缺少直链")
+            return
+        result = await aria2_client.add_uri(
+            uris=[internal_link(journal["source_url"])],
+            options={
+                "dir": os.path.dirname(journal["file_path"]),
+                "out": os.path.basename(journal["file_path"]),
+            },
+        )
+        if result and "result" in result:
+            update_download_gid(journal["download_id"], result["result"])
+            logger.info(f"中断的下载已交给aria2重新下载: {journal['file_path']} (GID: {result['result']})")
+        else:
+            mark_download_failed(journal["gid"], "进程重启后交给aria2重新下载失败")
+
+    async def _run(self, download: _NativeDownload, on_complete: CompletionHandler) -> None:
+        try:
+            for attempt in range(RETRY_ATTEMPTS + 1):
+                try:
+                    await self._download(download)
+                    break
+                except Exception as e:
+                    if not self._is_retryable(e) or attempt >= RETRY_ATTEMPTS:
+                        raise
+                    delay = RETRY_DELAY * (attempt + 1)
+                    logger.warning(
+                        f"进程内下载出错，{delay} 秒后续传 ({attempt + 1}/{RETRY_ATTEMPTS}): "
+                        f"{download.path} (GID: {download.gid}): {e}"
+                    )
+                    await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            if download.cancelled:
+                logger.info(f"进程内下载已取消: {download.path} (GID: {download.gid})")
+                self._fail(download, "下载已取消")
+            else:
+                # 进程退出：保留文件与分块日志，下次启动时续传
+                logger.info(f"进程内下载已中断，下次启动时续传: {download.path} (GID: {download.gid})")
+            raise
+        except Exception as e:
+            logger.error(f"进程内下载失败: {download.path} (GID: {download.gid}): {e}", exc_info=True)
+            self._fail(download, str(e) or type(e).__name__, keep_partial=self._is_retryable(e))
+            return
+        finally:
+            self._downloads.pop(download.gid, None)
+            if self.on_finished is not None:
+                self.on_finished()
+
+        logger.info(f"进程内下载完成: {download.path} ({download.total_length} 字节, GID: {download.gid})")
+        try:
+            await on_complete(download.gid, download.path, download.total_length)
+        except Exception as e:
+            logger.error(f"处理进程内下载完成事件失败 (GID: {download.gid}): {e}", exc_info=True)
+
+    @staticmethod
+    def _is_retryable(error: BaseException) -> bool:
+        return isinstance(error, (_TransientDownloadError, ConnectionError, asyncio.TimeoutError, FloodWait))
+
+    @staticmethod
+    def _fail(download: _NativeDownload, error_message: str, keep_partial: bool = False) -> None:
+        """标记下载失败；keep_partial 时保留文件与分块日志，重试下载时按位图续传"""
+        if not keep_partial:
+            try:
+                os.unlink(download.path)
+            except OSError:
+                pass
+        if download.download_id is not None and not keep_partial:
+            try:
+                delete_download_journal(download.download_id)
+            except Exception as db_e:
+                logger.debug(f"删除下载分块日志失败: {db_e}")
+        try:
+            # 同时通知等待该任务的队列处理器
+            mark_download_failed(download.gid, error_message)
+        except Exception as db_e:
+            logger.warning(f"更新数据库下载失败状态出错: {db_e}")
+            _mark_task_failed(download.gid)
+
+    async def _download(self, download: _NativeDownload) -> None:
+        indices = [i for i in client_scheduler.candidates() if not client_scheduler.is_flooded(i)]
+        if not indices:
+            first = client_scheduler.pick()
+            if first is None:
+                raise _TransientDownloadError("没有可用的客户端")
+            indices = [first]
+
+        # 每个机器人使用自己解析得到的 file_reference
+        lanes = []
+        for index in indices:
+            streamer = ByteStreamer(multi_clients[index])
+            try:
+                file_id = await streamer.get_file_properties(download.message_id)
+            except Exception as e:
+                logger.debug(f"客户端 {index} 无法获取消息 {download.message_id} 的文件属性: {e}")
+                continue
+            lanes.append((index, streamer, file_id, await streamer.get_location(file_id)))
+        if not lanes:
+            raise RuntimeError(f"无法获取消息 {download.message_id} 的文件属性")
+
+        file_size = getattr(lanes[0][2], "file_size", 0) or 0
+        if file_size <= 0:
+            raise RuntimeError("文件大小未知")
+        part_count = math.ceil(file_size / CHUNK_SIZE)
+
+        # 位图与文件不匹配（文件大小变化、文件已不存在）时从头下载
+        if (
+            download.bitmap is None
+            or download.total_length != file_size
+            or len(download.bitmap) != (part_count + 7) // 8
+            or not os.path.exists(download.path)
+        ):
+            download.bitmap = bytearray((part_count + 7) // 8)
+        download.total_length = file_size
+        missing = [part for part in range(part_count) if not download.has_part(part)]
+        download.completed_length = sum(
+            min(CHUNK_SIZE, file_size - part * CHUNK_SIZE) for part in range(part_count) if download.has_part(part)
+        )
+        download.sampled_length = download.completed_length
+        if download.download_id is None:
+            download.download_id = get_download_id_by_gid(download.gid)
+        if download.completed_length:
+            logger.info(f"续传 {download.path}: 已有 {part_count - len(missing)}/{part_count} 个分块，获取剩余 {len(missing)} 个")
+
+        fd = os.open(download.path, os.O_RDWR | os.O_CREAT, 0o644)
+        states: List[_StreamState] = [_StreamState(index, streamer.client, QOS_BULK) for index, streamer, _, _ in lanes]
+        reporter = asyncio.create_task(self._report_progress(download, fd))
+        try:
+            # 预先分配文件大小，分块可以乱序写入各自的偏移（不会清除已写入的数据）
+            if hasattr(os, "posix_fallocate"):
+                try:
+                    os.posix_fallocate(fd, 0, file_size)
+                except OSError:
+                    os.ftruncate(fd, file_size)
+            else:
+                os.ftruncate(fd, file_size)
+            self._save_journal(download, bytes(download.bitmap))
+
+            loop = asyncio.get_event_loop()
+            parts = iter(missing)
+
+            async def fetch(part: int) -> bytes:
+                offset = part * CHUNK_SIZE
+                for attempt in range(len(lanes)):
+                    lane = (part + attempt) % len(lanes)
+                    _, streamer, file_id, location = lanes[lane]
+                    chunk = await streamer.fetch_part(states[lane], file_id, location, offset, CHUNK_SIZE)
+                    if chunk:
+                        return chunk
+                raise _TransientDownloadError(f"所有客户端都无法获取文件块 (offset: {offset})")
+
+            async def worker() -> None:
+                for part in parts:
+                    chunk = await fetch(part)
+                    expected = min(CHUNK_SIZE, file_size - part * CHUNK_SIZE)
+                    if len(chunk) < expected:
+                        raise RuntimeError(f"文件块不完整 (offset: {part * CHUNK_SIZE}, {len(chunk)}/{expected})")
+                    await loop.run_in_executor(None, os.pwrite, fd, memoryview(chunk)[:expected], part * CHUNK_SIZE)
+                    download.set_part(part)
+                    download.completed_length += expected
+
+            workers = [
+                asyncio.create_task(worker())
+                for _ in range(min(len(missing), len(lanes) * Var.DOWNLOAD_CONCURRENCY))
+            ]
+            try:
+                await asyncio.gather(*workers)
+            except (Exception, asyncio.CancelledError):
+                if not download.cancelled:
+                    # 进程退出或出错前把已写入的分块落盘并记录，续传时只获取缺失的分块
+                    # fsync 放到线程池执行，不阻塞事件循环上的其他直链；shield 避免再次取消时中断落盘
+                    snapshot = bytes(download.bitmap)
+                    await asyncio.shield(loop.run_in_executor(None, os.fsync, fd))
+                    self._save_journal(download, snapshot)
+                raise
+            finally:
+                for task in workers:
+                    task.cancel()
+            await loop.run_in_executor(None, os.fsync, fd)
+        finally:
+            reporter.cancel()
+            os.close(fd)
+            for state in states:
+                state.release()
+        self._write_progress(download)
+        if download.download_id is not None:
+            try:
+                delete_download_journal(download.download_id)
+            except Exception as e:
+                logger.debug(f"删除下载分块日志失败: {e}")
+
+    async def _report_progress(self, download: _NativeDownload, fd: int) -> None:
+        loop = asyncio.get_event_loop()
+        last_flush = time.monotonic()
+        while True:
+            await asyncio.sleep(PROGRESS_INTERVAL)
+            self._write_progress(download)
+            if time.monotonic() - last_flush >= JOURNAL_FLUSH_INTERVAL:
+                # 快照之前完成的 pwrite 都会被随后的 fsync 落盘，位图不会记录尚未落盘的分块
+                snapshot = bytes(download.bitmap)
+                await loop.run_in_executor(None, os.fsync, fd)
+                self._save_journal(download, snapshot)
+                last_flush = time.monotonic()
+
+    @staticmethod
+    def _save_journal(download: _NativeDownload, bitmap: bytes) -> None:
+        if download.download_id is None:
+            return
+        try:
+            save_download_journal(
+                download.download_id, download.message_id, download.path,
+                download.total_length, CHUNK_SIZE, bitmap,
+            )
+        except Exception as e:
+            logger.warning(f"保存下载分块日志失败 (GID: {download.gid}): {e}")
+
+    @staticmethod
+    def _write_progress(download: _NativeDownload) -> None:
+        now = time.monotonic()
+        speed = int((download.completed_length - download.sampled_length) / max(now - download.sampled_at, 1e-6))
+        download.sampled_length = download.completed_length
+        download.sampled_at = now
+        try:
+            update_download_progress(
+                download.gid,
+                completed_length=download.completed_length,
+                total_length=download.total_length or None,
+                download_speed=speed,
+            )
+        except Exception:
+            # 静默失败，不影响下载
+            pass
+
+
+def _mark_task_failed(gid: str) -> None:
+    """数据库不可用时直接通知等待该任务的队列处理器：任务已失败，不再等待"""
+    try:
+        from WebStreamer.bot.plugins.stream_modules.task_tracker import mark_task_status
+        mark_task_status(gid, 'failed')
+    except Exception as e:
+        logger.debug(f"更新任务完成跟踪状态失败: {e}")
+
+
+tg_downloader = TelegramDownloader()
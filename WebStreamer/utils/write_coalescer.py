@@ -0,0 +1,58 @@
+"""
+直链写出合并
+
+分块生成器输出的是 1 MiB 分块或其 memoryview 切片。大块按套接字发送缓冲区大小切成 memoryview 依次写出
+（一次写入基本都能被内核直接接收，传输层不必再把剩余部分复制到自己的缓冲区）；
+首尾裁剪后只剩几 KB 的小块则先合并，凑够一个发送缓冲区大小再写，避免大量零碎的小写入。
+"""
+import socket
+from typing import Awaitable, Callable, Optional, Union
+
+# 写入大小范围（按 SO_SNDBUF 取值后限制在此范围内）
+MIN_WRITE_SIZE = 64 * 1024
+MAX_WRITE_SIZE = 1024 * 1024
+DEFAULT_WRITE_SIZE = 256 * 1024
+
+Buffer = Union[bytes, bytearray, memoryview]
+
+
+def socket_write_size(sock: Optional[socket.socket]) -> int:
+    """按套接字发送缓冲区大小确定单次写入大小"""
+    if sock is None:
+        return DEFAULT_WRITE_SIZE
+    try:
+        size = sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)
+    except (OSError, AttributeError):
+        return DEFAULT_WRITE_SIZE
+    return max(MIN_WRITE_SIZE, min(MAX_WRITE_SIZE, size))
+
+
+class WriteCoalescer:
+    """把输出数据整理成与发送缓冲区对齐的写入：大块零复制切片，小块合并"""
+
+    def __init__(self, write: Callable[[Buffer], Awaitable[None]], write_size: int = DEFAULT_WRITE_SIZE):
+        self._write = write
+        self.write_size = write_size
+        self._buffer = bytearray()
+
+    @property
+    def buffered(self) -> int:
+        """已合并但尚未写出的字节数"""
+        return len(self._buffer)
+
+    async def write(self, data: Buffer) -> None:
+        view = memoryview(data)
+        if len(view) < self.write_size:
+            # 小块：复制进合并缓冲区（最多一个写入大小）
+            self._buffer += view
+            if len(self._buffer) >= self.write_size:
+                await self.flush()
+            return
+        await self.flush()
+        for start in range(0, len(view), self.write_size):
+            await self._write(view[start:start + self.write_size])
+
+    async def flush(self) -> None:
+        if self._buffer:
+            buffer, self._buffer = self._buffer, bytearray()
+            await self._write(buffer)
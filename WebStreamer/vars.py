@@ -8,7 +8,12 @@ from configer import (
     STREAM_HAS_SSL, STREAM_NO_PORT, STREAM_FQDN,
     STREAM_KEEP_ALIVE, STREAM_PING_INTERVAL, STREAM_USE_SESSION_FILE,
     STREAM_ALLOWED_USERS, BIN_CHANNEL, ENABLE_STREAM, STREAM_AUTO_DOWNLOAD,
-    SEND_STREAM_LINK, ADMIN_ID, STREAM_MULTI_CLIENT, MULTI_BOT_TOKENS
+    SEND_STREAM_LINK, ADMIN_ID, STREAM_MULTI_CLIENT, MULTI_BOT_TOKENS,
+    STREAM_PREFETCH_MIN, STREAM_PREFETCH_MAX, STREAM_STRIPED,
+    STREAM_CHUNK_CACHE_MB, STREAM_NATIVE_DOWNLOAD, STREAM_DOWNLOAD_CONCURRENCY,
+    STREAM_DISK_CACHE_MB, STREAM_DISK_CACHE_DIR,
+    STREAM_MAX_STREAMS, STREAM_MAX_STREAMS_PER_IP, STREAM_QUEUE_SIZE, STREAM_QUEUE_TIMEOUT,
+    STREAM_BOT_CHUNK_BUDGET, STREAM_TRUSTED_PROXIES
 )
 
 
@@ -41,4 +46,25 @@ class Var(object):
     AUTO_DOWNLOAD = STREAM_AUTO_DOWNLOAD if STREAM_AUTO_DOWNLOAD else True
     SEND_STREAM_LINK = SEND_STREAM_LINK if SEND_STREAM_LINK else False
     ADMIN_ID = ADMIN_ID
+    # 预读窗口（同时在途的分块数），MIN 至少为 1
+    PREFETCH_MIN = max(1, int(STREAM_PREFETCH_MIN or 2))
+    PREFETCH_MAX = max(PREFETCH_MIN, int(STREAM_PREFETCH_MAX or 8))
+    # 多机器人条带化传输
+    STRIPED = bool(STREAM_STRIPED)
+    # 最近分块内存缓存大小（MB）
+    CHUNK_CACHE_MB = max(0, int(STREAM_CHUNK_CACHE_MB if STREAM_CHUNK_CACHE_MB is not None else 64))
+    # Telegram 媒体使用进程内下载器，以及每个机器人同时在途的分块数
+    NATIVE_DOWNLOAD = bool(STREAM_NATIVE_DOWNLOAD)
+    DOWNLOAD_CONCURRENCY = max(1, int(STREAM_DOWNLOAD_CONCURRENCY or 4))
+    # 磁盘分块缓存大小（MB，0 表示不启用）与目录（为空时使用数据库目录下的 segment_cache）
+    DISK_CACHE_MB = max(0, int(STREAM_DISK_CACHE_MB or 0))
+    DISK_CACHE_DIR = str(STREAM_DISK_CACHE_DIR or '')
+    # 直链准入控制（0 表示不限制）与每个机器人的在途分块预算
+    MAX_STREAMS = max(0, int(STREAM_MAX_STREAMS or 0))
+    MAX_STREAMS_PER_IP = max(0, int(STREAM_MAX_STREAMS_PER_IP or 0))
+    STREAM_QUEUE_SIZE = max(0, int(STREAM_QUEUE_SIZE or 0))
+    STREAM_QUEUE_TIMEOUT = max(0.0, float(STREAM_QUEUE_TIMEOUT or 0))
+    BOT_CHUNK_BUDGET = max(0, int(STREAM_BOT_CHUNK_BUDGET or 0))
+    # 可信反向代理（IP 或网段），来自这些地址的请求按 X-Forwarded-For 识别客户端 IP
+    TRUSTED_PROXIES = [str(proxy).strip() for proxy in (STREAM_TRUSTED_PROXIES or []) if str(proxy).strip()]
 
@@ -975,6 +975,13 @@ async def main():
             except Exception as e:
                 log.warning(f'设置aria2客户端失败: {e}')
             
+            # 续传重启前中断的进程内 Telegram 下载（按分块日志只获取缺失的分块）
+            try:
+                from WebStreamer.utils.tg_downloader import tg_downloader
+                asyncio.create_task(tg_downloader.resume_interrupted(client))
+            except Exception as e:
+                log.warning(f'续传中断的下载失败: {e}')
+            
             if Var and Var.KEEP_ALIVE and utils:
                 asyncio.create_task(utils.ping_server())
             
@@ -988,16 +995,28 @@ async def main():
 
 async def cleanup():
     """清理资源"""
+    if ENABLE_STREAM:
+        try:
+            # 中断进程内下载并等待分块日志保存完毕，下次启动时续传
+            from WebStreamer.utils.tg_downloader import tg_downloader
+            await tg_downloader.shutdown()
+        except Exception as e:
+            log.warning(f"停止进程内下载时出错: {e}")
     if stream_server:
         await stream_server.cleanup()
+    try:
+        # 关闭 aria2 RPC 的 HTTP 后备通道会话
+        await client.close_http_session()
+    except Exception as e:
+        log.warning(f"关闭aria2 HTTP会话时出错: {e}")
     if ENABLE_STREAM:
         try:
             # 停止所有客户端（包括多客户端模式下的额外客户端）
             from WebStreamer.bot import multi_clients
-            for index, client in multi_clients.items():
+            for index, tg_client in multi_clients.items():
                 try:
-                    if client and client.is_connected:
-                        await client.stop()
+                    if tg_client and tg_client.is_connected:
+                        await tg_client.stop()
                         log.info(f"客户端 {index} 已停止")
                 except Exception as e:
                     log.warning(f"停止客户端 {index} 时出错: {e}")
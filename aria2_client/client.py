@@ -4,8 +4,9 @@ Aria2 WebSocket客户端核心模块
 import asyncio
 import base64
 import json
+import time
 import uuid
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Tuple
 
 import aiohttp
 import websockets
@@ -13,8 +14,49 @@ import websockets
 from configer import get_config_value
 
 from .download_handler import DownloadHandler
+from .slots import DownloadSlots
 from .upload_handler import UploadHandler
 
+# WebSocket RPC 等待响应的超时时间(秒)
+WS_RPC_TIMEOUT = 15
+# 可以在 WebSocket 重连后重新发送的方法(只读或重复执行无副作用)；其余方法断线时直接失败，避免重复添加任务
+REPLAYABLE_METHODS = {
+    'aria2.tellStatus', 'aria2.tellActive', 'aria2.tellWaiting', 'aria2.tellStopped',
+    'aria2.getGlobalOption', 'aria2.getVersion', 'aria2.changeGlobalOption',
+    'aria2.pause', 'aria2.unpause', 'system.multicall',
+}
+# 释放下载槽位的通知(移除任务时 aria2 发送 onDownloadStop)
+SLOT_RELEASE_EVENTS = {'aria2.onDownloadComplete', 'aria2.onDownloadError', 'aria2.onDownloadStop'}
+# RPC_URL 解析结果的缓存时间(秒)，过期后重新读取配置，热重载修改 RPC_URL 后最多延迟这么久生效
+RPC_ENDPOINT_TTL = 30
+
+
+class Aria2RPCError(Exception):
+    """aria2 RPC 返回错误"""
+
+    def __init__(self, method: str, error: dict):
+        self.code = error.get('code')
+        super().__init__(f"{method} 失败: {error.get('message', error)} (code: {self.code})")
+
+
+def resolve_rpc_url(rpc_url: str) -> str:
+    """把配置中的 RPC_URL(host:port/path)转换为完整的 HTTP 地址"""
+    # 从RPC_URL中提取主机和端口
+    url_parts = rpc_url.split('/')
+    host_port = url_parts[0]
+    path = '/'.join(url_parts[1:])
+
+    # 如果主机名不是localhost或IP地址，则在Docker环境中使用localhost
+    if ':' in host_port:
+        host, port = host_port.split(':')
+        if not (host == 'localhost' or host == '127.0.0.1' or all(c.isdigit() or c == '.' for c in host)):
+            # 在Docker环境中，使用localhost
+            host = 'localhost'
+        host_port = f"{host}:{port}"
+
+    # 重新构建完整URL
+    return f"http://{host_port}/{path}"
+
 
 class AsyncAria2Client:
     """Aria2异步WebSocket客户端"""
@@ -39,7 +81,22 @@ class AsyncAria2Client:
         
         # 轮询相关
         self.polling_task = None  # 轮询任务
+        self.progress_task = None  # 聚合进度轮询任务
         self.is_polling = False   # 轮询状态标志
+
+        # HTTP RPC：复用同一个 keep-alive 会话，RPC 地址解析结果带过期时间缓存
+        self._http_session: Optional[aiohttp.ClientSession] = None
+        self._rpc_endpoint: Optional[Tuple[str, float]] = None
+        # 同一轮事件循环中发起的只读查询合并为一次 system.multicall
+        self._pending_calls: List[Tuple[str, list, asyncio.Future]] = []
+        self._batch_scheduled = False
+        # WebSocket RPC：按请求 id 关联响应，id -> (等待响应的 future, 请求体)
+        self._ws_pending: Dict[str, Tuple[asyncio.Future, dict]] = {}
+        # aria2 通知按到达顺序由单独的任务处理，监听循环不会因处理函数等待 RPC 响应而阻塞
+        self._event_queue: Optional[asyncio.Queue] = None
+        self._event_task = None
+        # 下载槽位计数：添加任务前等待空闲槽位，无需轮询 aria2
+        self.download_slots = DownloadSlots()
         
         # 初始化处理器
         self.upload_handler = UploadHandler(bot, self.progress_cache)
@@ -75,6 +132,8 @@ class AsyncAria2Client:
             self.websocket = await websockets.connect(full_ws_url, ping_interval=30)
             print("WebSocket连接成功")
             asyncio.ensure_future(self.listen())
+            # 断线期间未完成的可重放请求在新连接上重新发送
+            await self._replay_ws_pending()
             
             # 启动轮询任务
             await self.start_polling()
@@ -83,31 +142,144 @@ class AsyncAria2Client:
             await self.re_connect()
 
     async def listen(self):
-        """监听WebSocket消息"""
+        """监听WebSocket消息：RPC 响应交给对应的 future，通知放入事件队列按顺序处理"""
+        if self._event_task is None or self._event_task.done():
+            self._event_queue = asyncio.Queue()
+            self._event_task = asyncio.ensure_future(self._process_events())
         try:
             async for message in self.websocket:
                 result = json.loads(message)
                 if 'id' in result and result['id'] is None:
                     continue
+                pending = self._ws_pending.pop(result.get('id'), None) if 'id' in result else None
+                if pending is not None:
+                    future, _ = pending
+                    if not future.done():
+                        future.set_result(result)
+                    continue
                 print(f'rec message:{message}')
-                if 'error' in result:
-                    err_msg = result['error']['message']
-                    err_code = result['error']['code']
-                elif 'method' in result:
-                    method_name = result['method']
-                    if method_name == 'aria2.onDownloadStart':
-                        await self.download_handler.on_download_start(result, self.tell_status)
-                    elif method_name == 'aria2.onDownloadComplete':
-                        await self.download_handler.on_download_complete(result, self.tell_status)
-                    elif method_name == 'aria2.onDownloadError':
-                        await self.download_handler.on_download_error(result, self.tell_status)
-                    elif method_name == 'aria2.onDownloadPause':
-                        await self.download_handler.on_download_pause(result, self.tell_status)
+                if 'method' in result:
+                    # 槽位在收到通知时立即更新，不等前面的通知处理完(完成事件会等待上传)
+                    self._update_slots(result)
+                    self._event_queue.put_nowait(result)
         except websockets.exceptions.ConnectionClosedError:
             print("WebSocket连接已关闭")
+            self._on_ws_closed()
             # 停止轮询
             await self.stop_polling()
             await self.re_connect()
+        else:
+            self._on_ws_closed()
+
+    async def _process_events(self):
+        """按到达顺序处理 aria2 通知"""
+        while True:
+            result = await self._event_queue.get()
+            method_name = result['method']
+            try:
+                if method_name == 'aria2.onDownloadStart':
+                    await self.download_handler.on_download_start(result, self.tell_status)
+                elif method_name == 'aria2.onDownloadComplete':
+                    await self.download_handler.on_download_complete(result, self.tell_status)
+                elif method_name == 'aria2.onDownloadError':
+                    await self.download_handler.on_download_error(result, self.tell_status)
+                elif method_name == 'aria2.onDownloadPause':
+                    await self.download_handler.on_download_pause(result, self.tell_status)
+                elif method_name == 'aria2.onDownloadStop':
+                    await self.download_handler.on_download_stop(result)
+            except Exception as e:
+                print(f"处理aria2通知 {method_name} 出错: {e}")
+
+    def _update_slots(self, result: dict):
+        """按 aria2 通知登记或释放下载槽位"""
+        try:
+            gid = result['params'][0]['gid']
+        except (KeyError, IndexError, TypeError):
+            return
+        if result['method'] == 'aria2.onDownloadStart':
+            self.download_slots.track(gid)
+        elif result['method'] in SLOT_RELEASE_EVENTS:
+            self.download_slots.release(gid)
+
+    async def reconcile_download_slots(self):
+        """按 aria2 实际的活动与等待中任务校准下载槽位计数(启动时与定时轮询时调用)"""
+        from .constants import SLOT_RECONCILE_WAITING_LIMIT
+        self.download_slots.begin_reconcile()
+        active_tasks, waiting_tasks = await asyncio.gather(
+            self.tell_active(['gid']),
+            self.tell_waiting(0, SLOT_RECONCILE_WAITING_LIMIT, ['gid']),
+        )
+        drift = self.download_slots.reconcile(task['gid'] for task in active_tasks + waiting_tasks)
+        if drift:
+            print(f"[槽位] 校准下载槽位计数，偏差 {drift} 个任务，当前 {len(active_tasks) + len(waiting_tasks)} 个")
+
+    def _ws_connected(self) -> bool:
+        """WebSocket 是否处于可发送状态"""
+        ws = self.websocket
+        if ws is None:
+            return False
+        is_open = getattr(ws, 'open', None)
+        if is_open is not None:
+            return bool(is_open)
+        return getattr(ws, 'close_code', None) is None
+
+    def _on_ws_closed(self):
+        """连接断开：不可重放的请求立即失败，可重放的请求保留到重连后重新发送"""
+        for rpc_id, (future, body) in list(self._ws_pending.items()):
+            if body.get('method') not in REPLAYABLE_METHODS:
+                self._ws_pending.pop(rpc_id, None)
+                if not future.done():
+                    future.set_exception(ConnectionError(f"aria2 WebSocket 连接已断开 ({body.get('method')})"))
+
+    async def _replay_ws_pending(self):
+        """在新连接上重新发送断线前未收到响应的请求"""
+        if not self._ws_pending:
+            return
+        print(f"重新发送 {len(self._ws_pending)} 个未完成的 RPC 请求")
+        for rpc_id, (future, body) in list(self._ws_pending.items()):
+            if future.done():
+                self._ws_pending.pop(rpc_id, None)
+                continue
+            try:
+                await self.websocket.send(json.dumps(body))
+            except Exception as e:
+                print(f"重新发送 RPC 请求失败: {e}")
+                return
+
+    async def call(self, rpc_body: dict, timeout: float = WS_RPC_TIMEOUT) -> dict:
+        """
+        发送 RPC 请求并返回完整响应(包含 result 或 error)
+        优先通过已建立的 WebSocket 发送，按请求 id 等待响应；WebSocket 不可用时使用 HTTP。
+        可重放的方法在超时或发送失败时改用 HTTP 重试，其余方法超时抛出 asyncio.TimeoutError。
+        """
+        method = rpc_body.get('method')
+        replayable = method in REPLAYABLE_METHODS
+        if not self._ws_connected():
+            return await self.post_body(rpc_body)
+
+        rpc_id = rpc_body['id']
+        future = asyncio.get_event_loop().create_future()
+        self._ws_pending[rpc_id] = (future, rpc_body)
+        try:
+            await self.websocket.send(json.dumps(rpc_body))
+        except Exception as e:
+            self._ws_pending.pop(rpc_id, None)
+            print(f"WebSocket 发送 {method} 失败，改用HTTP: {e}")
+            return await self.post_body(rpc_body)
+
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            if future.done() and not future.cancelled():
+                return future.result()
+            if not replayable:
+                raise
+            print(f"WebSocket RPC {method} 超时，改用HTTP")
+            return await self.post_body(rpc_body)
+        finally:
+            self._ws_pending.pop(rpc_id, None)
+            if not future.done():
+                future.cancel()
 
     def parse_json_to_str(self, method, params):
         """将RPC方法和参数转换为JSON字符串"""
@@ -141,7 +313,9 @@ class AsyncAria2Client:
 
         rpc_body = self.get_rpc_body('aria2.addUri', params)
         print(rpc_body)
-        result = await self.post_body(rpc_body)
+        result = await self.call(rpc_body)
+        if result and 'result' in result:
+            self.download_slots.acquire(result['result'])
         
         return result
 
@@ -172,7 +346,10 @@ class AsyncAria2Client:
             params.append([999])
 
         rpc_body = self.get_rpc_body('aria2.addTorrent', params)
-        return await self.post_body(rpc_body)
+        result = await self.call(rpc_body)
+        if result and 'result' in result:
+            self.download_slots.acquire(result['result'])
+        return result
 
     async def tell_status(self, gid):
         """
@@ -184,14 +361,37 @@ class AsyncAria2Client:
         Returns:
             dict: 任务状态信息
         """
-        params = [gid]
-        rpc_body = self.get_rpc_body('aria2.tellStatus', params)
-        data = await self.post_body(rpc_body)
-        return data['result']
+        return await self.batched_call('aria2.tellStatus', [gid])
+
+    def rpc_endpoint(self) -> str:
+        """返回 aria2 HTTP RPC 地址(动态读取 RPC_URL 配置，按 RPC_ENDPOINT_TTL 缓存)"""
+        now = time.monotonic()
+        if self._rpc_endpoint is None or now - self._rpc_endpoint[1] > RPC_ENDPOINT_TTL:
+            rpc_url = get_config_value('RPC_URL', 'localhost:6800/jsonrpc')
+            full_url = resolve_rpc_url(rpc_url)
+            if self._rpc_endpoint is None or self._rpc_endpoint[0] != full_url:
+                print(f"aria2 RPC 地址: {full_url}")
+            self._rpc_endpoint = (full_url, now)
+        return self._rpc_endpoint[0]
+
+    def _get_http_session(self) -> aiohttp.ClientSession:
+        """获取(必要时创建)持久的 HTTP 会话，连接保持 keep-alive 复用"""
+        if self._http_session is None or self._http_session.closed:
+            self._http_session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=8, keepalive_timeout=60),
+                timeout=aiohttp.ClientTimeout(total=30),
+            )
+        return self._http_session
+
+    async def close_http_session(self):
+        """关闭 HTTP 会话"""
+        if self._http_session is not None and not self._http_session.closed:
+            await self._http_session.close()
+        self._http_session = None
 
     async def post_body(self, rpc_body):
         """
-        发送RPC请求
+        通过 HTTP 发送RPC请求(WebSocket 不可用时的后备通道，见 call)
         
         Args:
             rpc_body: RPC请求体
@@ -199,28 +399,73 @@ class AsyncAria2Client:
         Returns:
             dict: RPC响应
         """
-        # 动态从数据库读取RPC_URL配置
-        rpc_url = get_config_value('RPC_URL', 'localhost:6800/jsonrpc')
-        # 从RPC_URL中提取主机和端口
-        url_parts = rpc_url.split('/')
-        host_port = url_parts[0]
-        path = '/'.join(url_parts[1:])
-        
-        # 如果主机名不是localhost或IP地址，则在Docker环境中使用localhost
-        if ':' in host_port:
-            host, port = host_port.split(':')
-            if not (host == 'localhost' or host == '127.0.0.1' or all(c.isdigit() or c == '.' for c in host)):
-                # 在Docker环境中，使用localhost
-                host = 'localhost'
-            host_port = f"{host}:{port}"
-        
-        # 重新构建完整URL
-        full_url = f"http://{host_port}/{path}"
+        session = self._get_http_session()
+        try:
+            async with session.post(self.rpc_endpoint(), json=rpc_body) as response:
+                return await response.json(content_type=None)
+        except aiohttp.ClientConnectionError:
+            # 连接失败时重新读取 RPC_URL，下一次请求使用最新配置
+            self._rpc_endpoint = None
+            raise
+
+    async def batched_call(self, method: str, params: list):
+        """
+        发起只读查询并返回 result；同一轮事件循环中的多个查询合并为一次 system.multicall
         
-        print(f"连接到aria2 RPC: {full_url}")
-        async with aiohttp.ClientSession() as session:
-            async with session.post(full_url, json=rpc_body) as response:
-                return await response.json()
+        Raises:
+            Aria2RPCError: aria2 返回错误
+        """
+        future = asyncio.get_event_loop().create_future()
+        self._pending_calls.append((method, params, future))
+        if not self._batch_scheduled:
+            self._batch_scheduled = True
+            asyncio.get_event_loop().call_soon(lambda: asyncio.ensure_future(self._flush_batch()))
+        return await future
+
+    async def _flush_batch(self):
+        """发送积累的查询：只有一个时直接调用，多个时使用 system.multicall"""
+        calls, self._pending_calls = self._pending_calls, []
+        self._batch_scheduled = False
+        calls = [call for call in calls if not call[2].done()]
+        if not calls:
+            return
+        try:
+            if len(calls) == 1:
+                method, params, future = calls[0]
+                data = await self.call(self.get_rpc_body(method, params))
+                if 'error' in data:
+                    future.set_exception(Aria2RPCError(method, data['error']))
+                else:
+                    future.set_result(data['result'])
+                return
+
+            multicall = [
+                {'methodName': method, 'params': [f'token:{self.rpc_secret}'] + params}
+                for method, params, _ in calls
+            ]
+            data = await self.call({
+                'jsonrpc': '2.0',
+                'id': str(uuid.uuid4()),
+                'method': 'system.multicall',
+                'params': [multicall],
+            })
+            if 'error' in data:
+                for method, _, future in calls:
+                    if not future.done():
+                        future.set_exception(Aria2RPCError(method, data['error']))
+                return
+            # 成功的调用返回 [结果]，失败的调用返回 {code, message}
+            for (method, _, future), item in zip(calls, data['result']):
+                if future.done():
+                    continue
+                if isinstance(item, list) and item:
+                    future.set_result(item[0])
+                else:
+                    future.set_exception(Aria2RPCError(method, item if isinstance(item, dict) else {}))
+        except Exception as e:
+            for _, _, future in calls:
+                if not future.done():
+                    future.set_exception(e)
 
     async def re_connect(self):
         """重新连接到WebSocket服务器"""
@@ -233,66 +478,55 @@ class AsyncAria2Client:
 
     async def tell_stopped(self, offset: int, num: int):
         """获取已停止的任务列表"""
-        params = [
-            offset, num
-        ]
-        rpc_body = self.get_rpc_body('aria2.tellStopped', params)
-        data = await self.post_body(rpc_body)
-        return data['result']
+        return await self.batched_call('aria2.tellStopped', [offset, num])
 
-    async def tell_waiting(self, offset: int, num: int):
-        """获取等待中的任务列表"""
-        params = [
-            offset, num
-        ]
-        rpc_body = self.get_rpc_body('aria2.tellWaiting', params)
-        data = await self.post_body(rpc_body)
-        return data['result']
+    async def tell_waiting(self, offset: int, num: int, keys: Optional[List[str]] = None):
+        """获取等待中的任务列表，keys 指定时只返回这些字段"""
+        return await self.batched_call('aria2.tellWaiting', [offset, num, keys] if keys else [offset, num])
 
-    async def tell_active(self):
-        """获取活动任务列表"""
-        params = []
-        rpc_body = self.get_rpc_body('aria2.tellActive', params)
-        data = await self.post_body(rpc_body)
-        return data['result']
+    async def tell_active(self, keys: Optional[List[str]] = None):
+        """获取活动任务列表，keys 指定时只返回这些字段"""
+        return await self.batched_call('aria2.tellActive', [keys] if keys else [])
 
     async def pause(self, gid: str):
         """暂停任务"""
-        params = [gid]
-        jsonreq = self.parse_json_to_str('aria2.pause', params)
-        print(jsonreq)
-        await self.websocket.send(jsonreq)
+        return await self._call_and_report('aria2.pause', [gid])
 
     async def unpause(self, gid: str):
         """恢复任务"""
-        params = [gid]
-        jsonreq = self.parse_json_to_str('aria2.unpause', params)
-        print(jsonreq)
-        await self.websocket.send(jsonreq)
+        return await self._call_and_report('aria2.unpause', [gid])
 
     async def remove(self, gid: str):
         """移除任务"""
         params = [gid]
         rpc_body = self.get_rpc_body('aria2.remove', params)
-        data = await self.post_body(rpc_body)
+        data = await self.call(rpc_body)
+        if data and 'result' in data:
+            self.download_slots.release(gid)
         return data
 
     async def remove_download_result(self, gid: str):
         """移除下载结果"""
-        params = [gid]
-        jsonreq = self.parse_json_to_str('aria2.removeDownloadResult', params)
-        print(jsonreq)
-        await self.websocket.send(jsonreq)
+        return await self._call_and_report('aria2.removeDownloadResult', [gid])
+
+    async def _call_and_report(self, method: str, params: list):
+        """发送控制类请求，aria2 返回错误时打印出来(调用方通常不检查返回值)"""
+        rpc_body = self.get_rpc_body(method, params)
+        print(rpc_body)
+        data = await self.call(rpc_body)
+        if 'error' in data:
+            print(f"{method} 失败: {data['error'].get('message')} (code: {data['error'].get('code')})")
+        return data
 
     async def change_global_option(self, params):
         """修改全局选项"""
         rpc_body = self.get_rpc_body('aria2.changeGlobalOption', params)
-        return await self.post_body(rpc_body)
+        return await self.call(rpc_body)
 
     async def get_global_option(self):
         """获取全局选项"""
         rpc_body = self.get_rpc_body('aria2.getGlobalOption')
-        data = await self.post_body(rpc_body)
+        data = await self.call(rpc_body)
         return data['result']
 
     async def start_polling(self):
@@ -303,19 +537,42 @@ class AsyncAria2Client:
         
         self.is_polling = True
         self.polling_task = asyncio.create_task(self.poll_active_downloads())
+        self.progress_task = asyncio.create_task(self.poll_progress())
         print("[轮询] 已启动轮询任务")
     
     async def stop_polling(self):
         """停止轮询任务"""
         self.is_polling = False
-        if self.polling_task:
-            self.polling_task.cancel()
+        for task in (self.polling_task, self.progress_task):
+            if task:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self.polling_task = None
+        self.progress_task = None
+        print("[轮询] 已停止轮询任务")
+    
+    async def poll_progress(self):
+        """
+        聚合进度轮询：每个间隔只调用一次 tellActive(只取进度字段)，
+        由下载处理器与上一轮快照比较后批量写入数据库并推送，替代每个任务各自轮询 tellStatus
+        """
+        from .constants import DOWNLOAD_PROGRESS_UPDATE_INTERVAL, PROGRESS_KEYS
+        
+        while self.is_polling:
             try:
-                await self.polling_task
+                # 没有已登记的任务时不查询
+                if self.download_messages:
+                    tasks = await self.tell_active(PROGRESS_KEYS)
+                    await self.download_handler.apply_progress(tasks)
+                await asyncio.sleep(DOWNLOAD_PROGRESS_UPDATE_INTERVAL)
             except asyncio.CancelledError:
-                pass
-            self.polling_task = None
-        print("[轮询] 已停止轮询任务")
+                break
+            except Exception as e:
+                print(f"[进度轮询] 获取下载进度出错: {e}")
+                await asyncio.sleep(DOWNLOAD_PROGRESS_UPDATE_INTERVAL)
     
     async def poll_active_downloads(self):
         """
@@ -328,14 +585,15 @@ class AsyncAria2Client:
         
         while self.is_polling:
             try:
-                # 获取所有活动任务
-                active_tasks = await self.tell_active()
-                
-                # 获取最近停止的任务(可能是快速完成的小文件)
-                stopped_tasks = await self.tell_stopped(0, 20)
-                
-                # 获取等待中的任务
-                waiting_tasks = await self.tell_waiting(0, 10)
+                # 活动任务、最近停止的任务(可能是快速完成的小文件)、等待中的任务
+                # 同时发起，合并为一次 system.multicall
+                active_tasks, stopped_tasks, waiting_tasks, _ = await asyncio.gather(
+                    self.tell_active(),
+                    self.tell_stopped(0, 20),
+                    self.tell_waiting(0, 10),
+                    # 定时校准下载槽位计数(首次轮询即启动时的初始计数)
+                    self.reconcile_download_slots(),
+                )
                 
                 total_tasks = len(active_tasks) + len(stopped_tasks) + len(waiting_tasks)
                 
@@ -9,6 +9,8 @@ logger = logging.getLogger(__name__)
 
 # 常量定义
 DOWNLOAD_PROGRESS_UPDATE_INTERVAL = 3  # 下载进度更新间隔(秒)
+# 聚合进度轮询 tellActive 只取这些字段
+PROGRESS_KEYS = ['gid', 'completedLength', 'totalLength', 'downloadSpeed', 'status']
 FILE_MODIFIED_TIME_WINDOW = 300  # 文件修改时间窗口(秒) - 5分钟
 PROGRESS_UPDATE_FREQUENCY = 5  # 进度消息更新频率(每N次更新一次)
 RCLONE_MAX_RETRIES = 3  # rclone上传最大重试次数
@@ -19,6 +21,7 @@ PROCESS_TERMINATE_TIMEOUT = 5  # 进程终止超时时间(秒)
 # 轮询配置
 POLL_INTERVAL = 30  # 活动任务轮询间隔(秒)
 IDLE_CHECK_INTERVAL = 60  # 空闲时检查间隔(秒)
+SLOT_RECONCILE_WAITING_LIMIT = 1000  # 校准下载槽位计数时查询的等待中任务数上限
 
 # 上传并发控制
 upload_concurrent_semaphore = None  # 上传并发控制信号量，延迟初始化
@@ -0,0 +1,151 @@
+"""
+下载槽位计数
+
+在进程内记录占用 aria2 下载槽位（活动 + 等待中）的任务 GID，添加任务前不必再查询 aria2 的任务列表：
+添加任务时占用槽位，收到 onDownloadComplete / onDownloadError / onDownloadStop（移除）通知时释放，
+启动时与之后的定时轮询按 aria2 的实际任务列表校准。
+槽位空出时按排队顺序立即唤醒等待者，每个被唤醒的等待者预留一个槽位，直到它添加的任务被登记
+（或预留过期），避免同时被唤醒的等待者一起超额添加任务。
+"""
+import asyncio
+import time
+from collections import deque
+from typing import Callable, Deque, Iterable, Optional, Set
+
+# 被唤醒的等待者预留槽位的有效期(秒)，等待者没有添加任务(添加失败、文件被跳过)时预留到期自动归还
+RESERVATION_TTL = 10
+
+
+class DownloadSlots:
+    """aria2 下载槽位计数与等待队列"""
+
+    def __init__(self):
+        self._gids: Set[str] = set()
+        self._reservations: Deque[float] = deque()  # 预留槽位的过期时间
+        self._waiters: Deque[asyncio.Future] = deque()
+        # 校准查询进行期间释放的 GID（查询结果中可能仍包含这些任务）
+        self._released_during_reconcile: Optional[Set[str]] = None
+        self._limit = 0
+        self._extra: Callable[[], int] = lambda: 0
+        self.seeded = False
+        self.reconciles = 0
+        self.drift = 0  # 校准时发现的计数偏差累计
+
+    @property
+    def reserved(self) -> int:
+        now = time.monotonic()
+        while self._reservations and self._reservations[0] <= now:
+            self._reservations.popleft()
+        return len(self._reservations)
+
+    def in_use(self) -> int:
+        """当前占用的槽位数（aria2 任务 + 预留 + 额外占用）"""
+        return len(self._gids) + self.reserved + self._extra()
+
+    def acquire(self, gid: str) -> None:
+        """登记本进程添加的任务：占用一个槽位，并消耗一个预留"""
+        if self._reservations:
+            self._reservations.popleft()
+        self._gids.add(gid)
+
+    def track(self, gid: str) -> None:
+        """登记其他来源添加的任务（onDownloadStart 通知、外部客户端添加）"""
+        self._gids.add(gid)
+
+    def release(self, gid: str) -> None:
+        """任务完成、出错或被移除：释放槽位并唤醒等待者"""
+        if self._released_during_reconcile is not None:
+            self._released_during_reconcile.add(gid)
+        if gid in self._gids:
+            self._gids.discard(gid)
+            self.notify()
+
+    def cancel_reservation(self) -> None:
+        """等待者改用其他方式下载（进程内下载已计入额外占用）时提前归还预留"""
+        if self._reservations:
+            self._reservations.popleft()
+            self.notify()
+
+    def begin_reconcile(self) -> None:
+        self._released_during_reconcile = set()
+
+    def reconcile(self, gids: Iterable[str]) -> int:
+        """按 aria2 实际的活动 + 等待中任务校准计数，返回偏差数量"""
+        released = self._released_during_reconcile or set()
+        self._released_during_reconcile = None
+        actual = set(gids) - released
+        drift = len(self._gids ^ actual)
+        self._gids = actual
+        self.seeded = True
+        self.reconciles += 1
+        self.drift += drift
+        self.notify()
+        return drift
+
+    def notify(self) -> None:
+        """按排队顺序唤醒等待者，每空出一个槽位唤醒一个"""
+        if not self._limit:
+            return
+        free = self._limit - self.in_use()
+        while free > 0 and self._waiters:
+            future = self._waiters.popleft()
+            if future.done():
+                continue
+            self._reservations.append(time.monotonic() + RESERVATION_TTL)
+            future.set_result(None)
+            free -= 1
+
+    async def wait(self, limit: int, timeout: float, extra: Optional[Callable[[], int]] = None) -> bool:
+        """
+        等待空闲槽位并预留一个，返回 True；超时返回 False
+
+        Args:
+            limit: 最大并发下载数
+            timeout: 最长等待时间(秒)
+            extra: 返回其他下载方式占用的槽位数（进程内下载）
+        """
+        self._limit = limit
+        if extra is not None:
+            self._extra = extra
+        if not self._waiters and self.in_use() < limit:
+            self._reservations.append(time.monotonic() + RESERVATION_TTL)
+            return True
+
+        future = asyncio.get_event_loop().create_future()
+        self._waiters.append(future)
+        try:
+            # 预留到期也会空出槽位，按最早的过期时间重新检查
+            deadline = time.monotonic() + timeout
+            while not future.done():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                expires = self._reservations[0] - time.monotonic() if self._reservations else remaining
+                try:
+                    await asyncio.wait_for(asyncio.shield(future), max(0.01, min(remaining, expires)))
+                except asyncio.TimeoutError:
+                    self.notify()
+            return True
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # 已预留槽位但等待方被取消：归还预留
+                self.cancel_reservation()
+            raise
+        finally:
+            if not future.done():
+                future.cancel()
+                try:
+                    self._waiters.remove(future)
+                except ValueError:
+                    pass
+
+    def stats(self) -> dict:
+        return {
+            "tracked": len(self._gids),
+            "reserved": self.reserved,
+            "waiting": len(self._waiters),
+            "limit": self._limit,
+            "seeded": self.seeded,
+            "reconciles": self.reconciles,
+            "drift": self.drift,
+        }
@@ -599,16 +599,9 @@ class UploadHandler:
                 # 更新任务完成跟踪状态为 'uploaded'
                 if gid:
                     try:
-                        from WebStreamer.bot.plugins.stream import task_completion_tracker, task_completion_lock
-                        import asyncio as asyncio_module
-                        
-                        if task_completion_lock:
-                            async with task_completion_lock:
-                                task_completion_tracker[gid] = {
-                                    'status': 'uploaded',
-                                    'completed_at': asyncio_module.get_event_loop().time()
-                                }
-                                print(f"任务 {gid} 已标记为已上传")
+                        from WebStreamer.bot.plugins.stream import mark_task_status
+                        mark_task_status(gid, 'uploaded')
+                        print(f"任务 {gid} 已标记为已上传")
                     except Exception as e:
                         print(f"更新任务上传状态失败: {e}")
                 
@@ -628,19 +621,12 @@ class UploadHandler:
                             except Exception as e:
                                 print(f"更新数据库清理状态失败: {e}")
                         
-                        # 更新任务完成跟踪状态为 'cleaned'
-                        if gid:
+                        # 更新任务完成跟踪状态为 'cleaned'（有上传记录时由 mark_upload_cleaned 在该下载的所有上传都结束后更新）
+                        if gid and not upload_id:
                             try:
-                                from WebStreamer.bot.plugins.stream import task_completion_tracker, task_completion_lock
-                                import asyncio as asyncio_module
-                                
-                                if task_completion_lock:
-                                    async with task_completion_lock:
-                                        task_completion_tracker[gid] = {
-                                            'status': 'cleaned',
-                                            'completed_at': asyncio_module.get_event_loop().time()
-                                        }
-                                        print(f"任务 {gid} 已标记为已清理")
+                                from WebStreamer.bot.plugins.stream import mark_task_status
+                                mark_task_status(gid, 'cleaned')
+                                print(f"任务 {gid} 已标记为已清理")
                             except Exception as e:
                                 print(f"更新任务清理状态失败: {e}")
                         
@@ -785,6 +771,7 @@ class UploadHandler:
                     pass
 
             client_index = None
+            client_lease = None
             file_name_display = os.path.basename(file_path)
             upload_start_msg = (
                 f'📤 <b>上传到 Telegram</b>\n\n'
@@ -795,31 +782,20 @@ class UploadHandler:
             
             # 选择上传客户端（使用负载均衡）
             upload_client = None
+            # 按机器人的令牌桶限速（仅对 Pyrogram 多客户端生效，client_index 为 None 时直接放行）
+            from WebStreamer.utils.rate_limiter import rate_limiter
             
             if pyrogram_clients and len(pyrogram_clients) > 0:
-                # 使用Pyrogram多客户端负载均衡
-                # 优先选择能访问频道的客户端
-                if channel_accessible_clients:
-                    available_loads = {
-                        k: v for k, v in upload_work_loads.items() 
-                        if k in channel_accessible_clients and k in pyrogram_clients
-                    }
-                    if available_loads:
-                        client_index = min(available_loads, key=available_loads.get)
-                    else:
-                        # 回退到所有客户端
-                        valid_loads = {k: v for k, v in upload_work_loads.items() if k in pyrogram_clients}
-                        if valid_loads:
-                            client_index = min(valid_loads, key=valid_loads.get)
-                else:
-                    # 使用所有客户端
-                    valid_loads = {k: v for k, v in upload_work_loads.items() if k in pyrogram_clients}
-                    if valid_loads:
-                        client_index = min(valid_loads, key=valid_loads.get)
+                # 使用Pyrogram多客户端负载均衡：由直链调度器按延迟、负载、错误率与 FloodWait 冷却选择
+                # 优先选择能访问频道的客户端，都不能访问时回退到所有客户端
+                from WebStreamer.utils.scheduler import client_scheduler
+                accessible = [i for i in pyrogram_clients if i in channel_accessible_clients]
+                client_index = client_scheduler.pick(candidates=accessible or list(pyrogram_clients))
                 
                 if client_index is not None and client_index in pyrogram_clients:
                     upload_client = pyrogram_clients[client_index]
-                    upload_work_loads[client_index] = upload_work_loads.get(client_index, 0) + 1
+                    # 租约同步更新 upload_work_loads（展示用），释放可重复调用
+                    client_lease = client_scheduler.acquire(client_index, upload_work_loads)
                     print(f"使用Pyrogram客户端 {client_index} 上传文件（上传负载: {upload_work_loads[client_index]}）")
             
             # 如果没有Pyrogram客户端，使用Telethon bot
@@ -842,28 +818,23 @@ class UploadHandler:
                         partial_callback = functools.partial(self.callback, gid=gid, msg=msg, path=file_path, upload_id=upload_id)
                         temp_msg = await upload_client.send_file(admin_id, file_path, progress_callback=partial_callback)
                     else:  # Pyrogram
+                        await rate_limiter.acquire(client_index, 'send', admin_id)
                         temp_msg = await upload_client.send_photo(admin_id, file_path)
                     
                     if forward_id:
                         if hasattr(temp_msg, 'forward_to'):  # Telethon
                             await temp_msg.forward_to(int(forward_id))
                         else:  # Pyrogram
+                            await rate_limiter.acquire(client_index, 'send', int(forward_id))
                             await upload_client.forward_messages(int(forward_id), admin_id, temp_msg.id)
                     
                     # 静默处理：不再发送Telegram消息，因此无需删除
                     # 更新任务完成跟踪状态为 'uploaded'（Telegram上传）
                     if gid:
                         try:
-                            from WebStreamer.bot.plugins.stream import task_completion_tracker, task_completion_lock
-                            import asyncio as asyncio_module
-                            
-                            if task_completion_lock:
-                                async with task_completion_lock:
-                                    task_completion_tracker[gid] = {
-                                        'status': 'uploaded',
-                                        'completed_at': asyncio_module.get_event_loop().time()
-                                    }
-                                    print(f"任务 {gid} 已标记为已上传（Telegram）")
+                            from WebStreamer.bot.plugins.stream import mark_task_status
+                            mark_task_status(gid, 'uploaded')
+                            print(f"任务 {gid} 已标记为已上传（Telegram）")
                         except Exception as e:
                             print(f"更新任务上传状态失败: {e}")
                     
@@ -882,19 +853,12 @@ class UploadHandler:
                                 except Exception as e:
                                     print(f"更新数据库清理状态失败: {e}")
                             
-                            # 更新任务完成跟踪状态为 'cleaned'（Telegram上传）
-                            if gid:
+                            # 更新任务完成跟踪状态为 'cleaned'（Telegram上传）（有上传记录时由 mark_upload_cleaned 在该下载的所有上传都结束后更新）
+                            if gid and not upload_id:
                                 try:
-                                    from WebStreamer.bot.plugins.stream import task_completion_tracker, task_completion_lock
-                                    import asyncio as asyncio_module
-                                    
-                                    if task_completion_lock:
-                                        async with task_completion_lock:
-                                            task_completion_tracker[gid] = {
-                                                'status': 'cleaned',
-                                                'completed_at': asyncio_module.get_event_loop().time()
-                                            }
-                                            print(f"任务 {gid} 已标记为已清理（Telegram上传）")
+                                    from WebStreamer.bot.plugins.stream import mark_task_status
+                                    mark_task_status(gid, 'cleaned')
+                                    print(f"任务 {gid} 已标记为已清理（Telegram上传）")
                                 except Exception as e:
                                     print(f"更新任务清理状态失败: {e}")
                         except Exception as e:
@@ -919,6 +883,7 @@ class UploadHandler:
                         )
                     else:  # Pyrogram
                         admin_id = get_config_value('ADMIN_ID', 0)
+                        await rate_limiter.acquire(client_index, 'send', admin_id)
                         temp_msg = await upload_client.send_video(admin_id, file_path, thumb=thumb_path)
                     
                     forward_id = get_config_value('FORWARD_ID', None)
@@ -927,22 +892,16 @@ class UploadHandler:
                             await temp_msg.forward_to(int(forward_id))
                         else:  # Pyrogram
                             admin_id = get_config_value('ADMIN_ID', 0)
+                            await rate_limiter.acquire(client_index, 'send', int(forward_id))
                             await upload_client.forward_messages(int(forward_id), admin_id, temp_msg.id)
                     
                     # 静默处理：不再发送Telegram消息，因此无需删除
                     # 更新任务完成跟踪状态为 'uploaded'（Telegram上传）
                     if gid:
                         try:
-                            from WebStreamer.bot.plugins.stream import task_completion_tracker, task_completion_lock
-                            import asyncio as asyncio_module
-                            
-                            if task_completion_lock:
-                                async with task_completion_lock:
-                                    task_completion_tracker[gid] = {
-                                        'status': 'uploaded',
-                                        'completed_at': asyncio_module.get_event_loop().time()
-                                    }
-                                    print(f"任务 {gid} 已标记为已上传（Telegram）")
+                            from WebStreamer.bot.plugins.stream import mark_task_status
+                            mark_task_status(gid, 'uploaded')
+                            print(f"任务 {gid} 已标记为已上传（Telegram）")
                         except Exception as e:
                             print(f"更新任务上传状态失败: {e}")
                     
@@ -964,19 +923,12 @@ class UploadHandler:
                             except Exception as e:
                                 print(f"更新数据库清理状态失败: {e}")
                         
-                        # 更新任务完成跟踪状态为 'cleaned'（Telegram上传）
-                        if gid:
+                        # 更新任务完成跟踪状态为 'cleaned'（Telegram上传）（有上传记录时由 mark_upload_cleaned 在该下载的所有上传都结束后更新）
+                        if gid and not upload_id:
                             try:
-                                from WebStreamer.bot.plugins.stream import task_completion_tracker, task_completion_lock
-                                import asyncio as asyncio_module
-                                
-                                if task_completion_lock:
-                                    async with task_completion_lock:
-                                        task_completion_tracker[gid] = {
-                                            'status': 'cleaned',
-                                            'completed_at': asyncio_module.get_event_loop().time()
-                                        }
-                                        print(f"任务 {gid} 已标记为已清理（Telegram上传）")
+                                from WebStreamer.bot.plugins.stream import mark_task_status
+                                mark_task_status(gid, 'cleaned')
+                                print(f"任务 {gid} 已标记为已清理（Telegram上传）")
                             except Exception as e:
                                 print(f"更新任务清理状态失败: {e}")
                 else:
@@ -988,12 +940,14 @@ class UploadHandler:
                         partial_callback = functools.partial(self.callback, gid=gid, msg=msg, path=file_path, upload_id=upload_id)
                         temp_msg = await upload_client.send_file(admin_id, file_path, progress_callback=partial_callback)
                     else:  # Pyrogram
+                        await rate_limiter.acquire(client_index, 'send', admin_id)
                         temp_msg = await upload_client.send_document(admin_id, file_path)
                     
                     if forward_id:
                         if hasattr(temp_msg, 'forward_to'):  # Telethon
                             await temp_msg.forward_to(int(forward_id))
                         else:  # Pyrogram
+                            await rate_limiter.acquire(client_index, 'send', int(forward_id))
                             await upload_client.forward_messages(int(forward_id), admin_id, temp_msg.id)
                     
                     if hasattr(msg, 'delete'):
@@ -1013,19 +967,12 @@ class UploadHandler:
                             except Exception as e:
                                 print(f"更新数据库清理状态失败: {e}")
                         
-                        # 更新任务完成跟踪状态为 'cleaned'（Telegram上传）
-                        if gid:
+                        # 更新任务完成跟踪状态为 'cleaned'（Telegram上传）（有上传记录时由 mark_upload_cleaned 在该下载的所有上传都结束后更新）
+                        if gid and not upload_id:
                             try:
-                                from WebStreamer.bot.plugins.stream import task_completion_tracker, task_completion_lock
-                                import asyncio as asyncio_module
-                                
-                                if task_completion_lock:
-                                    async with task_completion_lock:
-                                        task_completion_tracker[gid] = {
-                                            'status': 'cleaned',
-                                            'completed_at': asyncio_module.get_event_loop().time()
-                                        }
-                                        print(f"任务 {gid} 已标记为已清理（Telegram上传）")
+                                from WebStreamer.bot.plugins.stream import mark_task_status
+                                mark_task_status(gid, 'cleaned')
+                                print(f"任务 {gid} 已标记为已清理（Telegram上传）")
                             except Exception as e:
                                 print(f"更新任务清理状态失败: {e}")
                         
@@ -1040,10 +987,16 @@ class UploadHandler:
                         except:
                             pass
                             
+            except Exception as e:
+                # 该客户端被限流：在释放租约之前记录冷却时间，之后的上传会自动选择其他客户端
+                if client_index is not None and type(e).__name__ == 'FloodWait':
+                    from WebStreamer.utils.scheduler import client_scheduler
+                    client_scheduler.record_flood_wait(client_index, getattr(e, 'value', 300) or 300, 'send')
+                raise
             finally:
                 # 减少上传负载
-                if client_index is not None and client_index in upload_work_loads:
-                    upload_work_loads[client_index] = max(0, upload_work_loads[client_index] - 1)
+                if client_lease is not None:
+                    client_lease.release()
                     
         except Exception as e:
             print(f"上传到Telegram失败: {e}")
@@ -1063,9 +1016,6 @@ class UploadHandler:
 
             # 静默处理：不再发送Telegram消息，错误信息已通过数据库记录
             print(f"Telegram上传错误: {error_msg}")
-            # 确保减少负载
-            if client_index is not None and client_index in upload_work_loads:
-                upload_work_loads[client_index] = max(0, upload_work_loads[client_index] - 1)
         finally:
             # 释放上传并发控制信号量
             if upload_semaphore:
@@ -122,6 +122,34 @@ STREAM_ALLOWED_USERS = result.get('STREAM_ALLOWED_USERS', '')
 STREAM_AUTO_DOWNLOAD = result.get('STREAM_AUTO_DOWNLOAD', True)
 # 是否发送直链信息给用户（默认不启用，设置为 True 后才会发送直链信息给用户，关闭后仍会生成直链并添加到下载队列）
 SEND_STREAM_LINK = result.get('SEND_STREAM_LINK', False)
+# 直链预读窗口：同时在途的 GetFile 分块请求数量范围（按延迟在 MIN 与 MAX 之间自适应调整）
+STREAM_PREFETCH_MIN = result.get('STREAM_PREFETCH_MIN', 2)
+STREAM_PREFETCH_MAX = result.get('STREAM_PREFETCH_MAX', 8)
+# 多机器人条带化传输：单个文件的分块轮流分配给所有可访问频道的机器人并行获取
+# （默认关闭；开启后每个直链请求都会分散到所有机器人，GetFile 调用与 FloodWait 风险随机器人数量增加，仅多客户端模式生效）
+STREAM_STRIPED = result.get('STREAM_STRIPED', False)
+# 最近分块内存缓存大小（MB），用于合并重复/重叠的 Range 请求（默认64MB，0 表示只合并在途请求不缓存）
+STREAM_CHUNK_CACHE_MB = result.get('STREAM_CHUNK_CACHE_MB', 64)
+# Telegram 媒体直接由进程内下载器写入磁盘（不经过 aria2 → 本地直链的 HTTP 回环），默认关闭仍由 aria2 下载；HTTP/磁力/种子任务始终使用 aria2
+STREAM_NATIVE_DOWNLOAD = result.get('STREAM_NATIVE_DOWNLOAD', False)
+# 进程内下载器每个机器人同时在途的分块数（默认4）
+STREAM_DOWNLOAD_CONCURRENCY = result.get('STREAM_DOWNLOAD_CONCURRENCY', 4)
+# 磁盘分块缓存大小（MB），重复播放的热门直链直接从磁盘读取分块（默认0，不启用）
+STREAM_DISK_CACHE_MB = result.get('STREAM_DISK_CACHE_MB', 0)
+# 磁盘分块缓存目录（默认为数据库目录下的 segment_cache）
+STREAM_DISK_CACHE_DIR = result.get('STREAM_DISK_CACHE_DIR', '')
+# 直链准入控制：同时进行的外部直链数量上限（全局 / 单个 IP，默认0 不限制），交给 aria2 的直链带有内部令牌，不受限制
+STREAM_MAX_STREAMS = result.get('STREAM_MAX_STREAMS', 0)
+STREAM_MAX_STREAMS_PER_IP = result.get('STREAM_MAX_STREAMS_PER_IP', 0)
+# 可信反向代理地址（IP 或网段，字符串逗号分隔或列表），只有来自这些地址的请求才按 X-Forwarded-For 识别客户端 IP
+STREAM_TRUSTED_PROXIES = result.get('STREAM_TRUSTED_PROXIES', [])
+if isinstance(STREAM_TRUSTED_PROXIES, str):
+    STREAM_TRUSTED_PROXIES = [proxy.strip() for proxy in STREAM_TRUSTED_PROXIES.split(',') if proxy.strip()]
+# 超出上限的直链请求排队等待的数量与时间（秒），队列满或超时返回 503 Retry-After
+STREAM_QUEUE_SIZE = result.get('STREAM_QUEUE_SIZE', 16)
+STREAM_QUEUE_TIMEOUT = result.get('STREAM_QUEUE_TIMEOUT', 5)
+# 每个机器人同时在途的 GetFile 分块数上限（默认32，0 表示不限制）
+STREAM_BOT_CHUNK_BUDGET = result.get('STREAM_BOT_CHUNK_BUDGET', 32)
 # 是否跳过小于指定大小的媒体文件（默认False）
 SKIP_SMALL_FILES = result.get('SKIP_SMALL_FILES', False)
 # 最小文件大小（MB），小于此大小的文件将被跳过（默认100MB）
@@ -23,6 +23,19 @@ SQLite 数据库模块
   - thumbs               : 缩略图相关信息，预留为 JSON 字符串
   - extra                : 预留扩展字段（JSON 字符串）
 
+- tg_file_locations 表：日志频道消息解析出的 FileId（直链/下载用），重启后无需再次 get_messages
+  - chat_id / message_id : 日志频道 ID 与消息 ID（联合主键）
+  - file_id              : 编码后的完整 FileId 字符串（含缩略图等全部字段）
+  - dc_id/media_id/access_hash/file_reference : 媒体位置（file_reference 过期时刷新）
+  - file_size/mime_type/file_name/file_unique_id : 文件属性
+
+- download_chunks 表：进程内 Telegram 下载的分块日志（崩溃/重启后只重新获取缺失的分块）
+  - download_id          : 关联 downloads.id（主键）
+  - message_id           : 日志频道消息 ID
+  - file_path            : 预分配的目标文件路径
+  - file_size/chunk_size : 文件大小与分块大小（字节）
+  - bitmap               : 已落盘分块位图（第 i 位为 1 表示第 i 个分块已写入并 fsync）
+
 - downloads 表：存放下载任务（aria2）与本地/网盘路径信息
   - id               : 自增主键
   - file_unique_id   : 外键，关联 tg_media
@@ -139,6 +152,28 @@ def init_db():
             "CREATE INDEX IF NOT EXISTS idx_tg_media_media_group ON tg_media (media_group_id)"
         )
 
+        # 日志频道消息的 FileId 解析结果（持久化，避免重启后重复 get_messages）
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS tg_file_locations (
+                chat_id          INTEGER NOT NULL, -- 日志频道 ID
+                message_id       INTEGER NOT NULL, -- 日志频道中的消息 ID
+                file_id          TEXT NOT NULL,    -- 编码后的完整 FileId
+                file_type        INTEGER,          -- FileType 枚举值
+                dc_id            INTEGER,          -- 媒体所在 DC
+                media_id         INTEGER,          -- 媒体 ID
+                access_hash      INTEGER,          -- 访问哈希
+                file_reference   BLOB,             -- 文件引用（会过期，过期时刷新）
+                file_size        INTEGER,          -- 文件大小（字节）
+                mime_type        TEXT,             -- MIME 类型
+                file_name        TEXT,             -- 文件名
+                file_unique_id   TEXT,             -- Telegram 全局唯一 ID
+                updated_at       TEXT NOT NULL,    -- 最近解析时间
+                PRIMARY KEY (chat_id, message_id)
+            )
+            """
+        )
+
         # 下载任务信息
         cur.execute(
             """
@@ -172,6 +207,22 @@ def init_db():
             "CREATE INDEX IF NOT EXISTS idx_downloads_status ON downloads (status)"
         )
 
+        # 进程内 Telegram 下载的分块日志（按批刷新，重启后据此续传）
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS download_chunks (
+                download_id      INTEGER PRIMARY KEY,               -- 关联 downloads.id
+                message_id       INTEGER NOT NULL,                  -- 日志频道消息 ID
+                file_path        TEXT NOT NULL,                     -- 预分配的目标文件路径
+                file_size        INTEGER NOT NULL,                  -- 文件大小（字节）
+                chunk_size       INTEGER NOT NULL,                  -- 分块大小（字节）
+                bitmap           BLOB NOT NULL,                     -- 已落盘分块位图
+                updated_at       TEXT NOT NULL,                     -- 最近刷新时间
+                FOREIGN KEY (download_id) REFERENCES downloads(id) ON DELETE CASCADE
+            )
+            """
+        )
+
         # 上传任务信息
         cur.execute(
             """
@@ -315,6 +366,60 @@ def save_tg_media(message, media) -> str:
     return file_unique_id
 
 
+def save_file_location(chat_id: int, message_id: int, file_id) -> None:
+    """保存/更新日志频道消息解析出的 FileId（file_id 为 pyrogram FileId，附带 file_size 等属性）"""
+    file_type = getattr(file_id, "file_type", None)
+    with db_cursor() as cur:
+        cur.execute(
+            """
+            INSERT OR REPLACE INTO tg_file_locations (
+                chat_id, message_id, file_id, file_type,
+                dc_id, media_id, access_hash, file_reference,
+                file_size, mime_type, file_name, file_unique_id, updated_at
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            (
+                chat_id,
+                message_id,
+                file_id.encode(),
+                int(file_type) if file_type is not None else None,
+                getattr(file_id, "dc_id", None),
+                getattr(file_id, "media_id", None),
+                getattr(file_id, "access_hash", None),
+                getattr(file_id, "file_reference", None),
+                getattr(file_id, "file_size", None),
+                getattr(file_id, "mime_type", None),
+                getattr(file_id, "file_name", None),
+                getattr(file_id, "unique_id", None),
+                _now_iso(),
+            ),
+        )
+
+
+def get_file_location(chat_id: int, message_id: int):
+    """获取已持久化的 FileId 解析结果，不存在时返回 None"""
+    with get_connection() as conn:
+        conn.row_factory = sqlite3.Row
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT * FROM tg_file_locations WHERE chat_id = ? AND message_id = ?",
+            (chat_id, message_id),
+        )
+        row = cur.fetchone()
+        return dict(row) if row else None
+
+
+def get_used_dc_ids(chat_id: int) -> list:
+    """获取日志频道文件用到过的所有 DC（用于预热媒体会话）"""
+    with get_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT DISTINCT dc_id FROM tg_file_locations WHERE chat_id = ? AND dc_id IS NOT NULL",
+            (chat_id,),
+        )
+        return [row[0] for row in cur.fetchall()]
+
+
 def create_download(file_unique_id: str, gid: str | None, source_url: str | None) -> int:
     """创建一条下载记录，返回 downloads.id。"""
     now = _now_iso()
@@ -364,6 +469,85 @@ def get_download_id_by_gid(gid: str) -> int | None:
         return row['id'] if row else None
 
 
+def get_local_paths_by_unique_id(file_unique_id: str) -> list:
+    """获取某个 Telegram 文件已下载完成的本地路径（最近完成的在前）。"""
+    with get_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT local_path
+              FROM downloads
+             WHERE file_unique_id = ? AND local_path IS NOT NULL
+             ORDER BY COALESCE(completed_at, updated_at) DESC
+            """,
+            (file_unique_id,),
+        )
+        return [row[0] for row in cur.fetchall()]
+
+
+def update_download_gid(download_id: int, gid: str):
+    """更换下载记录的任务 ID（续传改由 aria2 重新下载时使用）。"""
+    with db_cursor() as cur:
+        cur.execute(
+            "UPDATE downloads SET gid = ?, updated_at = ? WHERE id = ?",
+            (gid, _now_iso(), download_id),
+        )
+
+
+def save_download_journal(download_id: int, message_id: int, file_path: str,
+                          file_size: int, chunk_size: int, bitmap: bytes) -> None:
+    """保存/更新进程内下载的分块位图。"""
+    with db_cursor() as cur:
+        cur.execute(
+            """
+            INSERT OR REPLACE INTO download_chunks (
+                download_id, message_id, file_path, file_size, chunk_size, bitmap, updated_at
+            ) VALUES (?, ?, ?, ?, ?, ?, ?)
+            """,
+            (download_id, message_id, file_path, file_size, chunk_size, bytes(bitmap), _now_iso()),
+        )
+
+
+def delete_download_journal(download_id: int) -> None:
+    """下载完成或放弃后删除分块日志。"""
+    with db_cursor() as cur:
+        cur.execute("DELETE FROM download_chunks WHERE download_id = ?", (download_id,))
+
+
+def get_interrupted_downloads():
+    """获取有分块日志但尚未完成的下载（进程重启前中断的进程内下载）。"""
+    with get_connection() as conn:
+        conn.row_factory = sqlite3.Row
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT j.*, d.gid, d.source_url, d.status
+              FROM download_chunks j
+              JOIN downloads d ON d.id = j.download_id
+             WHERE d.status IN ('pending', 'downloading')
+            """
+        )
+        return [dict(row) for row in cur.fetchall()]
+
+
+def get_download_journal(download_id: int):
+    """获取下载的分块日志（不存在时返回 None）。"""
+    with get_connection() as conn:
+        conn.row_factory = sqlite3.Row
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT j.*, d.gid, d.source_url, d.status
+              FROM download_chunks j
+              JOIN downloads d ON d.id = j.download_id
+             WHERE j.download_id = ?
+            """,
+            (download_id,),
+        )
+        row = cur.fetchone()
+        return dict(row) if row else None
+
+
 def get_download_by_id(download_id: int):
     """根据 ID 获取下载记录。"""
     with get_connection() as conn:
@@ -429,6 +613,32 @@ def _notify_ws_download_update(gid: str):
         pass
 
 
+def _notify_task_status(gid: str, status: str):
+    """通知等待该任务的队列处理器：任务进入了新的阶段（流程结束时唤醒等待者）"""
+    try:
+        from WebStreamer.bot.plugins.stream_modules.task_tracker import mark_task_status
+        mark_task_status(gid, status)
+    except Exception as e:
+        # 静默失败，不影响主流程
+        pass
+
+
+def _notify_ws_download_progress_batch(items: list):
+    """通过 WebSocket 一次推送多个下载任务的进度（异步，不阻塞）"""
+    if not items:
+        return
+    try:
+        from WebStreamer.server.ws_manager import ws_manager
+        import asyncio
+
+        loop = asyncio.get_event_loop()
+        if not loop.is_closed():
+            asyncio.create_task(ws_manager.send_download_progress_batch(items))
+    except Exception as e:
+        # 静默失败，不影响主流程
+        pass
+
+
 def _notify_ws_upload_update(upload_id: int):
     """通过 WebSocket 推送上传状态更新（异步，不阻塞）"""
     try:
@@ -575,6 +785,8 @@ def mark_download_failed(gid: str, error_message: str | None):
         )
     # 推送 WebSocket 更新
     _notify_ws_download_update(gid)
+    # 下载失败后不会再有上传与清理，等待该任务的队列处理器不再等待
+    _notify_task_status(gid, 'failed')
 
 
 def mark_download_paused(gid: str):
@@ -647,6 +859,52 @@ def update_download_progress(gid: str, completed_length: int | None = None,
     _notify_ws_download_update(gid)
 
 
+def update_download_progress_batch(rows: list):
+    """
+    在一个事务中批量更新多个下载任务的进度，并合并为一条 WebSocket 消息推送（聚合进度轮询使用）。
+
+    Args:
+        rows: [(gid, completed_length, total_length, download_speed), ...]，值为 None 时保留原值
+    """
+    if not rows:
+        return
+    now = _now_iso()
+    gids = [row[0] for row in rows]
+    with db_cursor() as cur:
+        cur.executemany(
+            """
+            UPDATE downloads
+               SET updated_at = ?,
+                   completed_length = COALESCE(?, completed_length),
+                   total_length = COALESCE(?, total_length),
+                   download_speed = COALESCE(?, download_speed)
+             WHERE gid = ?
+            """,
+            [(now, completed, total, speed, gid) for gid, completed, total, speed in rows],
+        )
+        cur.execute(
+            f"""
+            SELECT id, gid, status, completed_length, total_length, download_speed
+              FROM downloads
+             WHERE gid IN ({', '.join('?' * len(gids))})
+            """,
+            tuple(gids),
+        )
+        items = [
+            {
+                "gid": row['gid'],
+                "download_id": row['id'],
+                "status": row['status'],
+                "completed_length": row['completed_length'],
+                "total_length": row['total_length'],
+                "download_speed": row['download_speed'],
+            }
+            for row in cur.fetchall()
+        ]
+    # 推送 WebSocket 批量更新（进度更新不涉及上传记录，不附带 uploads）
+    _notify_ws_download_progress_batch(items)
+
+
 def fetch_recent_downloads(limit: int = 100):
     """
     查询最近的下载记录（按创建时间倒序），包含部分 Telegram 媒体字段和上传信息，
@@ -1014,6 +1272,20 @@ def init_config_from_yaml():
             'STREAM_ALLOWED_USERS': ('string', 'stream', '允许使用直链的用户列表'),
             'STREAM_AUTO_DOWNLOAD': ('bool', 'stream', '是否自动添加到下载队列'),
             'SEND_STREAM_LINK': ('bool', 'stream', '是否发送直链信息给用户'),
+            'STREAM_PREFETCH_MIN': ('int', 'stream', '直链预读窗口最小分块数（默认2）'),
+            'STREAM_PREFETCH_MAX': ('int', 'stream', '直链预读窗口最大分块数（默认8）'),
+            'STREAM_STRIPED': ('bool', 'stream', '是否启用多机器人条带化传输（默认关闭）'),
+            'STREAM_CHUNK_CACHE_MB': ('int', 'stream', '最近分块内存缓存大小MB（默认64）'),
+            'STREAM_NATIVE_DOWNLOAD': ('bool', 'stream', 'Telegram媒体是否使用进程内下载器（默认关闭）'),
+            'STREAM_DOWNLOAD_CONCURRENCY': ('int', 'stream', '进程内下载器每个机器人在途分块数（默认4）'),
+            'STREAM_DISK_CACHE_MB': ('int', 'stream', '磁盘分块缓存大小MB（默认0，不启用）'),
+            'STREAM_DISK_CACHE_DIR': ('string', 'stream', '磁盘分块缓存目录（留空使用数据库目录下的segment_cache）'),
+            'STREAM_MAX_STREAMS': ('int', 'stream', '同时进行的外部直链数量上限（默认0，不限制）'),
+            'STREAM_MAX_STREAMS_PER_IP': ('int', 'stream', '单个IP同时进行的直链数量上限（默认0，不限制）'),
+            'STREAM_TRUSTED_PROXIES': ('list', 'stream', '可信反向代理地址列表（按X-Forwarded-For识别客户端IP）'),
+            'STREAM_QUEUE_SIZE': ('int', 'stream', '超出上限的直链请求排队数量（默认16）'),
+            'STREAM_QUEUE_TIMEOUT': ('int', 'stream', '直链请求排队等待秒数，超时返回503（默认5）'),
+            'STREAM_BOT_CHUNK_BUDGET': ('int', 'stream', '每个机器人同时在途的分块请求数上限（默认32，0不限制）'),
             'MULTI_BOT_TOKENS': ('list', 'stream', '多机器人Token列表'),
         }
         
@@ -1220,6 +1492,19 @@ def mark_upload_completed(upload_id: int, remote_path: str = None):
     _notify_ws_upload_update(upload_id)
 
 
+def _has_active_uploads(cur, download_id: int) -> bool:
+    """该下载是否还有未结束的上传（排队、等待下载、上传中、已暂停）"""
+    cur.execute(
+        """
+        SELECT 1 FROM uploads
+         WHERE download_id = ? AND status IN ('pending', 'waiting_download', 'uploading', 'paused')
+         LIMIT 1
+        """,
+        (download_id,),
+    )
+    return cur.fetchone() is not None
+
+
 def mark_upload_failed(upload_id: int, failure_reason: str, error_message: str = None, error_code: str = None):
     """
     标记上传失败。
@@ -1244,8 +1529,21 @@ def mark_upload_failed(upload_id: int, failure_reason: str, error_message: str =
             """,
             (failure_reason, error_message, error_code, now, upload_id),
         )
+        cur.execute(
+            """
+            SELECT d.gid, d.id FROM uploads u JOIN downloads d ON d.id = u.download_id
+             WHERE u.id = ?
+            """,
+            (upload_id,),
+        )
+        row = cur.fetchone()
+        # 同一下载的其他上传（OneDrive/Google Drive/Telegram）仍在进行时不结束等待
+        settled = bool(row) and not _has_active_uploads(cur, row[1])
     # 推送 WebSocket 更新
     _notify_ws_upload_update(upload_id)
+    # 该下载的所有上传都已结束且没有可清理的文件，等待该任务的队列处理器不再等待
+    if settled and row[0]:
+        _notify_task_status(row[0], 'failed')
 
 
 def mark_upload_cleaned(upload_id: int):
@@ -1314,6 +1612,8 @@ def mark_upload_cleaned(upload_id: int):
                     if gid_row and gid_row[0]:
                         gid = gid_row[0]
                         _notify_ws_download_update(gid)
+                        # 所有上传都已清理，整个流程结束
+                        _notify_task_status(gid, 'cleaned')
                         # 更新队列通知消息（如果存在）
                         try:
                             from WebStreamer.bot.plugins.stream_modules.utils import update_queue_msg_on_cleanup
@@ -1331,6 +1631,15 @@ def mark_upload_cleaned(upload_id: int):
                                 loop.run_until_complete(update_queue_msg_on_cleanup(gid))
                         except Exception as update_e:
                             logging.debug(f"更新队列通知消息失败: {update_e}")
+                # 其余上传都已失败或取消（不会再清理）时，整个流程同样已经结束
+                elif all(
+                    upload[2] is not None or upload[1] in ('failed', 'cancelled')
+                    for upload in uploads
+                ):
+                    cur.execute("SELECT gid FROM downloads WHERE id = ?", (download_id,))
+                    gid_row = cur.fetchone()
+                    if gid_row and gid_row[0]:
+                        _notify_task_status(gid_row[0], 'cleaned')
     
     # 推送 WebSocket 更新
     # 同时推送清理更新和上传更新（因为清理状态是上传记录的一部分）
@@ -1605,6 +1914,7 @@ def delete_all_downloads():
         
         # 删除所有上传记录（先删除，避免外键约束问题）
         cur.execute("DELETE FROM uploads")
+        cur.execute("DELETE FROM download_chunks")
         
         # 删除所有下载记录
         cur.execute("DELETE FROM downloads")
@@ -1675,6 +1985,7 @@ def delete_download_record(download_id: int, delete_local_file: bool = True):
         # 删除上传记录（外键约束会自动级联删除，但显式删除更清晰）
         cur.execute("DELETE FROM uploads WHERE download_id = ?", (download_id,))
         upload_count = cur.rowcount
+        cur.execute("DELETE FROM download_chunks WHERE download_id = ?", (download_id,))
         
         # 删除下载记录
         cur.execute("DELETE FROM downloads WHERE id = ?", (download_id,))
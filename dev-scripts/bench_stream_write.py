@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""
+直链写出路径微基准
+
+模拟 media_streamer 的输出：从分块缓存取 1 MiB 分块，按 Range 裁剪首尾后经 asyncio 传输写入本地套接字，
+对端持续读取。对比两种写法：
+  before: bytes 切片裁剪首尾（每次复制），整块 write
+  after : memoryview 裁剪（零复制），WriteCoalescer 按 SO_SNDBUF 切片写出并合并小块
+输出吞吐量（MiB/s）、tracemalloc 统计的写出期间内存峰值，以及期间的 GC 次数。
+
+用法:
+    python dev-scripts/bench_stream_write.py [--requests 200] [--range-mib 4]
+"""
+import argparse
+import asyncio
+import gc
+import importlib.util
+import os
+import random
+import socket
+import time
+import tracemalloc
+
+CHUNK_SIZE = 1024 * 1024
+WRITE_BUFFER_LIMIT = 64 * 1024  # 与 aiohttp StreamWriter 的排空阈值一致
+
+# 直接按路径加载，避免导入 WebStreamer 包（需要 pyrogram 与配置文件）
+_spec = importlib.util.spec_from_file_location(
+    "write_coalescer",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "WebStreamer", "utils", "write_coalescer.py"),
+)
+write_coalescer = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(write_coalescer)
+
+
+def make_ranges(count: int, range_mib: int, file_chunks: int, seed: int = 1):
+    """生成不与分块边界对齐的 Range 请求（模拟 aria2 分段与播放器拖动）"""
+    rnd = random.Random(seed)
+    ranges = []
+    for _ in range(count):
+        start = rnd.randrange(0, (file_chunks - range_mib - 1) * CHUNK_SIZE)
+        ranges.append((start, start + range_mib * CHUNK_SIZE - rnd.randrange(1, CHUNK_SIZE)))
+    return ranges
+
+
+def yield_parts(chunks, from_bytes: int, until_bytes: int, use_view: bool):
+    offset = from_bytes - (from_bytes % CHUNK_SIZE)
+    first_part_cut = from_bytes - offset
+    last_part_cut = until_bytes % CHUNK_SIZE + 1
+    first = offset // CHUNK_SIZE
+    part_count = until_bytes // CHUNK_SIZE - first + 1
+    for i in range(part_count):
+        chunk = chunks[first + i]
+        if use_view:
+            chunk = memoryview(chunk)
+        if part_count == 1:
+            yield chunk[first_part_cut:last_part_cut]
+        elif i == 0:
+            yield chunk[first_part_cut:]
+        elif i == part_count - 1:
+            yield chunk[:last_part_cut]
+        else:
+            yield chunk
+
+
+async def run(mode: str, ranges, chunks) -> dict:
+    left, right = socket.socketpair()
+    _, writer = await asyncio.open_connection(sock=left)
+    peer_reader, peer_writer = await asyncio.open_connection(sock=right)
+    write_size = write_coalescer.socket_write_size(left)
+
+    async def drain_peer():
+        received = 0
+        while True:
+            data = await peer_reader.read(CHUNK_SIZE)
+            if not data:
+                return received
+            received += len(data)
+
+    async def raw_write(data):
+        writer.write(data)
+        if writer.transport.get_write_buffer_size() > WRITE_BUFFER_LIMIT:
+            await writer.drain()
+
+    peer_task = asyncio.create_task(drain_peer())
+    gc.collect()
+    gc_before = sum(stat["collections"] for stat in gc.get_stats())
+    tracemalloc.start()
+    started = time.perf_counter()
+    sent = 0
+    for from_bytes, until_bytes in ranges:
+        if mode == "after":
+            coalescer = write_coalescer.WriteCoalescer(raw_write, write_size)
+            for part in yield_parts(chunks, from_bytes, until_bytes, use_view=True):
+                await coalescer.write(part)
+                sent += len(part)
+            await coalescer.flush()
+        else:
+            for part in yield_parts(chunks, from_bytes, until_bytes, use_view=False):
+                await raw_write(part)
+                sent += len(part)
+    await writer.drain()
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    gc_after = sum(stat["collections"] for stat in gc.get_stats())
+
+    writer.close()
+    received = await peer_task
+    peer_writer.close()
+    assert received == sent, (received, sent)
+    mib = sent / CHUNK_SIZE
+    return {
+        "mode": mode,
+        "mib": mib,
+        "mib_per_s": mib / elapsed,
+        "peak_kib": peak / 1024,
+        "gc_collections": gc_after - gc_before,
+        "write_size": write_size,
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="直链写出路径微基准")
+    parser.add_argument("--requests", type=int, default=200, help="Range 请求数量")
+    parser.add_argument("--range-mib", type=int, default=4, help="每个 Range 请求的大小（MiB）")
+    parser.add_argument("--file-mib", type=int, default=64, help="模拟文件大小（MiB，分块常驻内存）")
+    args = parser.parse_args()
+
+    chunks = [os.urandom(CHUNK_SIZE) for _ in range(args.file_mib)]
+    ranges = make_ranges(args.requests, args.range_mib, args.file_mib)
+    for mode in ("before", "after"):
+        result = await run(mode, ranges, chunks)
+        print(
+            f"{result['mode']:>6}: {result['mib']:.0f} MiB, {result['mib_per_s']:.0f} MiB/s, "
+            f"峰值内存 {result['peak_kib']:.0f} KiB, GC {result['gc_collections']} 次, "
+            f"写入大小 {result['write_size'] // 1024} KiB"
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -6,6 +6,7 @@
 export type WSMessageType = 
   | 'initial' 
   | 'download_update' 
+  | 'download_progress_batch'
   | 'upload_update' 
   | 'cleanup_update' 
   | 'statistics_update'